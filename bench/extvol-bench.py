@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Benchmark opening and closing extended volumes without a desktop session.
+
+    Builds a synthetic volume and $HOME in a temporary directory, puts stub
+    versions of the external tools on PATH (absolute tool paths are mapped
+    onto the stubs as well), replaces the GTK dialogs, Notify and CUPS with
+    stand-ins and then opens and closes the volume a number of times. The
+    wall time of every profile and of the whole open/close, and the
+    latency of every external command, is printed as JSON.
+
+    Usage: extvol-bench.py [-n RUNS] [-l LATENCY] [-t TOOL=LATENCY ...] [-o FILE]
+"""
+
+import os
+import sys
+import json
+import time
+import types
+import getopt
+import shutil
+import tempfile
+import threading
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+# Tools which get a stub, with the output the stub prints
+STUBS = {
+    "dconf": "",
+    "gconftool-2": "",
+    "gsettings": "",
+    "ps": "",
+    "lsof": "",
+    "sudo": "",
+    "pulseaudio": "",
+    "tracker": "",
+    "evolution": "",
+    "gpg-config": "",
+    "pkill": "",
+    "killall": "",
+    "backintime": "",
+    "gconf-dumper.py": "",
+    "hamster-service": "",
+    "vbox-starter.sh": "",
+    "sync": "",
+    }
+
+class _Stub(object):
+    """ Accepts any attribute access or call, standing in for GObject APIs """
+    def __init__(self, *args, **kwargs):
+        pass
+
+    def __getattr__(self, name):
+        return _Stub()
+
+    def __call__(self, *args, **kwargs):
+        return _Stub()
+
+    def __iter__(self):
+        return iter([])
+
+class _MainContext(object):
+    """ Just enough of GLib.MainContext to dispatch idle callbacks """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._idle = []
+
+    def add(self, func, args):
+        with self._lock:
+            self._idle.append((func, args))
+        self._event.set()
+
+    def wakeup(self):
+        self._event.set()
+
+    def iteration(self, may_block):
+        if may_block:
+            self._event.wait()
+        self._event.clear()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for func, args in idle:
+            func(*args)
+        return bool(idle)
+
+class _GLib(_Stub):
+    """ GLib stand-in with a working default main context, so code which
+        waits on the main loop behaves as in a session """
+    def __init__(self):
+        context = _MainContext()
+        self.MainContext = types.SimpleNamespace(default=lambda: context)
+        self.idle_add = lambda func, *args: context.add(func, args)
+
+def _install_fake_modules():
+    """ Register stand-ins for gi (Gtk, Notify, GLib, Gio) and cups. The Gio
+        stand-in is never used for settings, they go through the (stubbed)
+        dconf tool. """
+    gi = types.ModuleType("gi")
+    gi.require_version = lambda *args: None
+    repository = types.ModuleType("gi.repository")
+    for name in ("Gtk", "Notify", "Gio", "GObject"):
+        setattr(repository, name, _Stub())
+    repository.GLib = _GLib()
+    gi.repository = repository
+    sys.modules["gi"] = gi
+    sys.modules["gi.repository"] = repository
+    cups = types.ModuleType("cups")
+    cups.Connection = _Stub
+    sys.modules["cups"] = cups
+
+def _write_stubs(bindir, latency, overrides):
+    for tool, output in STUBS.items():
+        path = os.path.join(bindir, tool)
+        with open(path, 'w') as stub:
+            stub.write("#!/bin/sh\nsleep %s\nprintf '%%s' '%s'\nexit 0\n" % \
+                       (overrides.get(tool, latency), output))
+        os.chmod(path, 0o755)
+
+def _seed_volume(mountpoint):
+    """ Create the files an initialized extended volume carries """
+    for path in (".gnupg", ".thunderbird", ".config/pulse", ".config/backintime",
+                 ".local/share/evolution", ".config/libreoffice"):
+        os.makedirs(os.path.join(mountpoint, path), exist_ok=True)
+    for path in (".extended_volume", ".gnupg/gnupg-scripts.conf", ".gnupg/gpg-agent.conf",
+                 ".config/backintime/config", ".nemo-backup.txt.dump",
+                 ".evolution-backup.xml.dump"):
+        open(os.path.join(mountpoint, path), 'a').close()
+    for i in range(4):
+        with open(os.path.join(mountpoint, ".config/pulse", "state-%d.tdb" % i), 'wb') as f:
+            f.write(os.urandom(64 * 1024))
+
+def _map_tools(bindir):
+    """ Run stubs instead of tools called with an absolute path """
+    original = subprocess.Popen.__init__
+
+    def init(self, args, *rest, **kwargs):
+        if isinstance(args, (list, tuple)) and args:
+            stub = os.path.join(bindir, os.path.basename(args[0]))
+            if os.path.exists(stub):
+                args = [stub] + list(args[1:])
+        original(self, args, *rest, **kwargs)
+    subprocess.Popen.__init__ = init
+
+def _stats(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {"mean": sum(samples) / len(samples), "min": samples[0],
+            "max": samples[-1], "median": samples[len(samples) // 2],
+            "runs": len(samples)}
+
+def run(runs, latency, overrides):
+    base = tempfile.mkdtemp(prefix="extvol-bench-")
+    home = os.path.join(base, "home")
+    mountpoint = os.path.join(base, "volume")
+    bindir = os.path.join(base, "bin")
+    for path in (home, mountpoint, bindir, os.path.join(home, ".config/pulse")):
+        os.makedirs(path)
+    _write_stubs(bindir, latency, overrides)
+    _seed_volume(mountpoint)
+    os.environ["HOME"] = home
+    os.environ["USER"] = "bench"
+    os.environ["PATH"] = bindir + os.pathsep + os.environ.get("PATH", "")
+    _map_tools(bindir)
+    _install_fake_modules()
+
+    import extvolmanager
+    import extvolprocs
+    import extvolmounts
+    import extvolrun
+    import extvolsettings
+
+    extvolsettings.USE_GIO = False
+    dialogs = []
+    extvolmanager.show_error = lambda message=None, variables=None: \
+        dialogs.append(message or str(variables))
+    extvolmanager.ask_user = lambda title, message: False
+    # The synthetic volume is not a real mount: pretend it is, and time the
+    # open file scan but ignore what it finds on the shared filesystem.
+    extvolmounts.is_mountpoint = lambda path: True
+    scan = extvolprocs.open_files
+    scans = []
+
+    def open_files(mountpoint, exclude=(), sudo=False):
+        start = time.monotonic()
+        scan(mountpoint, exclude, sudo)
+        scans.append(time.monotonic() - start)
+        return []
+    extvolprocs.open_files = open_files
+
+    timings = {"open": {}, "close": {}}
+    run_profiles = extvolmanager._run_profiles
+
+    def timed_profiles(mountpoint, opening, *args, **kwargs):
+        result = run_profiles(mountpoint, opening, *args, **kwargs)
+        for name, seconds in result.items():
+            timings["open" if opening else "close"].setdefault(name, []).append(seconds)
+        return result
+    extvolmanager._run_profiles = timed_profiles
+
+    totals = {"open": [], "close": []}
+    try:
+        for i in range(runs):
+            start = time.monotonic()
+            extvolmanager.extvol_open(mountpoint)
+            totals["open"].append(time.monotonic() - start)
+            start = time.monotonic()
+            extvolmanager.extvol_close(mountpoint)
+            totals["close"].append(time.monotonic() - start)
+    finally:
+        shutil.rmtree(base, ignore_errors=True)
+
+    return {
+        "runs": runs,
+        "stub_latency": latency,
+        "stub_overrides": overrides,
+        "open": _stats(totals["open"]),
+        "close": _stats(totals["close"]),
+        "open_file_scan": _stats(scans),
+        "profiles": dict((action, dict((name, _stats(samples))
+                                       for name, samples in sorted(profiles.items())))
+                         for action, profiles in timings.items()),
+        "dialogs": dialogs,
+        "commands": extvolrun.runner().stats(),
+        }
+
+def main():
+    runs = 5
+    latency = 0.02
+    overrides = {}
+    output = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:l:t:o:")
+    except getopt.GetoptError as error:
+        print(error, file=sys.stderr)
+        print(__doc__.strip().splitlines()[-1], file=sys.stderr)
+        sys.exit(2)
+    for o, a in opts:
+        if o == "-n":
+            runs = int(a)
+        elif o == "-l":
+            latency = float(a)
+        elif o == "-t":
+            tool, value = a.split('=', 1)
+            overrides[tool] = float(value)
+        elif o == "-o":
+            output = a
+    result = json.dumps(run(runs, latency, overrides), indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as out:
+            out.write(result + '\n')
+    else:
+        print(result)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Measure the cold start of extvolmanager and extvol-close and check it
+    against the startup budget.
+
+    Every sample is a fresh interpreter. "import" times "import
+    extvolmanager" and checks that none of the bindings which are meant to
+    load on first use (Gtk, Notify, GLib, Gio, CUPS, VirtualBox,
+    asyncio) got imported.
+    "extvol-close" times the whole script for a path which is not an open
+    extended volume, i.e. startup plus the mount table lookup. The median of
+    each must stay within BUDGET seconds; the exit status is 1 otherwise.
+
+    Usage: extvol-startup.py [-n RUNS] [-b BUDGET] [-o FILE]
+"""
+
+import os
+import sys
+import json
+import time
+import getopt
+import shutil
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(HERE)
+
+# Seconds the median cold start may take
+BUDGET = 0.25
+# Modules which must not be imported by "import extvolmanager"
+LAZY = ("gi.repository.Gtk", "gi.repository.Notify", "gi.repository.GLib",
+        "gi.repository.Gio", "cups", "vboxapi", "asyncio")
+
+IMPORT = """
+import sys, time, json
+start = time.monotonic()
+import extvolmanager
+elapsed = time.monotonic() - start
+print(json.dumps({"elapsed": elapsed, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (LAZY,)
+
+def _median(samples):
+    samples = sorted(samples)
+    return samples[len(samples) // 2] if samples else None
+
+def run(runs):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = TOP + os.pathsep + env.get("PYTHONPATH", "")
+    home = tempfile.mkdtemp(prefix="extvol-startup-")
+    env["HOME"] = home
+    imports, closes, loaded = [], [], set()
+    try:
+        for i in range(runs):
+            out = subprocess.run([sys.executable, "-c", IMPORT], env=env, check=True,
+                                 stdout=subprocess.PIPE, universal_newlines=True).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            imports.append(result["elapsed"])
+            loaded.update(result["loaded"])
+            start = time.monotonic()
+            subprocess.run([sys.executable, os.path.join(TOP, "extvol-close"), home],
+                           env=env, check=True)
+            closes.append(time.monotonic() - start)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    return {"runs": runs, "import": _median(imports), "extvol-close": _median(closes),
+            "eagerly_loaded": sorted(loaded)}
+
+def main():
+    runs = 5
+    budget = BUDGET
+    output = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "n:b:o:")
+    except getopt.GetoptError as error:
+        print(error, file=sys.stderr)
+        print(__doc__.strip().splitlines()[-1], file=sys.stderr)
+        sys.exit(2)
+    for o, a in opts:
+        if o == "-n":
+            runs = int(a)
+        elif o == "-b":
+            budget = float(a)
+        elif o == "-o":
+            output = a
+    result = run(runs)
+    result["budget"] = budget
+    result["ok"] = result["import"] <= budget and result["extvol-close"] <= budget and \
+        not result["eagerly_loaded"]
+    text = json.dumps(result, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as out:
+            out.write(text + '\n')
+    else:
+        print(text)
+    sys.exit(0 if result["ok"] else 1)
+
+if __name__ == "__main__":
+    main()
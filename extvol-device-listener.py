@@ -3,32 +3,136 @@
 
 import os.path
 import gettext
-from gi.repository import GObject, Gio
+import syslog
+import concurrent.futures
+from gi.repository import GObject, GLib, Gio
 from dbus.mainloop.glib import DBusGMainLoop
 import extvolmanager
+import extvolmounts
 
 gettext.install("extended-volume-manager")
 
-class ExtvolDeviceListener(object):
-    def mount_added(self, obj, data):
-        mountpoint = data.get_root().get_path().rstrip('/')
-        device = data.get_volume().get_identifier("unix-device")
-        fs = extvolmanager.getFilesystem(mountpoint)
-        if fs.startswith("ext"):
-            extvolmanager.fixPermissions(mountpoint)
-        if device.startswith("/dev/dm-") and \
-                os.path.exists(os.path.join(mountpoint, ".extended_volume")):
-            if extvolmanager.ask_user(_("Extended volume"),
-                                      _("This appears to be an extended Volume. "
-                                        "Do you want to make use of the settings "
-                                        "stored therein?")):
-                extvolmanager.extvol_open(mountpoint)
+# Milliseconds a mount has to stay before it is handled, so that a device
+# which is mounted and unmounted again in quick succession is ignored
+DEBOUNCE = 1000
+# Upper bound for the number of devices prepared at the same time
+MAX_WORKERS = 4
+
+def _mount_key(mount):
+    """ Return what identifies the device behind a Gio.Mount: its UUID if
+        it has one, else the device node """
+    uuid = mount.get_uuid()
+    if not uuid and mount.get_volume() is not None:
+        uuid = mount.get_volume().get_uuid()
+    if uuid:
+        return uuid
+    entry = extvolmounts.table().by_mountpoint(mount.get_root().get_path())
+    return entry.device if entry is not None else mount.get_root().get_path()
 
+def prepare(mountpoint):
+    """ Fix the permissions of a newly mounted volume. Returns True if it
+        is an extended volume which can be opened. Runs in a worker. """
+    mount = extvolmounts.table().by_mountpoint(mountpoint)
+    if mount is None:
+        return False
+    if mount.fstype.startswith("ext"):
+        extvolmanager.fixPermissions(mountpoint)
+    return mount.device.startswith("/dev/dm-") and \
+        os.path.exists(os.path.join(mountpoint, ".extended_volume"))
+
+class ExtvolDeviceListener(object):
+    """ Handles mount events off the main loop. Events are debounced and
+        deduplicated per device; an event for a device still being prepared
+        is kept, the latest one per device, and handled once that is done.
+        Different devices are prepared in parallel, and the results come
+        back to the main loop, where the user is asked and the volume
+        opened. Several extended volumes can be open, but
+        they are opened one after the other, as opening serves the main
+        loop while it waits. """
     def __init__(self):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        # key -> GLib source of the debounce timer
+        self.pending = {}
+        # key -> mountpoint being prepared by a worker
+        self.active = {}
+        # key -> mountpoint of the latest event which came in meanwhile
+        self.rerun = {}
+        # mountpoint -> key, as the device is gone when the mount is removed
+        self.keys = {}
+        # extended volumes waiting for the one being opened
+        self.queue = []
+        self.opening = False
         self.vm = Gio.VolumeMonitor.get()
         for mount in self.vm.get_mounts():
             self.mount_added(None, mount)
         self.vm.connect("mount-added", self.mount_added)
+        self.vm.connect("mount-removed", self.mount_removed)
+
+    def mount_added(self, obj, data):
+        mountpoint = data.get_root().get_path()
+        if mountpoint is None:
+            return
+        mountpoint = mountpoint.rstrip('/')
+        key = self.keys[mountpoint] = _mount_key(data)
+        if key in self.pending:
+            GLib.source_remove(self.pending.pop(key))
+        self.pending[key] = GLib.timeout_add(DEBOUNCE, self._submit, key, mountpoint)
+
+    def mount_removed(self, obj, data):
+        mountpoint = data.get_root().get_path()
+        key = self.keys.pop(mountpoint.rstrip('/'), None) if mountpoint else None
+        if key in self.pending:
+            syslog.syslog(syslog.LOG_DEBUG, "%s went away before it was handled" % key)
+            GLib.source_remove(self.pending.pop(key))
+        self.rerun.pop(key, None)
+
+    def _submit(self, key, mountpoint):
+        del self.pending[key]
+        if key in self.active:
+            syslog.syslog(syslog.LOG_DEBUG, "%s is still being handled, handling it "
+                          "again afterwards" % key)
+            self.rerun[key] = mountpoint
+            return False
+        self._prepare(key, mountpoint)
+        return False
+
+    def _prepare(self, key, mountpoint):
+        self.active[key] = mountpoint
+        future = self.pool.submit(prepare, mountpoint)
+        future.add_done_callback(
+            lambda future: GLib.idle_add(self._prepared, key, mountpoint, future))
+
+    def _prepared(self, key, mountpoint, future):
+        del self.active[key]
+        if key in self.rerun:
+            # Superseded by a later event of the same device
+            self._prepare(key, self.rerun.pop(key))
+            return False
+        try:
+            extended = future.result()
+        except Exception as error:
+            syslog.syslog(syslog.LOG_ERR, "Handling %s failed: %s" % (mountpoint, error))
+            return False
+        if extended:
+            self.queue.append(mountpoint)
+            self._open_next()
+        return False
+
+    def _open_next(self):
+        if self.opening:
+            return
+        self.opening = True
+        try:
+            while self.queue:
+                mountpoint = self.queue.pop(0)
+                if extvolmounts.is_mountpoint(mountpoint) and \
+                        extvolmanager.ask_user(_("Extended volume"),
+                                               _("This appears to be an extended Volume. "
+                                                 "Do you want to make use of the settings "
+                                                 "stored therein?")):
+                    extvolmanager.extvol_open(mountpoint)
+        finally:
+            self.opening = False
 
 if __name__ == "__main__":
     DBusGMainLoop(set_as_default=True)
@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Copy directory trees quickly and resumably: files are cloned or copied
+    in the kernel where the filesystems allow it, several at a time, with
+    their metadata """
+
+import os
+import stat
+import errno
+import fcntl
+import shutil
+import threading
+import concurrent.futures
+
+# Upper bound for the number of files copied at the same time
+MAX_WORKERS = 8
+# Suffix of the staging directory a tree is copied into
+PARTIAL = ".extvol-partial"
+# Suffix of a file which is still being copied
+PART = ".part"
+# ioctl sharing the extents of a file (reflink), _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+# Bytes per copy_file_range() / read() call
+CHUNK = 1 << 24
+# Modification times of a staged and a source file which differ by less than
+# this many nanoseconds count as equal: FAT keeps them in steps of two
+# seconds, and some network filesystems round them as well
+MTIME_SLACK = 2000000000
+
+# errnos which mean the kernel cannot do this copy and userspace has to
+_UNSUPPORTED = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP,
+                errno.ENOTTY, errno.EBADF, errno.ETXTBSY)
+
+class TreeCopy(object):
+    """ Copies the tree at src to dst, which must not exist yet. The tree is
+        built in dst + PARTIAL and renamed to dst when complete; files in a
+        staging directory left by an interrupted copy are kept if their size
+        and modification time match the source, within MTIME_SLACK.
+        progress, if given, is called with the fraction of bytes done. """
+    def __init__(self, src, dst, progress=None):
+        self.src = src
+        self.dst = dst
+        self.staging = dst.rstrip('/') + PARTIAL
+        self.progress = progress
+        self.total = 0
+        self.done = 0
+        self.skipped = 0
+        self._clone = True
+        self._copy_range = hasattr(os, "copy_file_range")
+        self._lock = threading.Lock()
+
+    def _plan(self):
+        """ Return the relative paths of the directories, files (with their
+            stat results) and symlinks below src """
+        dirs, files, links = [''], [], []
+        for root, dirnames, filenames in os.walk(self.src):
+            rel = os.path.relpath(root, self.src)
+            rel = '' if rel == '.' else rel
+            for name in dirnames + filenames:
+                path = os.path.join(rel, name)
+                st = os.lstat(os.path.join(self.src, path))
+                if stat.S_ISLNK(st.st_mode):
+                    links.append(path)
+                elif stat.S_ISDIR(st.st_mode):
+                    dirs.append(path)
+                elif stat.S_ISREG(st.st_mode):
+                    files.append((path, st))
+        return dirs, files, links
+
+    def _advance(self, nbytes):
+        with self._lock:
+            self.done += nbytes
+            done, total = self.done, self.total
+        if self.progress is not None and total:
+            self.progress(min(done / total, 1.0))
+
+    def _copy_data(self, fsrc, fdst, size):
+        """ Copy the contents of one open file to another, cloning the
+            extents if possible, then in the kernel, then through a buffer """
+        if self._clone:
+            try:
+                fcntl.ioctl(fdst, FICLONE, fsrc)
+                self._advance(size)
+                return
+            except OSError as error:
+                if error.errno not in _UNSUPPORTED:
+                    raise
+                self._clone = False
+        copied = 0
+        if self._copy_range:
+            try:
+                while True:
+                    n = os.copy_file_range(fsrc, fdst, CHUNK)
+                    if n == 0:
+                        break
+                    copied += n
+                    self._advance(n)
+                return
+            except OSError as error:
+                if copied or error.errno not in _UNSUPPORTED:
+                    raise
+                self._copy_range = False
+        while True:
+            block = os.read(fsrc, CHUNK)
+            if not block:
+                break
+            os.write(fdst, block)
+            self._advance(len(block))
+
+    def _copy_file(self, path, st):
+        target = os.path.join(self.staging, path)
+        try:
+            tst = os.lstat(target)
+            if tst.st_size == st.st_size and \
+                    abs(tst.st_mtime_ns - st.st_mtime_ns) < MTIME_SLACK:
+                with self._lock:
+                    self.skipped += 1
+                self._advance(st.st_size)
+                return
+        except FileNotFoundError:
+            pass
+        part = target + PART
+        fsrc = os.open(os.path.join(self.src, path), os.O_RDONLY)
+        try:
+            fdst = os.open(part, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                self._copy_data(fsrc, fdst, st.st_size)
+            finally:
+                os.close(fdst)
+        finally:
+            os.close(fsrc)
+        shutil.copystat(os.path.join(self.src, path), part)
+        os.replace(part, target)
+
+    def run(self):
+        """ Copy the tree, return the number of files taken over from an
+            interrupted earlier copy """
+        dirs, files, links = self._plan()
+        self.total = sum(st.st_size for path, st in files)
+        for path in dirs:
+            os.makedirs(os.path.join(self.staging, path), exist_ok=True)
+        for path in links:
+            target = os.path.join(self.staging, path)
+            if os.path.lexists(target):
+                os.remove(target)
+            os.symlink(os.readlink(os.path.join(self.src, path)), target)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            for future in [pool.submit(self._copy_file, path, st) for path, st in files]:
+                future.result()
+        # Directory times change while they are filled, so they come last,
+        # deepest first
+        for path in reversed(dirs):
+            shutil.copystat(os.path.join(self.src, path), os.path.join(self.staging, path))
+        os.rename(self.staging, self.dst)
+        if self.progress is not None:
+            self.progress(1.0)
+        return self.skipped
+
+def copy_tree(src, dst, progress=None):
+    """ Copy the tree at src to dst, see TreeCopy. Returns the number of
+        files an interrupted earlier copy had already done. """
+    return TreeCopy(src, dst, progress).run()
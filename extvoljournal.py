@@ -0,0 +1,131 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Write-ahead journal of the symlinks and renames done in $HOME while an
+    extended volume is open. Every operation is recorded, and flushed to
+    disk, before it is done, so after a crash exactly the recorded
+    operations can be undone, newest first.
+
+    Usage: python3 -m extvoljournal [JOURNAL]
+    recovers from the given (default: the user's) journal.
+"""
+
+import os
+import sys
+import json
+import syslog
+import threading
+
+def default_path():
+    """ Return where the journal is kept, next to the marker file """
+    return os.path.join(os.environ["HOME"], ".mounted_as_extended_volume.journal")
+
+class Journal(object):
+    """ Appends one JSON object per line to the journal and then performs
+        the operation. Safe to use from several threads. """
+    def __init__(self, path=None):
+        self.path = path or default_path()
+        self._lock = threading.Lock()
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+    def _append(self, record):
+        line = (json.dumps(record, sort_keys=True) + '\n').encode("utf-8")
+        with self._lock:
+            os.write(self._fd, line)
+            os.fdatasync(self._fd)
+
+    def begin(self, mountpoint):
+        """ Start the journal of opening mountpoint """
+        self._append({"op": "begin", "mountpoint": mountpoint, "pid": os.getpid()})
+
+    def rename(self, src, dst, profile=None):
+        self._append({"op": "rename", "src": src, "dst": dst, "profile": profile})
+        os.rename(src, dst)
+
+    def symlink(self, target, link, profile=None):
+        self._append({"op": "symlink", "target": target, "link": link, "profile": profile})
+        os.symlink(target, link)
+
+    def of(self, profile):
+        """ Return the rename and symlink functions recording the profile
+            the operations are done for """
+        return (lambda src, dst: self.rename(src, dst, profile),
+                lambda target, link: self.symlink(target, link, profile))
+
+    def close(self):
+        os.close(self._fd)
+
+def read(path=None):
+    """ Return the records of a journal. A torn last line, left by a crash
+        while it was written, is ignored: its operation never ran. """
+    records = []
+    try:
+        with open(path or default_path(), 'r') as journal:
+            for line in journal:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    break
+    except FileNotFoundError:
+        pass
+    return records
+
+def _undo(record):
+    """ Undo one operation if it is still in effect, return True if so """
+    if record["op"] == "symlink":
+        link = record["link"]
+        if os.path.islink(link) and os.readlink(link) == record["target"]:
+            os.remove(link)
+            return True
+    elif record["op"] == "rename":
+        if os.path.lexists(record["dst"]) and not os.path.lexists(record["src"]):
+            os.rename(record["dst"], record["src"])
+            return True
+    return False
+
+def recover(path=None):
+    """ Undo the operations of a journal, newest first, and remove it.
+        Operations which were already undone, e.g. by a close which did not
+        finish, are skipped. Returns the number of operations undone. """
+    path = path or default_path()
+    undone = 0
+    for record in reversed(read(path)):
+        try:
+            if _undo(record):
+                undone += 1
+        except OSError as error:
+            syslog.syslog(syslog.LOG_ERR, "Could not undo %s: %s" % (record, error))
+    clear(path)
+    return undone
+
+def keep(path, profiles=None):
+    """ Append the records of the journal at path to the default journal,
+        which is recovered when a volume is opened next, and remove it.
+        If profiles is given, only the operations done for those profiles,
+        or for no recorded profile, are kept; the others were undone when
+        their profiles were closed. """
+    if not os.path.exists(path):
+        return
+    records = [record for record in read(path)
+               if profiles is None or record.get("profile") is None or
+               record["profile"] in profiles]
+    fd = os.open(default_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+    try:
+        os.write(fd, b"".join((json.dumps(record, sort_keys=True) + '\n').encode("utf-8")
+                              for record in records))
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    clear(path)
+
+def clear(path=None):
+    """ Remove the journal, after everything in it was undone """
+    try:
+        os.remove(path or default_path())
+    except FileNotFoundError:
+        pass
+
+if __name__ == "__main__":
+    syslog.openlog("extended-volume-manager")
+    journal = sys.argv[1] if len(sys.argv) > 1 else default_path()
+    syslog.syslog(syslog.LOG_DEBUG, "Recovered %d operations from %s" % \
+                  (recover(journal), journal))
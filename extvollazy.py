@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Import heavy bindings (Gtk, Notify, CUPS, VirtualBox) on first use
+    instead of at startup """
+
+import importlib
+import importlib.util
+import threading
+
+class LazyModule(object):
+    """ Stands in for a module and imports it when an attribute is first
+        accessed. For GObject introspection bindings give the package
+        "gi.repository", the namespace as name and its version. """
+    def __init__(self, package, name=None, version=None):
+        self._package = package
+        self._name = name
+        self._version = version
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._module is None:
+                if self._version is not None:
+                    import gi
+                    gi.require_version(self._name, self._version)
+                if self._name is None:
+                    self._module = importlib.import_module(self._package)
+                else:
+                    # Same as "from package import name"
+                    package = __import__(self._package, fromlist=[self._name])
+                    self._module = getattr(package, self._name)
+            return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        name = self._package if self._name is None else "%s.%s" % (self._package, self._name)
+        state = "loaded" if self._module is not None else "not loaded"
+        return "<lazy module %s (%s)>" % (name, state)
+
+def available(name):
+    """ Return True if the module can be imported, without importing it """
+    try:
+        return importlib.util.find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
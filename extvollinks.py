@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Plan the symlinks from $HOME into an extended volume for all profiles
+    at once, then apply the plan profile by profile.
+
+    Usage: python3 -m extvollinks [-c] MOUNTPOINT
+    prints the plan for opening (with -c: closing) the volume without
+    changing anything.
+"""
+
+import os
+import sys
+import json
+import getopt
+import threading
+import extvolsettings
+
+# Index of the highest .old-N generation used per path, kept in $HOME
+INDEX = ".extvol-generations.json"
+
+def conffile_target(mountpoint, conffile):
+    """ Return where a configuration file is kept on the volume: in its
+        root, under its (dotted) base name """
+    name = os.path.basename(conffile)
+    if not name.startswith('.'):
+        name = '.' + name
+    return os.path.join(mountpoint, name)
+
+class LinkPlan(object):
+    """ The operations which link (opening) or unlink (closing) the
+        configuration directories and files of a set of profiles. Every
+        directory involved is read with one scandir(), however many entries
+        of it are linked, and the .old-N generation to rotate a backup to
+        comes from an index instead of probing. """
+    def __init__(self, mountpoint, home=None, opening=True):
+        self.mountpoint = mountpoint
+        self.home = home or os.environ["HOME"]
+        self.opening = opening
+        self.ops = {}
+        self._listings = {}
+        self._lock = threading.Lock()
+        self._index_path = os.path.join(self.home, INDEX)
+        try:
+            with open(self._index_path, 'r') as index:
+                self.generations = json.load(index)
+        except (OSError, ValueError):
+            self.generations = {}
+        self._index_changed = False
+
+    def _listing(self, directory):
+        """ Return a dict of the entries in directory, mapping each name to
+            the DirEntry, or None if the directory does not exist """
+        if directory not in self._listings:
+            try:
+                self._listings[directory] = dict((e.name, e) for e in os.scandir(directory))
+            except (FileNotFoundError, NotADirectoryError):
+                self._listings[directory] = None
+        return self._listings[directory]
+
+    def _entry(self, path):
+        listing = self._listing(os.path.dirname(path))
+        return listing.get(os.path.basename(path)) if listing else None
+
+    def _next_generation(self, relpath, home):
+        """ Return the generation for rotating the backup of relpath, taking
+            the higher of the index and the .old-N names seen anyway """
+        prefix = os.path.basename(home) + ".old-"
+        seen = [int(name[len(prefix):]) for name in self._listing(os.path.dirname(home)) or ()
+                if name.startswith(prefix) and name[len(prefix):].isdigit()]
+        generation = max([self.generations.get(relpath, 1)] + seen) + 1
+        self.generations[relpath] = generation
+        self._index_changed = True
+        return generation
+
+    def _link_ops(self, relpath, target, isdir):
+        home = os.path.join(self.home, relpath)
+        ops = []
+        if self._entry(target) is None:
+            ops.append(("makedirs", target) if isdir else ("mknod", target))
+        if self._listing(os.path.dirname(home)) is None:
+            ops.append(("makedirs", os.path.dirname(home)))
+        entry = self._entry(home)
+        if entry is not None:
+            if entry.is_symlink() and os.readlink(home) == target:
+                return []
+            if self._entry(home + ".old") is not None:
+                ops.append(("rename", home + ".old",
+                            "%s.old-%d" % (home, self._next_generation(relpath, home))))
+            ops.append(("rename", home, home + ".old"))
+        ops.append(("symlink", target, home))
+        return ops
+
+    def _unlink_ops(self, relpath):
+        home = os.path.join(self.home, relpath)
+        ops = []
+        entry = self._entry(home)
+        if entry is not None and entry.is_symlink():
+            ops.append(("remove", home))
+        if self._entry(home + ".old") is not None and (entry is None or entry.is_symlink()):
+            ops.append(("rename", home + ".old", home))
+        return ops
+
+    def add(self, profile):
+        """ Plan the links of a profile """
+        ops = []
+        links = [(path, os.path.join(self.mountpoint, path), True) for path in profile.confdirs]
+        links += [(path, conffile_target(self.mountpoint, path), False)
+                  for path in profile.conffiles]
+        for relpath, target, isdir in links:
+            if self.opening:
+                ops.extend(self._link_ops(relpath, target, isdir))
+            else:
+                ops.extend(self._unlink_ops(relpath))
+        self.ops[profile.name] = ops
+
+    def save_index(self):
+        """ Write the generation index if the plan used new generations """
+        if self._index_changed:
+            extvolsettings.write_atomic(self._index_path,
+                                        json.dumps(self.generations, sort_keys=True))
+            self._index_changed = False
+
+    def apply(self, name, rename=os.rename, symlink=os.symlink):
+        """ Perform the operations planned for profile name. Renames and
+            symlinks go through the given functions, so they can be
+            journaled. Returns a list of (operation, error) for the
+            operations which failed; the others are done regardless. """
+        failed = []
+        for op in self.ops.get(name, ()):
+            try:
+                if op[0] == "makedirs":
+                    os.makedirs(op[1], exist_ok=True)
+                elif op[0] == "mknod":
+                    open(op[1], 'a').close()
+                elif op[0] == "rename":
+                    rename(op[1], op[2])
+                elif op[0] == "symlink":
+                    symlink(op[1], op[2])
+                elif op[0] == "remove":
+                    os.remove(op[1])
+            except OSError as error:
+                failed.append((op, error))
+        return failed
+
+    def describe(self):
+        """ Return the plan as readable lines """
+        lines = []
+        for name, ops in sorted(self.ops.items()):
+            lines.append("%s:" % name)
+            lines.extend("    %s" % " ".join(op) for op in ops)
+            if not ops:
+                lines.append("    (nothing to do)")
+        return lines
+
+def plan(mountpoint, profiles, opening=True, home=None):
+    """ Return the LinkPlan for opening or closing the given profiles """
+    linkplan = LinkPlan(mountpoint, home, opening)
+    for profile in profiles:
+        linkplan.add(profile)
+    return linkplan
+
+if __name__ == "__main__":
+    opts, args = getopt.getopt(sys.argv[1:], "c")
+    if len(args) != 1:
+        print(__doc__.strip().splitlines()[-3].strip(), file=sys.stderr)
+        sys.exit(2)
+    import extvolmanager
+    dryrun = plan(args[0].rstrip('/'), extvolmanager.PROFILES, opening=("-c", "") not in opts)
+    print('\n'.join(dryrun.describe()))
@@ -3,117 +3,222 @@
 """ Handle opening/closing of extended volumes """
 
 import os
-import subprocess
+import json
 import gettext
 import traceback
 import sys
 import time
-import re
 import syslog
 import glob
 import shutil
+import hashlib
 import threading
-import multiprocessing
-import pickle
-import cups
-try:
-    import gi
-    gi.require_version('Gtk', '3.0')
-    gi.require_version('Notify', '0.7')
-    from gi.repository import Gtk, Notify, GLib, Gio
-except:
-    pass
-
-try:
-    from vboxapi import VirtualBoxManager
-except:
-    pass
+import concurrent.futures
+import extvolcopy
+import extvoljournal
+import extvollazy
+import extvollinks
+import extvolmanifest
+import extvolmounts
+import extvolperms
+import extvolprinters
+import extvolprocs
+import extvolrun
+import extvolsettings
+import extvolstate
+import extvoltrace
+import extvolvbox
+import extvolwatch
+# Bindings which take long to load are imported on first use
+Gtk = extvollazy.LazyModule("gi.repository", "Gtk", "3.0")
+Notify = extvollazy.LazyModule("gi.repository", "Notify", "0.7")
+GLib = extvollazy.LazyModule("gi.repository", "GLib")
+Gio = extvollazy.LazyModule("gi.repository", "Gio")
 
 gettext.install("extended-volume-manager")
-Notify.init("extended-volume-manager")
-pyn = Notify.Notification()
-pyn.set_urgency(Notify.Urgency.NORMAL)
-pyn.set_app_name("extended-volume-manager")
-pyn.set_category("device")
-pyn.set_hint("transient", GLib.Variant('b', True))
-pyn.set_timeout(2000)
 syslog.openlog("extended-volume-manager")
 
-class PBarThread(threading.Thread):
-    def __init__(self, title, message):
-        super(PBarThread, self).__init__()
-        self._stop = threading.Event()
+# Profiles may run in worker threads, their dialogs are shown one at a time
+_ui_lock = threading.Lock()
+
+_notification = None
+
+def notify(summary, body, icon="usbpendrive_unmount"):
+    """ Show a desktop notification, setting up Notify the first time """
+    _on_main(_notify, summary, body, icon)
+
+def _notify(summary, body, icon):
+    global _notification
+    if _notification is None:
+        Notify.init("extended-volume-manager")
+        _notification = Notify.Notification()
+        _notification.set_urgency(Notify.Urgency.NORMAL)
+        _notification.set_app_name("extended-volume-manager")
+        _notification.set_category("device")
+        _notification.set_hint("transient", GLib.Variant('b', True))
+        _notification.set_timeout(2000)
+    _notification.update(summary, body, icon)
+    _notification.show()
+
+def _is_main_thread():
+    return threading.current_thread() is threading.main_thread()
+
+def _on_main(func, *args):
+    """ Call func on the main thread: directly if this is the main thread,
+        else through the main loop. Returns nothing. """
+    def call():
+        func(*args)
+        return False
+    if _is_main_thread():
+        func(*args)
+    else:
+        GLib.idle_add(call)
+
+def _call_on_main(func, *args):
+    """ Call func on the main thread and return its result. Worker threads
+        wait until the main loop got to it, which it does while the main
+        thread waits in _wait(), and take turns. """
+    if _is_main_thread():
+        return func(*args)
+    result = []
+    called = threading.Event()
+
+    def call():
+        try:
+            result.append(func(*args))
+        finally:
+            called.set()
+        return False
+    with _ui_lock:
+        GLib.idle_add(call)
+        called.wait()
+    return result[0] if result else None
+
+def _submit(pool, func, *args):
+    """ Submit func to pool. The future wakes the main context when it
+        finishes, so _wait() on the main thread notices it at once. """
+    future = pool.submit(func, *args)
+    future.add_done_callback(lambda future: GLib.MainContext.default().wakeup())
+    return future
+
+def _wait(futures, return_when=concurrent.futures.ALL_COMPLETED):
+    """ concurrent.futures.wait() which keeps dispatching main loop events
+        when called on the main thread, so progress windows and dialogs of
+        the workers are served. The futures have to come from _submit(),
+        so that neither polling nor latency is added. """
+    if not _is_main_thread():
+        return concurrent.futures.wait(futures, return_when=return_when)
+    context = GLib.MainContext.default()
+    while True:
+        done, not_done = concurrent.futures.wait(futures, timeout=0, return_when=return_when)
+        if not not_done or (done and return_when == concurrent.futures.FIRST_COMPLETED):
+            return done, not_done
+        context.iteration(True)
+
+class ProgressWindow(object):
+    """ A small window with a message and a progress bar. All methods may be
+        called from any thread; the GTK work is always done on the main
+        thread. Updates from workers are coalesced into one idle callback. """
+    def __init__(self, title, message, pulse=False):
+        self._lock = threading.Lock()
+        self._update = None
+        self._pulse_source = None
+        self.win = None
+        _on_main(self._create, title, message, pulse)
+
+    def _create(self, title, message, pulse):
         self.win = Gtk.Window()
-        self.vbox = Gtk.VBox(homogeneous=True, spacing=10)
+        vbox = Gtk.VBox(homogeneous=True, spacing=10)
         self.label = Gtk.Label(label=message)
         self.pbar = Gtk.ProgressBar()
-        self.vbox.pack_start(self.label, True, True, 0)
-        self.vbox.pack_start(self.pbar, True, True, 0)
-        self.win.add(self.vbox)
+        self.pbar.set_show_text(True)
+        vbox.pack_start(self.label, True, True, 0)
+        vbox.pack_start(self.pbar, True, True, 0)
+        self.win.add(vbox)
         self.win.set_position(Gtk.WindowPosition.CENTER)
         self.win.set_border_width(10)
         self.win.set_keep_above(True)
         self.win.set_title(title)
-
-    def run(self):
         self.win.show_all()
-        while not self.stopped():
-            self.pbar.pulse()
-            while Gtk.events_pending():
-                Gtk.main_iteration()
-            time.sleep(.25)
-        self.win.destroy()
-        while Gtk.events_pending():
-            Gtk.main_iteration()
+        if pulse:
+            # Animation only, an indeterminate bar has nothing to report
+            self._pulse_source = GLib.timeout_add(100, self._pulse)
 
-    def stop(self):
-        self._stop.set()
+    def _pulse(self):
+        self.pbar.pulse()
+        return True
+
+    def _apply(self):
+        with self._lock:
+            fraction, text = self._update
+            self._update = None
+        if self.win is not None:
+            self.pbar.set_fraction(fraction)
+            if text is not None:
+                self.pbar.set_text(text)
+        return False
 
-    def stopped(self):
-        return self._stop.isSet()
+    def set_fraction(self, fraction, text=None):
+        """ Show fraction (0.0 to 1.0) as done, with an optional text """
+        with self._lock:
+            scheduled = self._update is not None
+            self._update = (fraction, text)
+        if not scheduled:
+            _on_main(self._apply)
+
+    def step(self, done, total, name):
+        """ Report that done of total steps are finished, the last being name """
+        self.set_fraction(float(done) / total if total else 1.0,
+                          _("%(name)s (%(done)d of %(total)d)") % \
+                          {"name": name, "done": done, "total": total})
+
+    def _destroy(self):
+        if self._pulse_source is not None:
+            GLib.source_remove(self._pulse_source)
+        if self.win is not None:
+            self.win.destroy()
+            self.win = None
+        return False
+
+    def close(self):
+        _on_main(self._destroy)
 
 def _chmod_R(mode, path):
     """ Apply the given permissions recursively to the given path. The
         "chmod" function documentation describes the mode argument.
+        Returns the number of inodes changed.
     """
     if not os.path.exists(path):
         raise OSError("no such file or directory: '%s'" % path)
-    os.chmod(path, mode)
-    if os.path.isdir(path):
-        child_paths = (os.path.join(path, c) for c in os.listdir(path))
-        for child_path in child_paths:
-            _chmod_R(mode, child_path)
-
-def _double_fork(cmd):
-    """ Execute child process with double fork. """
-    args = "import subprocess\nsubprocess.Popen(" +str(cmd) + ")"
-    subprocess.Popen(["/usr/bin/python", "-c", args])
+    changed = extvolperms.fix_tree(path, mode=mode)
+    syslog.syslog(syslog.LOG_DEBUG, "Changed permissions of %d inodes below %s" % \
+                  (changed, path))
+    return changed
 
 def start_with_pbar(args, title, message):
-    win = Gtk.Window()
-    vbox = Gtk.VBox(homogeneous=True, spacing=10)
-    label = Gtk.Label(label=message)
-    pbar = Gtk.ProgressBar()
-    vbox.pack_start(label, True, True, 0)
-    vbox.pack_start(pbar, True, True, 0)
-    win.add(vbox)
-    win.set_position(Gtk.WindowPosition.CENTER)
-    win.set_border_width(10)
-    win.set_keep_above(True)
-    win.set_title(title)
-    win.show_all()
-    p = multiprocessing.Process(target=subprocess.run, args=(args,))
-    p.start()
-    while p.is_alive():
-        pbar.pulse()
-        while Gtk.events_pending():
-            Gtk.main_iteration()
-        time.sleep(.25)
-    win.destroy()
-    while Gtk.events_pending():
-        Gtk.main_iteration()
-    p.join()
-    return p.exitcode
+    """ Run a command while showing a progress window, return its exit
+        status. The end of the command is noticed by a child watch. """
+    progress = ProgressWindow(title, message, pulse=True)
+    loop = GLib.MainLoop()
+    status = []
+
+    def exited(pid, condition):
+        status.append(condition)
+        GLib.spawn_close_pid(pid)
+        loop.quit()
+    try:
+        with extvoltrace.span(os.path.basename(args[0]), "command", argv=list(args)) as s:
+            pid = GLib.spawn_async(args, flags=GLib.SpawnFlags.SEARCH_PATH |
+                                   GLib.SpawnFlags.DO_NOT_REAP_CHILD)[0]
+            GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, exited)
+            loop.run()
+            if os.WIFEXITED(status[0]):
+                s.status = os.WEXITSTATUS(status[0])
+            else:
+                s.status = -os.WTERMSIG(status[0])
+    finally:
+        progress.close()
+    return s.status
 
 def show_error(message=None, variables=None):
     """ Display error messages """
@@ -124,17 +229,21 @@ def show_error(message=None, variables=None):
                     % {"error":traceback.format_exc(), "vars":str(variables)}
     else:
         syslog.syslog(message)
+    _call_on_main(_error_dialog, message)
+
+def _error_dialog(message):
     dlg = Gtk.MessageDialog(type=Gtk.MessageType.ERROR, buttons=Gtk.ButtonsType.OK)
     dlg.format_secondary_text(message)
     dlg.run()
     dlg.destroy()
-    while Gtk.events_pending():
-        Gtk.main_iteration()
-    return
 
 def ask_user(title, message):
     """ Ask user a Yes/No question with message """
-    question = Gtk.MessageDialog(buttons=Gtk.ButtonsType.YES_NO, type=Gtk.MessageType.QUESTION)
+    return _call_on_main(_question_dialog, title, message)
+
+def _question_dialog(title, message):
+    question = Gtk.MessageDialog(buttons=Gtk.ButtonsType.YES_NO,
+                                 type=Gtk.MessageType.QUESTION)
     question.set_markup(_(message))
     question.set_title(title)
     question.set_default_response(Gtk.ResponseType.YES)
@@ -142,503 +251,281 @@ def ask_user(title, message):
     question.set_keep_above(True)
     response = question.run()
     question.destroy()
-    while Gtk.events_pending():
-        Gtk.main_iteration()
     return response == Gtk.ResponseType.YES
 
 def getFilesystem(path):
     """ Return the filesystem of a mounted volume. """
     if not os.path.exists(path):
         return None
-    fs = None
-    try:
-        while not os.path.ismount(path):
-            path = os.path.split(path)[0]
-        p = open('/proc/mounts', 'r')
-        proc = p.readlines()
-        p.close()
-        fs = re.search("^[-/a-zA-Z0-9]* " + path + " ([a-zA-Z0-9]+)",
-                       ''.join(proc), re.MULTILINE).group(1)
-    except:
-        pass
-    return fs
+    return extvolmounts.filesystem(path)
 
-def fixPermissions(path):
+def fixPermissions(path, force=False):
     """ Make everything under path read/writable for the current user """
     try:
         syslog.syslog(syslog.LOG_DEBUG, "Setting permissions on %s" % path)
-        subprocess.run(["/usr/bin/sudo", "/bin/chown", "-R",
-                         "%s:%s" % (str(os.getuid()), str(os.getgid())), path])
-        subprocess.run(["/usr/bin/sudo", "/bin/chmod", "-R", "a+rwX", path])
+        extvolperms.fix_volume(path, force)
     except:
         show_error(_("Could not set permissions and/or ownership on %s") % path)
 
-def _link_confdir(mountpoint, confdir):
-    """ Create a symlink for a directory from /home/$USER/confdir to
-    mountpoint/confdir """
-    try:
-        syslog.syslog(syslog.LOG_DEBUG, "Configuration directory %s" % confdir)
-        if not os.path.exists(os.path.join(mountpoint, confdir)):
-            os.makedirs(os.path.join(mountpoint, confdir))
-        if not os.path.exists(os.path.join(os.environ["HOME"], os.path.dirname(confdir))):
-            os.makedirs(os.path.join(os.environ["HOME"], os.path.dirname(confdir)))
-        if os.path.lexists(os.path.join(os.environ["HOME"], confdir)):
-            if os.path.lexists(os.path.join(os.environ["HOME"], confdir + ".old")):
-                i = 2
-                while os.path.lexists(os.path.join(os.environ["HOME"], confdir + ".old-" + str(i))):
-                    i = i+1
-                os.rename(os.path.join(os.environ["HOME"], confdir + ".old"),
-                          os.path.join(os.environ["HOME"], confdir + ".old-" + str(i)))
-            os.rename(os.path.join(os.environ["HOME"], confdir),
-                      os.path.join(os.environ["HOME"], confdir + ".old"))
-        os.symlink(os.path.join(mountpoint, confdir), os.path.join(os.environ["HOME"], confdir))
-    except:
-        show_error(variables=vars())
-        return False
-
-def _unlink_confdir(mountpoint, confdir):
-    """ Remove a symlink to a configuration directory from /home/$USER """
-    syslog.syslog(syslog.LOG_DEBUG, "Configuration directory %s" % confdir)
-    try:
-        if os.path.islink(os.path.join(os.environ["HOME"], confdir)):
-            os.remove(os.path.join(os.environ["HOME"], confdir))
-        if os.path.exists(os.path.join(os.environ["HOME"], confdir + ".old")):
-            os.rename(os.path.join(os.environ["HOME"], confdir + ".old"),
-                      os.path.join(os.environ["HOME"], confdir))
-    except:
-        show_error(variables=vars())
-        return False
+def _volume_has(mountpoint, relpath):
+    """ Return True if relpath exists on the volume, see extvolmanifest """
+    return extvolmanifest.get(mountpoint).has(relpath)
 
-def _link_conffile(mountpoint, conffile):
-    """ Create a symlink for a file from /home/$USER/conffile to
-    mountpoint/conffile """
-    destfile = os.path.basename(conffile)
-    if not destfile.startswith('.'):
-        destfile = '.' + destfile
+def _copy_tree(src, dst, title, message):
+    """ Copy a directory tree while showing its progress """
+    progress = ProgressWindow(title, message)
     try:
-        syslog.syslog(syslog.LOG_DEBUG, "Configuration file %s" % conffile)
-        if not os.path.exists(os.path.join(mountpoint, destfile)):
-            os.mknod(os.path.join(mountpoint, destfile))
-        if not os.path.exists(os.path.join(os.environ["HOME"], os.path.dirname(conffile))):
-            os.makedirs(os.path.join(os.environ["HOME"], os.path.dirname(conffile)))
-        if os.path.lexists(os.path.join(os.environ["HOME"], conffile)):
-            if os.path.exists(os.path.join(os.environ["HOME"], conffile + ".old")):
-                i = 2
-                while os.path.exists(os.path.join(os.environ["HOME"], conffile + ".old-" + str(i))):
-                    i = i+1
-                os.rename(os.path.join(os.environ["HOME"], conffile + ".old"),
-                          os.path.join % (os.environ["HOME"], conffile + ".old-" + str(i)))
-            os.rename(os.path.join(os.environ["HOME"], conffile),
-                      os.path.join(os.environ["HOME"], conffile + ".old"))
-        os.symlink(os.path.join(mountpoint, destfile), os.path.join(os.environ["HOME"], conffile))
-    except:
-        show_error(variables=vars())
-        return False
-
-def _unlink_conffile(mountpoint, conffile):
-    """ Remove a symlink to a configuration file from /home/$USER """
-    syslog.syslog(syslog.LOG_DEBUG, "Configuration file %s" % conffile)
-    try:
-        if os.path.islink(os.path.join(os.environ["HOME"], conffile)):
-            os.remove(os.path.join(os.environ["HOME"], conffile))
-        if os.path.exists(os.path.join(os.environ["HOME"], conffile + ".old")):
-            os.rename(os.path.join(os.environ["HOME"], conffile + ".old"),
-                      os.path.join(os.environ["HOME"], conffile))
-    except:
-        show_error(variables=vars())
-        return False
-
-def _load_gconf(mountpoint, gconfkey):
-    try:
-        if os.path.exists("%s/.%s-backup.xml.dump" % (mountpoint, gconfkey.rsplit('/', 1)[1])):
-            syslog.syslog(syslog.LOG_DEBUG, "GConf key %s" % gconfkey)
-            subprocess.run(["/usr/bin/gconftool-2", "--load",
-                             "%s/.%s-backup.xml.dump" % (mountpoint, gconfkey.rsplit('/', 1)[1])])
-    except:
-        show_error(variables=vars())
-        return False
-
-def _save_gconf(mountpoint, gconfkey):
-    try:
-        dumpfile = open("%s/.%s-backup.xml.dump" % (mountpoint, gconfkey.rsplit('/', 1)[1]), 'w')
-        syslog.syslog(syslog.LOG_DEBUG, "GConf key %s" % gconfkey)
-        subprocess.run(["/usr/bin/gconftool-2", "--dump", "%s" % gconfkey], stdout=dumpfile)
-        dumpfile.close()
-    except:
-        show_error(variables=vars())
-        return False
-
-def _load_dconf(mountpoint, dconfkey):
-    dconfkey = dconfkey.rstrip('/')
-    try:
-        if os.path.exists("%s/.%s-backup.txt.dump" % (mountpoint, dconfkey.rsplit('/', 1)[1])):
-            syslog.syslog(syslog.LOG_DEBUG, "DConf key %s" % dconfkey)
-            subprocess.run(["/usr/bin/dconf", "load", "%s/" % dconfkey],
-                            stdin=open("%s/.%s-backup.txt.dump" % \
-                            (mountpoint, dconfkey.rsplit('/', 1)[1]), 'r'))
-    except:
-        show_error(variables=vars())
-        return False
-
-def _save_dconf(mountpoint, dconfkey):
-    dconfkey = dconfkey.rstrip('/')
-    try:
-        dumpfile = open("%s/.%s-backup.txt.dump" % (mountpoint, dconfkey.rsplit('/', 1)[1]), 'w')
-        syslog.syslog(syslog.LOG_DEBUG, "DConf key %s" % dconfkey)
-        subprocess.run(["/usr/bin/dconf", "dump", "%s/" % dconfkey], stdout=dumpfile)
-        dumpfile.close()
-    except:
-        show_error(variables=vars())
-        return False
+        with extvoltrace.span("copy %s" % src, "migration", target=dst) as s:
+            s.args["resumed"] = extvolcopy.copy_tree(src, dst, progress.set_fraction)
+    finally:
+        progress.close()
 
 def _migrate_confdir(mountpoint, oldpath, newpath):
+    manifest = extvolmanifest.get(mountpoint)
+    if newpath in manifest.migrations:
+        return
     try:
-        if os.path.exists(os.path.join(mountpoint, oldpath)):
-            if not os.path.exists(os.path.join(mountpoint, newpath)):
+        if _volume_has(mountpoint, oldpath):
+            if not _volume_has(mountpoint, newpath):
                 syslog.syslog(syslog.LOG_DEBUG,
                               "Migrating old directory %s to new directory %s" % (oldpath, newpath))
-                shutil.copytree(os.path.join(mountpoint, oldpath), os.path.join(mountpoint, newpath))
+                _copy_tree(os.path.join(mountpoint, oldpath), os.path.join(mountpoint, newpath),
+                           _("Migrating settings"),
+                           _("Copying %(old)s to %(new)s, please wait...") % \
+                           {"old": oldpath, "new": newpath})
+        # Once opened, newpath is on the volume, so nothing is left to migrate
+        manifest.migrated(newpath)
     except:
+        show_error(_("Could not migrate %(old)s to %(new)s") % {"old": oldpath, "new": newpath})
         return False
 
 def _open_gnupg(mountpoint):
-    _link_confdir(mountpoint, ".gnupg")
-    _load_dconf(mountpoint, "/apps/seahorse")
     try:
-        if os.path.exists(os.path.join(mountpoint, ".gnupg")):
+        if _volume_has(mountpoint, ".gnupg"):
             syslog.syslog(syslog.LOG_DEBUG, "Setting permissions on .gnupg")
             _chmod_R(0o0700, os.path.join(mountpoint, ".gnupg"))
-        if not os.path.exists(os.path.join(mountpoint, ".gnupg", "gnupg-scripts.conf")):
+        if not _volume_has(mountpoint, ".gnupg/gnupg-scripts.conf"):
             syslog.syslog(syslog.LOG_DEBUG, "Creating gnupg-scripts default configuration")
-            subprocess.run(["/usr/bin/gpg-config", "--default"])
-        if not os.path.exists(os.path.join(mountpoint, ".gnupg", "gpg-agent.conf")):
+            # Not limited: killed halfway it would leave a partial configuration
+            extvolrun.run(["/usr/bin/gpg-config", "--default"], timeout=None)
+        if not _volume_has(mountpoint, ".gnupg/gpg-agent.conf"):
             syslog.syslog(syslog.LOG_DEBUG, "Copying default gpg-agent.conf")
             shutil.copy("/etc/skel/.gnupg/gpg-agent.conf", os.path.join(mountpoint, ".gnupg"))
     except:
         show_error(variables=vars())
         return False
 
-def _close_gnupg(mountpoint):
-    _save_dconf(mountpoint, "/apps/seahorse")
-    _unlink_confdir(mountpoint, ".gnupg")
+def _reload_gpg_agent(mountpoint):
     try:
         syslog.syslog(syslog.LOG_DEBUG, "Reloading the gpg-agent")
-        subprocess.run(["/usr/bin/pkill", "-HUP", "gpg-agent"])
+        extvolrun.run(["/usr/bin/pkill", "-HUP", "gpg-agent"])
     except:
         show_error(variables=vars())
         return False
 
 def _really_kill_evolution():
-    evoprocs = subprocess.run(["find", "/usr/lib/evolution", "-type", "f", "-and",
-                                 "-executable", "-exec", "basename", "{}", ";"],
-                                stdout=subprocess.PIPE, 
-                                universal_newlines=True).stdout
-    evoprocs = evoprocs.replace('\n', ',') + 'evolution'
-    evopids = subprocess.run(["ps", "-C", evoprocs, "-o", "pid", "--no-headers"],
-                               stdout=subprocess.PIPE,
-                               universal_newlines=True).stdout
-    if len(evopids) == 0:
-        return True
-    evopids = evopids.strip().split('\n')
-    for pid in evopids:
-        subprocess.run(["kill", pid])
-        subprocess.run(["kill", "-9", pid])
-    evopids = subprocess.run(["ps", "-C", evoprocs, "-o", "pid", "--no-headers"],
-                               stdout=subprocess.PIPE,
-                               universal_newlines=True).stdout
-    if len(evopids) > 0:
-        return False
-    else:
-        return True
+    """ Stop all evolution processes, return False if some survived """
+    evoprocs = extvolprocs.find(extvolprocs.evolution_binaries())
+    return not extvolprocs.terminate(p.pid for p in evoprocs)
 
-def _open_evolution(mountpoint):
-    syslog.syslog(syslog.LOG_DEBUG, "Shutting down evolution")
-    subprocess.run(["/usr/bin/evolution", "--force-shutdown"],
-                    stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
-    if not _really_kill_evolution():
-        show_error(_("Failed to stop evolution, will skip loading evolution data "
-                     "from the extended container!"))
-    else:
-        _link_confdir(mountpoint, ".local/share/evolution")
-        _link_confdir(mountpoint, ".config/evolution")
-        _link_confdir(mountpoint, ".cache/evolution")
-        _load_gconf(mountpoint, "/apps/evolution")
+def _kill_hamster(mountpoint):
+    syslog.syslog(syslog.LOG_DEBUG, "Stopping hamster applet")
+    hamster = extvolprocs.find(["hamster-service"])
+    return not extvolprocs.terminate(p.pid for p in hamster)
+
+def _spawn_hamster(mountpoint):
+    syslog.syslog(syslog.LOG_DEBUG, "Spawning the mighty hamster...")
+    extvolrun.spawn(["/usr/lib/hamster-applet/hamster-service"])
 
-def _close_evolution(mountpoint):
+def _stop_evolution(mountpoint):
     syslog.syslog(syslog.LOG_DEBUG, "Shutting down evolution")
-    subprocess.run(["/usr/bin/evolution", "--force-shutdown"],
-                    stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
-    _really_kill_evolution()
-    _save_gconf(mountpoint, "/apps/evolution")
-    _unlink_confdir(mountpoint, ".local/share/evolution")
-    _unlink_confdir(mountpoint, ".config/evolution")
-    _unlink_confdir(mountpoint, ".cache/evolution")
+    extvolrun.run(["/usr/bin/evolution", "--force-shutdown"], timeout=30,
+                  stdout=extvolrun.DEVNULL, stderr=extvolrun.STDOUT)
+    return _really_kill_evolution()
+
+def _migrate_hamster(mountpoint):
+    return _migrate_confdir(mountpoint, ".gnome2/hamster-applet", ".local/share/hamster-applet")
 
 def _open_hamster(mountpoint):
-    syslog.syslog(syslog.LOG_DEBUG, "Spawning the mighty hamster...")
-    proclist = "hamster-service"
-    pids = subprocess.run(["/bin/ps", "--no-headers", "-o", "pid", "-C", proclist],
-                          stdout=subprocess.PIPE, universal_newlines=True).stdout
-    for pid in pids.split():
-        try:
-            subprocess.run(["kill", pid])
-            subprocess.run(["kill", "-9", pid])
-        except:
-            pass
-    _migrate_confdir(mountpoint, ".gnome2/hamster-applet", ".local/share/hamster-applet")
-    _link_confdir(mountpoint, ".local/share/hamster-applet")
-    _load_gconf(mountpoint, "/apps/hamster-applet")
-    subprocess.Popen(["/usr/lib/hamster-applet/hamster-service"])
-    extlist = subprocess.run(["gsettings", "get", "org.gnome.shell", "enabled-extensions"],
-                             stdout=subprocess.PIPE, 
-                             universal_newlines=True).stdout.strip('[]\n').split(', ')
-    if "'hamster@projecthamster.wordpress.com'" not in extlist:
-        extlist.append("'hamster@projecthamster.wordpress.com'")
-        subprocess.run(["gsettings", "set", "org.gnome.shell", "enabled-extensions",
-                         "[" + ', '.join(extlist) + "]"])
+    extvolsettings.strv_add("org.gnome.shell", "enabled-extensions",
+                            "hamster@projecthamster.wordpress.com")
 
 def _close_hamster(mountpoint):
-    syslog.syslog(syslog.LOG_DEBUG, "Stopping hamster applet")
-    _save_gconf(mountpoint, "/apps/hamster-applet")
-    _unlink_confdir(mountpoint, ".local/share/hamster-applet")
-    proclist = "hamster-service"
-    pids = subprocess.run(["/bin/ps", "--no-headers", "-o", "pid", "-C", proclist],
-                          stdout=subprocess.PIPE, universal_newlines=True).stdout
-    for pid in pids.split():
-        try:
-            subprocess.run(["kill", pid])
-            subprocess.run(["kill", "-9", pid])
-        except:
-            pass
-    extlist = subprocess.run(["gsettings", "get", "org.gnome.shell", "enabled-extensions"],
-                               stdout=subprocess.PIPE,
-                               universal_newlines=True).stdout.strip('[]\n').split(', ')
-    if "'hamster@projecthamster.wordpress.com'" in extlist:
-        extlist = [x for x in extlist if x != "'hamster@projecthamster.wordpress.com'"]
-        subprocess.run(["gsettings", "set", "org.gnome.shell", "enabled-extensions",
-                         "[" + ', '.join(extlist) + "]"])
-
-def _open_keepass(mountpoint):
-    _link_confdir(mountpoint, ".config/KeePass")
-
-def _close_keepass(mountpoint):
-    _unlink_confdir(mountpoint, ".config/KeePass")
-
-def _open_libreoffice(mountpoint):
-    _migrate_confdir(mountpoint, ".openoffice.org", ".config/libreoffice")
-    _link_confdir(mountpoint, ".config/libreoffice")
-    _link_conffile(mountpoint, ".odbc.ini")
-
-def _close_libreoffice(mountpoint):
-    _unlink_confdir(mountpoint, ".config/libreoffice")
-    _unlink_conffile(mountpoint, ".odbc.ini")
-
-def _open_scribus(mountpoint):
-    _link_confdir(mountpoint, ".scribus")
-
-def _close_scribus(mountpoint):
-    _unlink_confdir(mountpoint, ".scribus")
-
-def _open_kmymoney(mountpoint):
-    _link_conffile(mountpoint, ".kde/share/config/kmymoneyrc")
-
-def _close_kmymoney(mountpoint):
-    _unlink_conffile(mountpoint, ".kde/share/config/kmymoneyrc")
-
-def _open_planner(mountpoint):
-    _load_gconf(mountpoint, "/apps/planner")
-
-def _close_planner(mountpoint):
-    _save_gconf(mountpoint, "/apps/planner")
-
-def _open_desktop(mountpoint):
-    _load_dconf(mountpoint, "/org/gnome/settings-daemon/plugins/power")
-    _load_dconf(mountpoint, "/org/gnome/desktop/session")
-    _load_gconf(mountpoint, "/desktop/gnome/keybindings")
-    _load_dconf(mountpoint, "/org/gnome/desktop/peripherals")
-    _migrate_confdir(mountpoint, ".fonts", ".local/share/fonts")
-    _link_confdir(mountpoint, ".local/share/fonts")
-    _link_conffile(mountpoint, ".gtk-bookmarks")
-    _link_conffile(mountpoint, ".lockpasswd")
-    _load_dconf(mountpoint, "/org/gnome/desktop/background")
-    _load_dconf(mountpoint, "/org/gnome/nemo")
-    _load_dconf(mountpoint, "/org/gnome/libgnomekbd")
+    extvolsettings.strv_remove("org.gnome.shell", "enabled-extensions",
+                               "hamster@projecthamster.wordpress.com")
+
+def _migrate_libreoffice(mountpoint):
+    return _migrate_confdir(mountpoint, ".openoffice.org", ".config/libreoffice")
+
+def _migrate_fonts(mountpoint):
+    return _migrate_confdir(mountpoint, ".fonts", ".local/share/fonts")
 
 def _close_desktop(mountpoint):
-    _save_dconf(mountpoint, "/org/gnome/settings-daemon/plugins/power")
-    _save_dconf(mountpoint, "/org/gnome/desktop/session")
-    _save_gconf(mountpoint, "/desktop/gnome/keybindings")
-    _save_dconf(mountpoint, "/org/gnome/desktop/peripherals")
-    _unlink_confdir(mountpoint, ".local/share/fonts")
-    _unlink_conffile(mountpoint, ".gtk-bookmarks")
-    _unlink_conffile(mountpoint, ".lockpasswd")
-    _save_dconf(mountpoint, "/org/gnome/desktop/background")
-    _save_dconf(mountpoint, "/org/gnome/nemo")
-    _save_dconf(mountpoint, "/org/gnome/libgnomekbd")
-    subprocess.run(["/usr/bin/dconf", "reset", "-f", "/org/gnome/desktop/background/"])
+    extvolsettings.reset_dconf("/org/gnome/desktop/background")
 
 def _load_printers(mountpoint):
-    if os.path.exists("%s/.cups/printers" % mountpoint):
-        try:
-            pconf = open("%s/.cups/printers" % mountpoint, 'r')
-            printers = pickle.load(pconf)
-            pconf.close()
-            cupsc = cups.Connection()
-            for printer in printers.keys():
-                cupsc.addPrinter(name=printer, filename="%s/.cups/%s.ppd" % (mountpoint, printer),
-                                 device=printers[printer]['device-uri'],
-                                 info=printers[printer]['printer-info'],
-                                 location=printers[printer]['printer-location'])
-                cupsc.enablePrinter(printer)
-                cupsc.acceptJobs(printer)
-            defp = open("%s/.cups/default-printer" % mountpoint, 'r')
-            cupsc.setDefault(defp.readline().strip())
-            defp.close()
-        except:
-            pass
+    try:
+        extvolprinters.load(mountpoint)
+    except:
+        syslog.syslog(syslog.LOG_DEBUG, "Restoring printers failed: %s" % \
+                      traceback.format_exc())
 
 def _save_printers(mountpoint):
     try:
-        if not os.path.exists("%s/.cups" % mountpoint):
-            os.mkdir("%s/.cups" % mountpoint)
-        pconf = open("%s/.cups/printers" % mountpoint, 'w')
-        cupsc = cups.Connection()
-        printers = cupsc.getPrinters()
-        pickle.dump(printers, pconf)
-        pconf.close()
-        defp = open("%s/.cups/default-printer" % mountpoint, 'w')
-        defp.write(cupsc.getDefault())
-        defp.close()
-        for printer in printers.keys():
-            ppd = os.readlink(cupsc.getPPD(printer))
-            shutil.copy(ppd, "%s/.cups/%s.ppd" % (mountpoint, printer))
+        extvolprinters.save(mountpoint)
     except:
-        pass
+        syslog.syslog(syslog.LOG_DEBUG, "Saving printers failed: %s" % \
+                      traceback.format_exc())
+
+def _has_vboxapi(mountpoint):
+    return extvollazy.available("vboxapi")
 
 def _open_vbox(mountpoint):
-    if "vboxapi" not in sys.modules:
-        return True
-    _link_confdir(mountpoint, ".VirtualBox")
-    _link_confdir(mountpoint, "VirtualBox VMs")
-    _link_conffile(mountpoint, ".vbox-starter.conf")
-    mgr = VirtualBoxManager(None, None)
-    vbox = mgr.vbox
-    vmx = mgr.getArray(vbox, 'machines')
+    # Reading the registry does not start VBoxSVC, only ask it if there is
+    # no registry to read
+    with extvoltrace.span("find virtual machines", "vbox") as s:
+        vmx = extvolvbox.machines(mountpoint)
+        if vmx is None and _volume_has(mountpoint, "VirtualBox VMs"):
+            s.args["api"] = True
+            vmx = extvolvbox.api_machines()
+        vmx = vmx or []
+        s.args["machines"] = len(vmx)
     if len(vmx) > 0:
         if len(vmx) > 1:
             show_error(_("Multiple virtual machines were found on %s, don't know "
                          "which one to start. Please start it manually.") % mountpoint)
         else:
-            vm = vmx[0].name
+            vm = vmx[0][0]
             if ask_user(_("Start Virtual Machine?"),
                         _("A virtual machine named \n%s\n was found. Do you want "
                           "to start it?") % vm):
                 try:
-                    subprocess.Popen(["/usr/bin/vbox-starter.sh", vm])
+                    extvolrun.spawn(["/usr/bin/vbox-starter.sh", vm])
                 except:
                     show_error(_("An error occured trying to start the virtual "
                                  "machine:\n%s") % sys.exc_info())
 
-def _close_vbox(mountpoint):
-    if "vboxapi" not in sys.modules:
-        return True
-    subprocess.run(["pkill", "VBoxSVC"])
-    _unlink_confdir(mountpoint, ".VirtualBox")
-    _unlink_confdir(mountpoint, "VirtualBox VMs")
-    _unlink_conffile(mountpoint, ".vbox-starter.conf")
+def _stop_vboxsvc(mountpoint):
+    extvolrun.run(["pkill", "VBoxSVC"])
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.digest()
+
+def _changed_files(src, dst, skip=lambda name: False):
+    """ Return the names of the regular files directly in src which differ
+        from their copy in dst. Files with equal size and modification time
+        are taken as equal, files with equal size but another modification
+        time are compared by content (and get their time synced if equal). """
+    changed = []
+    for entry in os.scandir(src):
+        if skip(entry.name) or not entry.is_file(follow_symlinks=False):
+            continue
+        target = os.path.join(dst, entry.name)
+        st = entry.stat(follow_symlinks=False)
+        try:
+            tst = os.stat(target)
+        except FileNotFoundError:
+            tst = None
+        if tst is not None and tst.st_size == st.st_size:
+            if tst.st_mtime_ns == st.st_mtime_ns:
+                continue
+            if _file_digest(entry.path) == _file_digest(target):
+                os.utime(target, ns=(st.st_atime_ns, st.st_mtime_ns))
+                continue
+        changed.append(entry.name)
+    return changed
+
+def _sync_files(src, dst, names):
+    """ Copy the given files from src to dst """
+    for name in names:
+        shutil.copy2(os.path.join(src, name), os.path.join(dst, name))
+    return names
+
+def _pulse_runtime(name):
+    return name.endswith("runtime")
+
+def _pulse_changed(mountpoint, opening):
+    """ The daemon only needs to be stopped when opening would give it other
+        state, or closing has to copy state it may be writing """
+    volpulse = "%s/.config/pulse" % mountpoint
+    homepulse = "%s/.config/pulse" % os.environ["HOME"]
+    src, dst = (volpulse, homepulse) if opening else (homepulse, volpulse)
+    if not os.path.isdir(src):
+        return False
+    return bool(_changed_files(src, dst, _pulse_runtime))
+
+def _stop_pulseaudio(mountpoint):
+    extvolrun.run(["pulseaudio", "--kill"])
+
+def _start_pulseaudio(mountpoint):
+    extvolrun.run(["pulseaudio", "--start"])
 
 def _open_pulseaudio(mountpoint):
-    if not os.path.exists("%s/.config/pulse" % mountpoint):
-        os.makedirs("%s/.config/pulse" % mountpoint)
-    else:
-        subprocess.run(["pulseaudio", "--kill"])
-        for f in glob.glob("%s/.config/pulse/*runtime" % mountpoint):
-            try:
-                os.remove(f)
-            except:
-                pass
-        for f in glob.glob("%s/.config/pulse/*" % mountpoint):
-            shutil.copy2(f, "%s/.config/pulse" % os.environ["HOME"])
-        subprocess.run(["pulseaudio", "--start"])
+    volpulse = "%s/.config/pulse" % mountpoint
+    homepulse = "%s/.config/pulse" % os.environ["HOME"]
+    if not os.path.exists(volpulse):
+        os.makedirs(volpulse)
+        return
+    for f in glob.glob("%s/*runtime" % volpulse):
+        try:
+            os.remove(f)
+        except:
+            pass
+    os.makedirs(homepulse, exist_ok=True)
+    changed = _changed_files(volpulse, homepulse, _pulse_runtime)
+    if not changed:
+        syslog.syslog(syslog.LOG_DEBUG, "PulseAudio state is up to date")
+        return
+    syslog.syslog(syslog.LOG_DEBUG, "Restoring PulseAudio state: %s" % ", ".join(changed))
+    _sync_files(volpulse, homepulse, changed)
 
 def _close_pulseaudio(mountpoint):
-    subprocess.run(["pulseaudio", "--kill"])
-    files = glob.glob("%s/.config/pulse/*" % os.environ["HOME"])
-    ffiles = [k for k in files if not k.endswith("runtime")]
-    for f in ffiles:
-        shutil.copy2(f, "%s/.config/pulse/" % mountpoint)
-    subprocess.run(["pulseaudio", "--start"])
+    # If anything changed, the daemon is stopped meanwhile, so the databases
+    # are not copied halfway through a write
+    homepulse = "%s/.config/pulse" % os.environ["HOME"]
+    volpulse = "%s/.config/pulse" % mountpoint
+    if not os.path.isdir(homepulse):
+        return
+    os.makedirs(volpulse, exist_ok=True)
+    copied = _sync_files(homepulse, volpulse,
+                         _changed_files(homepulse, volpulse, _pulse_runtime))
+    syslog.syslog(syslog.LOG_DEBUG, "Saved PulseAudio state: %s" % (", ".join(copied) or "unchanged"))
 
 def _open_gimp(mountpoint):
-    _link_confdir(mountpoint, ".gimp-2.8")
-    if not os.path.exists("%s/.gimp-2.8/sessionrc" % mountpoint):
+    if not _volume_has(mountpoint, ".gimp-2.8/sessionrc"):
         if os.path.exists("/etc/skel/.gimp-2.8/sessionrc"):
             shutil.copy2("/etc/skel/.gimp-2.8/sessionrc", "%s/.gimp-2.8/" % mountpoint)
 
-def _close_gimp(mountpoint):
-    _unlink_confdir(mountpoint, ".gimp-2.8")
-
-def _open_inkscape(mountpoint):
-    _link_confdir(mountpoint, ".config/inkscape")
-
-def _close_inkscape(mountpoint):
-    _unlink_confdir(mountpoint, ".config/inkscape")
+def _stop_tracker(mountpoint):
+    # Stopping the miners can take longer than the default timeout
+    extvolrun.run(["tracker", "daemon", "-k", "all"], stdout=extvolrun.DEVNULL, timeout=None)
+    #extvolrun.spawn(["/usr/bin/gnome-shell", "--replace"])
 
-def _open_gthumb(mountpoint):
-    _link_confdir(mountpoint, ".config/gthumb")
-    _load_gconf(mountpoint, "/apps/gthumb")
+def _start_tracker(mountpoint):
+    extvolrun.run(["tracker", "daemon", "-s"], stdout=extvolrun.DEVNULL)
 
-def _close_gthumb(mountpoint):
-    _unlink_confdir(mountpoint, ".config/gthumb")
-    _save_gconf(mountpoint, "/apps/gthumb")
-
-def _open_grsync(mountpoint):
-    _link_confdir(mountpoint, ".grsync")
+def _open_tracker(mountpoint):
+    extvolsettings.strv_add("org.freedesktop.Tracker.Miner.Files",
+                            "index-recursive-directories", mountpoint)
 
-def _close_grsync(mountpoint):
-    _unlink_confdir(mountpoint, ".grsync")
+def _restart_gconfd(mountpoint):
+    # D-Bus starts it again on demand, with the settings as they are now
+    extvolrun.run(["/usr/bin/killall", "gconfd-2"])
 
-def _open_tracker(mountpoint):
-    subprocess.run(["tracker", "daemon", "-k", "all"], stdout=open(os.devnull, 'w'))
-    _link_confdir(mountpoint, ".cache/tracker")
-    _link_confdir(mountpoint, ".config/tracker")
-    _link_confdir(mountpoint, ".local/share/tracker")
-    _load_dconf(mountpoint, "/org/freedesktop/tracker")
-    p = subprocess.run(["gsettings", "get", "org.freedesktop.Tracker.Miner.Files",
-                        "index-recursive-directories"],
-                       stdout=subprocess.PIPE, universal_newlines=True)
-    locs = p.stdout.strip('[]\n').split(', ')
-    mp = "'%s'" % mountpoint
-    if not mp in locs:
-        locs.append(mp)
-        subprocess.run(["gsettings", "set", "org.freedesktop.Tracker.Miner.Files",
-                        "index-recursive-directories", "[%s]" % ', '.join(locs)])
-    subprocess.run(["tracker", "daemon", "-s"], stdout=open(os.devnull, 'w'))
-
-def _close_tracker(mountpoint):
-    subprocess.run(["tracker", "daemon", "-k", "all"], stdout=open(os.devnull, 'w'))
-    #_double_fork(["/usr/bin/gnome-shell", "--replace"])
-    _unlink_confdir(mountpoint, ".cache/tracker")
-    _unlink_confdir(mountpoint, ".config/tracker")
-    _unlink_confdir(mountpoint, ".local/share/tracker")
-    _save_dconf(mountpoint, "/org/freedesktop/tracker")
-    subprocess.run(["tracker", "daemon", "-s"], stdout=open(os.devnull, 'w'))
-
-def _open_thunderbird(mountpoint):
-    if not os.path.exists(os.path.join(mountpoint, ".thunderbird")):
+def _seed_thunderbird(mountpoint):
+    if not _volume_has(mountpoint, ".thunderbird"):
         if os.path.exists("/etc/skel/.thunderbird"):
-            shutil.copytree("/etc/skel/.thunderbird", 
-                            os.path.join(mountpoint, ".thunderbird"))
-    _link_confdir(mountpoint, ".thunderbird")
-
-def _close_thunderbird(mountpoint):
-    _unlink_confdir(mountpoint, ".thunderbird")
+            _copy_tree("/etc/skel/.thunderbird", os.path.join(mountpoint, ".thunderbird"),
+                       _("Setting up Thunderbird"),
+                       _("Creating the Thunderbird profile, please wait..."))
 
 def _open_backintime(mountpoint):
-    _link_confdir(mountpoint, ".config/backintime")
-    _link_confdir(mountpoint, ".local/share/backintime")
     try:
-        if not os.path.exists(os.path.join(mountpoint, ".config/backintime", "config")):
+        if not _volume_has(mountpoint, ".config/backintime/config"):
             if ask_user(_("Setup backup"),
                         _("You have not yet configured a backup for this "
                           "volume yet. I can create a default configuration "
@@ -657,35 +544,44 @@ def _open_backintime(mountpoint):
     backupdir = os.path.join("/media", os.environ['USER'], "backup")
     try:
         if not os.path.isdir(backupdir):
-            subprocess.run(["sudo", "mkdir", "-m", "777", backupdir])
-        subprocess.run(["/usr/bin/backintime", "--quiet", "check-config"], check=True)
+            extvolrun.run(["sudo", "mkdir", "-m", "777", backupdir])
+        extvolrun.run(["/usr/bin/backintime", "--quiet", "check-config"],
+                      timeout=120, check=True)
     except:
         show_error(_("An error occured while checking the backup configuration."))
     if os.path.isdir(backupdir):
-        subprocess.run(["sudo", "rmdir", backupdir])
+        extvolrun.run(["sudo", "rmdir", backupdir])
 
 def _close_backintime(mountpoint):
+    # Runs after all other profiles, so the dumper saw every change made
+    # while closing, too
+    extvolrun.run(["/usr/bin/gconf-dumper.py", "-q", "-t", mountpoint])
+    state = extvolwatch.read_state(mountpoint)
+    extvolwatch.clear_state(mountpoint)
     backupdir = os.path.join("/media", os.environ['USER'], "backup")
-    if os.path.isdir(backupdir):
-        try:
-            subprocess.run(["/usr/bin/backintime", "backup"], check=True)
-        except:
-            show_error(_("An error occured while trying to run a (last) snapshot."))
-    _unlink_confdir(mountpoint, ".config/backintime")
-    _unlink_confdir(mountpoint, ".local/share/backintime")
-
-def _open_okular(mountpoint):
-    _link_conffile(mountpoint, ".kde/share/config/okularrc")
-    _link_conffile(mountpoint, ".kde/share/config/okularpartrc")
-    _link_confdir(mountpoint, ".kde/share/apps/okular")
-
-def _close_okular(mountpoint):
-    _unlink_conffile(mountpoint, ".kde/share/config/okularrc")
-    _unlink_conffile(mountpoint, ".kde/share/config/okularpartrc")
-    _unlink_confdir(mountpoint, ".kde/share/apps/okular")
+    if not os.path.isdir(backupdir):
+        extvolwatch.end_session(mountpoint, False)
+        return
+    if state is not None and state["snapshot_pid"]:
+        syslog.syslog(syslog.LOG_DEBUG, "Waiting for the background snapshot")
+        extvolprocs.wait([state["snapshot_pid"]])
+    if state is not None and not state["dirty"]:
+        syslog.syslog(syslog.LOG_DEBUG, "Nothing changed since the last snapshot")
+        extvolwatch.end_session(mountpoint, True)
+        return
+    try:
+        extvolrun.run(["/usr/bin/backintime", "backup"], timeout=None, check=True)
+    except:
+        extvolwatch.end_session(mountpoint, False)
+        show_error(_("An error occured while trying to run a (last) snapshot."))
+    else:
+        extvolwatch.end_session(mountpoint, True)
 
 def _check_new_version(mountpoint):
-    if os.path.exists("%s/.gnupg" % mountpoint) and not os.path.exists("%s/.thunderbird" % mountpoint):
+    manifest = extvolmanifest.get(mountpoint)
+    if manifest.fresh and manifest.layout == extvolmanifest.LAYOUT:
+        return True
+    if _volume_has(mountpoint, ".gnupg") and not _volume_has(mountpoint, ".thunderbird"):
         warnstring = _("You seem to be opening an extended container "\
             "previously created with Ubuntu Privacy Remix. "\
             "Please be aware of the following:\n"
@@ -709,18 +605,477 @@ def _check_new_version(mountpoint):
     else:
         return True
 
+class AppProfile(object):
+    """ Describes how the settings of one application are moved to and from
+        an extended volume.
+
+        after/before name the profiles this one has to be opened after or
+        before. Closing runs in the reverse order, unless close_after is
+        given, in which case the profile is closed after the named profiles
+        ("*" meaning all others).
+
+        dconf and gconf list the settings keys which are loaded from the
+        volume before the profile is opened and saved to it before the
+        profile is closed.
+
+        A pinned profile does work for its own volume when it is closed, so
+        it is never taken over by another volume while that one is open.
+
+        confdirs and conffiles list the paths in $HOME which are replaced by
+        symlinks into the volume while it is open, see extvollinks. Opening
+        runs prelink, links, then open_func; closing runs close_func,
+        unlinks, then unlinked. If prelink or close_func returns False, the
+        links of the profile are left alone.
+
+        services names the entries of SERVICES the profile needs stopped
+        while it is opened or closed. Profiles with gconf keys use gconfd
+        implicitly. If a service cannot be stopped when opening, the
+        profile is skipped.
+
+        data lists further paths on the volume, besides the confdirs,
+        conffiles and dumps, which show that a volume holds the profile.
+        When several volumes are open, each profile is held by one of them,
+        see extvolstate.
+    """
+    def __init__(self, name, open_func=None, close_func=None, after=(), before=(),
+                 close_after=None, dconf=(), gconf=(), confdirs=(), conffiles=(),
+                 prelink=None, unlinked=None, services=(), data=(), pinned=False):
+        self.name = name
+        self.open_func = open_func
+        self.close_func = close_func
+        self.prelink = prelink
+        self.unlinked = unlinked
+        self.confdirs = tuple(confdirs)
+        self.conffiles = tuple(conffiles)
+        self.after = tuple(after)
+        self.before = tuple(before)
+        self.close_after = close_after
+        self.dconf = tuple(dconf)
+        self.gconf = tuple(gconf)
+        self.services = tuple(services) + (("gconfd",) if self.gconf else ())
+        self.data = tuple(data)
+        self.pinned = pinned
+
+    def __repr__(self):
+        return "<AppProfile %s>" % self.name
+
+class Service(object):
+    """ A session daemon which is stopped before the profiles using it are
+        opened or closed, and started again after all of them finished,
+        however many of them use it.
+
+        on_open and on_close list the phases, "stop" and/or "start", the
+        service takes part in when opening and closing. If needed is given,
+        it is asked once per transition, with the mountpoint and whether the
+        volume is being opened, whether the daemon has to be bounced at all.
+        stop returns False if the daemon is still running; when opening,
+        stop_error is shown then. stop and start get the mountpoint.
+    """
+    def __init__(self, name, stop=None, start=None, on_open=(), on_close=(),
+                 needed=None, stop_error=None):
+        self.name = name
+        self.stop = stop
+        self.start = start
+        self.on_open = tuple(on_open)
+        self.on_close = tuple(on_close)
+        self.needed = needed
+        self.stop_error = stop_error
+
+    def phases(self, opening):
+        return self.on_open if opening else self.on_close
+
+    def __repr__(self):
+        return "<Service %s>" % self.name
+
+SERVICES = dict((s.name, s) for s in (
+    Service("evolution", _stop_evolution, on_open=("stop",), on_close=("stop",),
+            stop_error=_("Failed to stop evolution, will skip loading evolution data "
+                         "from the extended container!")),
+    Service("hamster", _kill_hamster, _spawn_hamster,
+            on_open=("stop", "start"), on_close=("stop",)),
+    Service("pulseaudio", _stop_pulseaudio, _start_pulseaudio,
+            on_open=("stop", "start"), on_close=("stop", "start"), needed=_pulse_changed),
+    Service("tracker", _stop_tracker, _start_tracker,
+            on_open=("stop", "start"), on_close=("stop", "start")),
+    Service("vboxsvc", _stop_vboxsvc, on_close=("stop",),
+            needed=lambda mountpoint, opening: _has_vboxapi(mountpoint)),
+    Service("gpg-agent", start=_reload_gpg_agent, on_close=("start",)),
+    Service("gconfd", start=_restart_gconfd, on_close=("start",)),
+    ))
+
+PROFILES = (
+    AppProfile("gnupg", _open_gnupg, before=("evolution",), services=("gpg-agent",),
+               confdirs=(".gnupg",), dconf=("/apps/seahorse",)),
+    AppProfile("evolution", services=("evolution",),
+               confdirs=(".local/share/evolution", ".config/evolution", ".cache/evolution"),
+               gconf=("/apps/evolution",)),
+    AppProfile("hamster", _open_hamster, _close_hamster, prelink=_migrate_hamster,
+               services=("hamster",),
+               confdirs=(".local/share/hamster-applet",), gconf=("/apps/hamster-applet",)),
+    AppProfile("keepass", confdirs=(".config/KeePass",)),
+    AppProfile("libreoffice", prelink=_migrate_libreoffice,
+               confdirs=(".config/libreoffice",), conffiles=(".odbc.ini",)),
+    AppProfile("scribus", confdirs=(".scribus",)),
+    AppProfile("gimp", _open_gimp, confdirs=(".gimp-2.8",)),
+    AppProfile("inkscape", confdirs=(".config/inkscape",)),
+    AppProfile("gthumb", confdirs=(".config/gthumb",), gconf=("/apps/gthumb",)),
+    AppProfile("planner", gconf=("/apps/planner",)),
+    AppProfile("desktop", close_func=_close_desktop, prelink=_migrate_fonts,
+               confdirs=(".local/share/fonts",),
+               conffiles=(".gtk-bookmarks", ".lockpasswd"),
+               dconf=("/org/gnome/settings-daemon/plugins/power",
+                      "/org/gnome/desktop/session",
+                      "/org/gnome/desktop/peripherals",
+                      "/org/gnome/desktop/background",
+                      "/org/gnome/nemo",
+                      "/org/gnome/libgnomekbd"),
+               gconf=("/desktop/gnome/keybindings",)),
+    AppProfile("printers", _load_printers, _save_printers, data=(".cups",)),
+    AppProfile("vbox", _open_vbox, _has_vboxapi, prelink=_has_vboxapi, services=("vboxsvc",),
+               confdirs=(".VirtualBox", "VirtualBox VMs"), conffiles=(".vbox-starter.conf",)),
+    AppProfile("pulseaudio", _open_pulseaudio, _close_pulseaudio, services=("pulseaudio",),
+               data=(".config/pulse",)),
+    AppProfile("grsync", confdirs=(".grsync",)),
+    AppProfile("kmymoney", conffiles=(".kde/share/config/kmymoneyrc",)),
+    AppProfile("thunderbird", prelink=_seed_thunderbird, confdirs=(".thunderbird",)),
+    AppProfile("tracker", _open_tracker, after=("desktop",), services=("tracker",),
+               confdirs=(".cache/tracker", ".config/tracker", ".local/share/tracker"),
+               dconf=("/org/freedesktop/tracker",)),
+    # Closing it stops the dumper of the volume and takes its last snapshot
+    AppProfile("backintime", _open_backintime, _close_backintime, close_after="*", pinned=True,
+               confdirs=(".config/backintime", ".local/share/backintime")),
+    AppProfile("okular", confdirs=(".kde/share/apps/okular",),
+               conffiles=(".kde/share/config/okularrc", ".kde/share/config/okularpartrc")),
+    )
+
+# Files below these paths on the volume may still be open when closing, their
+# owners are shut down while closing.
+OPEN_FILES_IGNORED = (".local/share/hamster-applet", ".local/share/evolution",
+                      ".config/tracker", ".cache/tracker", ".local/share/tracker",
+                      ".VirtualBox/VBoxSVC.log")
+
+# Upper bound for the number of profiles handled at the same time
+MAX_WORKERS = 6
+
+def _profile_dependencies(profiles, opening):
+    """ Return a dict mapping each profile name to the set of profile names
+        which have to be finished before it may run. """
+    names = set(p.name for p in profiles)
+    deps = dict((p.name, set()) for p in profiles)
+    for p in profiles:
+        for other in p.after:
+            if other in names:
+                deps[p.name].add(other)
+        for other in p.before:
+            if other in names:
+                deps[other].add(p.name)
+    if not opening:
+        reverse = dict((name, set()) for name in names)
+        for name, required in deps.items():
+            for other in required:
+                reverse[other].add(name)
+        deps = reverse
+        for p in profiles:
+            if p.close_after == "*":
+                deps[p.name] = names - set([p.name])
+                for other in deps[p.name]:
+                    deps[other].discard(p.name)
+            elif p.close_after is not None:
+                deps[p.name].update(n for n in p.close_after if n in names)
+    return deps
+
+def _run_profile(profile, mountpoint, opening, links, running=(), journal=None,
+                 failures=None):
+    """ Open or close a single profile, applying its part of the link plan
+        between the hooks, through the journal if one is given. When
+        opening, a profile using one of the running services, which could
+        not be stopped, is skipped. The name of a profile which failed, or
+        was closed without undoing its links, is added to failures.
+        Returns the time it took. """
+    if opening:
+        before, after = profile.prelink, profile.open_func
+    else:
+        before, after = profile.close_func, profile.unlinked
+    start = time.monotonic()
+    if before is None and after is None and not links.ops.get(profile.name):
+        return 0.0
+    action = "open" if opening else "close"
+    syslog.syslog(syslog.LOG_DEBUG, "%s profile %s" % (action, profile.name))
+    with extvoltrace.span("%s %s" % (action, profile.name), "profile") as s:
+        try:
+            if opening and set(profile.services) & set(running):
+                s.status = "skipped"
+                return time.monotonic() - start
+            if before is not None and before(mountpoint) is False:
+                s.status = "skipped"
+                if not opening and links.ops.get(profile.name) and failures is not None:
+                    failures.add(profile.name)
+                return time.monotonic() - start
+            if journal is not None:
+                failed = links.apply(profile.name, *journal.of(profile.name))
+            else:
+                failed = links.apply(profile.name)
+            if failed:
+                s.status = "failed"
+                show_error(_("Could not link the settings of %(profile)s:\n%(errors)s") % \
+                           {"profile": profile.name,
+                            "errors": "\n".join("%s: %s" % (" ".join(op), error)
+                                                for op, error in failed)})
+            if after is not None:
+                after(mountpoint)
+        except:
+            s.status = "error"
+            show_error(variables={"profile": profile.name, "mountpoint": mountpoint})
+        if s.status in ("failed", "error") and failures is not None:
+            failures.add(profile.name)
+    return time.monotonic() - start
+
+def _settings_batch(mountpoint, profiles):
+    """ Return a SettingsBatch covering the settings keys of all profiles,
+        which knows the dumps on the volume from its manifest """
+    dconf = [key for p in profiles for key in p.dconf]
+    gconf = [key for p in profiles for key in p.gconf]
+    return extvolsettings.SettingsBatch(
+        mountpoint, dconf=dconf, gconf=gconf,
+        exists=lambda path: _volume_has(mountpoint, os.path.relpath(path, mountpoint)))
+
+def _bounced_services(mountpoint, opening, profiles):
+    """ Return the services the profiles need bounced in this direction """
+    names = set(name for p in profiles for name in p.services)
+    services = []
+    for name in sorted(names):
+        service = SERVICES[name]
+        if not service.phases(opening):
+            continue
+        if service.needed is not None and not service.needed(mountpoint, opening):
+            continue
+        services.append(service)
+    return services
+
+def _run_service(service, phase, mountpoint):
+    """ Stop or start a service, return False if it failed """
+    func = service.stop if phase == "stop" else service.start
+    with extvoltrace.span("%s %s" % (phase, service.name), "service") as s:
+        try:
+            ok = func(mountpoint) is not False
+        except:
+            syslog.syslog(syslog.LOG_ERR, "Could not %s %s: %s" % \
+                          (phase, service.name, traceback.format_exc()))
+            ok = False
+        if not ok:
+            s.status = "failed"
+    return ok
+
+def _submit_services(pool, services, phase, mountpoint, opening):
+    """ Run one phase of all services at once, return a dict mapping the
+        futures to the services """
+    return dict((_submit(pool, _run_service, service, phase, mountpoint), service)
+                for service in services
+                if phase in service.phases(opening) and
+                (service.stop if phase == "stop" else service.start) is not None)
+
+def _run_profiles(mountpoint, opening, profiles=PROFILES, progress=None, journal=None,
+                  failures=None):
+    """ Open or close all profiles. The settings of all profiles are loaded
+        after opening and saved before closing in one batch, and the links
+        of all profiles are planned in one go. Profiles which don't depend
+        on each other run concurrently on a bounded pool of worker threads.
+        Each finished profile is reported to the given ProgressWindow.
+
+        The daemons the profiles need stopped are stopped together, before
+        the settings are loaded or saved, the links are planned and any
+        profile runs. The settings of profiles skipped because one of
+        their daemons could not be stopped are left alone.
+        They are started together as soon as the last profile using them
+        finished, so each is bounced at most once per transition.
+        The names of the profiles which failed are added to failures.
+        Returns a dict with the time each profile took. """
+    services = _bounced_services(mountpoint, opening, profiles)
+    users = set(p.name for p in profiles
+                if set(p.services) & set(s.name for s in services))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        stopping = _submit_services(pool, services, "stop", mountpoint, opening)
+        _wait(stopping)
+        still_running = set()
+        for future, service in stopping.items():
+            if not future.result():
+                still_running.add(service.name)
+                if opening and service.stop_error:
+                    show_error(service.stop_error)
+        try:
+            if opening:
+                _settings_batch(mountpoint, [p for p in profiles
+                                             if not set(p.services) & still_running]).load()
+            else:
+                _settings_batch(mountpoint, profiles).save()
+        except:
+            show_error(variables={"mountpoint": mountpoint})
+        # Daemons may create or replace entries in $HOME while they stop, so
+        # $HOME is only read once they did
+        with extvoltrace.span("plan links", "links") as s:
+            links = extvollinks.plan(mountpoint, profiles, opening)
+            links.save_index()
+            s.args["operations"] = sum(len(ops) for ops in links.ops.values())
+        deps = _profile_dependencies(profiles, opening)
+        byname = dict((p.name, p) for p in profiles)
+        done = set()
+        timings = {}
+        running = {}
+        starting = None
+        while len(done) < len(byname):
+            if starting is None and users <= done:
+                starting = _submit_services(pool, services, "start", mountpoint, opening)
+            for name in (p.name for p in profiles):
+                if name not in done and name not in running.values() and \
+                        deps[name] <= done:
+                    future = _submit(pool, _run_profile, byname[name], mountpoint, opening,
+                                         links, still_running, journal, failures)
+                    running[future] = name
+            if not running:
+                raise RuntimeError("Circular profile dependencies: %s" % \
+                                   ", ".join(sorted(set(byname) - done)))
+            finished, pending = _wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                timings[name] = future.result()
+                done.add(name)
+                if progress is not None:
+                    progress.step(len(done), len(byname), name)
+        if starting is None:
+            starting = _submit_services(pool, services, "start", mountpoint, opening)
+        _wait(starting)
+    syslog.syslog(syslog.LOG_DEBUG, "Profile timings: %s" % \
+                  ", ".join("%s %.2fs" % (n, t) for n, t in sorted(timings.items())))
+    return timings
+
+class _Writeback(object):
+    """ Writes the dirty data of a volume back while it is being closed:
+        once in the background, overlapping the profiles, and finally when
+        finish() is called. Only the volume's own filesystem is flushed. """
+    def __init__(self, mountpoint):
+        self.mountpoint = mountpoint
+        self.mount = extvolmounts.table().by_mountpoint(mountpoint)
+        self.start = time.monotonic()
+        self.written = extvolmounts.written_bytes(self.mount) if self.mount else None
+        self.thread = threading.Thread(target=self._sync, name="extvol-writeback",
+                                       daemon=True)
+        self.thread.start()
+
+    def _sync(self):
+        with extvoltrace.span("syncfs (early)", "filesystem", mountpoint=self.mountpoint):
+            try:
+                extvolmounts.syncfs(self.mountpoint)
+            except OSError as error:
+                syslog.syslog(syslog.LOG_ERR, "Early writeback failed: %s" % error)
+
+    def finish(self):
+        """ Flush what is left and report how much was written back """
+        self.thread.join()
+        start = time.monotonic()
+        with extvoltrace.span("syncfs", "filesystem", mountpoint=self.mountpoint) as span:
+            extvolmounts.syncfs(self.mountpoint)
+            flush = time.monotonic() - start
+            written = extvolmounts.written_bytes(self.mount) if self.mount else None
+            if written is not None and self.written is not None:
+                span.args["bytes"] = written - self.written
+                syslog.syslog(syslog.LOG_DEBUG, "Wrote back %d bytes to %s in %.2fs, "
+                              "%.2fs of it in the final flush" % \
+                              (written - self.written, self.mountpoint,
+                               time.monotonic() - self.start, flush))
+            else:
+                syslog.syslog(syslog.LOG_DEBUG, "Flushed %s in %.2fs" % \
+                              (self.mountpoint, flush))
+
+def _trace_path(state, action):
+    """ Return where the trace of opening or closing a volume is written,
+        next to its state directory, which is gone after closing """
+    return os.path.join(extvolstate.root(), "%s.%s-trace.json" % (state.id, action))
+
+def _provides(mountpoint):
+    """ Return the function which tells extvolstate.claim() whether the
+        volume holds the data of a profile: it was set up there before, or
+        any of its paths or dumps are on the volume. Paths only created
+        because the volume held a profile no other volume provided, and
+        which are still empty, do not count. """
+    manifest = extvolmanifest.get(mountpoint)
+    def provides(profile):
+        if profile.name in manifest.profiles:
+            return True
+        if profile.name in manifest.fallbacks:
+            return False
+        paths = [os.path.join(mountpoint, path) for path in profile.confdirs + profile.data]
+        paths += [extvollinks.conffile_target(mountpoint, path) for path in profile.conffiles]
+        paths += [extvolsettings.dump_path(mountpoint, key, "dconf") for key in profile.dconf]
+        paths += [extvolsettings.dump_path(mountpoint, key, "gconf") for key in profile.gconf]
+        return any(_volume_has(mountpoint, os.path.relpath(path, mountpoint)) for path in paths)
+    return provides
+
+def _holds_data(mountpoint, profile):
+    """ Return True if the links of a profile left data on the volume """
+    for path in profile.confdirs:
+        try:
+            with os.scandir(os.path.join(mountpoint, path)) as entries:
+                if any(True for entry in entries):
+                    return True
+        except OSError:
+            pass
+    for path in profile.conffiles:
+        try:
+            if os.path.getsize(extvollinks.conffile_target(mountpoint, path)):
+                return True
+        except OSError:
+            pass
+    return False
+
+def _write_dumper_settings(state, profiles):
+    """ Tell the dumper of a volume which settings its profiles have, and
+        which trees on the volume it watches for changes """
+    extvolsettings.write_atomic(state.path_of("settings.json"), json.dumps(
+        {"dconf": [key for p in profiles for key in p.dconf],
+         "gconf": [key for p in profiles for key in p.gconf],
+         "trees": sorted(set(path for p in profiles for path in p.confdirs + p.data))}))
+
+def _take_over(taken):
+    """ Close the profiles taken over from other open volumes there, so
+        they can be opened on this one """
+    volumes = dict((v.id, v) for v in extvolstate.open_volumes())
+    for volume_id, names in sorted(taken.items()):
+        other = volumes.get(volume_id)
+        if other is None:
+            continue
+        syslog.syslog(syslog.LOG_DEBUG, "Taking over %s from %s" % \
+                      (", ".join(sorted(names)), other.mountpoint))
+        with extvoltrace.span("take over", "volume", mountpoint=other.mountpoint,
+                              profiles=sorted(names)):
+            _run_profiles(other.mountpoint, False, [p for p in PROFILES if p.name in names])
+            held = extvolstate.claimed(other)
+            _write_dumper_settings(other, [p for p in PROFILES if p.name in held])
+            extvolrun.run(["gconf-dumper.py", "-u", "-t", other.mountpoint])
+
+def _recover(state):
+    """ Undo the links of a volume which was open in a crashed session, or
+        unmounted without being closed, and forget it """
+    syslog.syslog(syslog.LOG_DEBUG, "Undoing %d links of %s" % \
+                  (extvoljournal.recover(state.path_of("journal")), state.mountpoint))
+    extvolstate.release(state)
+    state.remove()
+
 def extvol_open(mountpoint):
     """ open an extended volume """
-    global pyn
+    mountpoint = mountpoint.rstrip('/')
     syslog.syslog(syslog.LOG_DEBUG, "Opening volume at %s as extended volume" % \
                                     mountpoint)
-    # if the lock file says there's another one open, exit.
-    if os.path.exists("%s/.mounted_as_extended_volume" \
-        % os.environ["HOME"]):
-        show_error(_("Either this is not an extended volume, or there is already "
-                     "another extended volume mounted. There can only be one "
-                     "extended volume mounted at a time."))
+    state = extvolstate.VolumeState(mountpoint)
+    if state.exists():
+        show_error(_("The extended volume at %s is already open.") % mountpoint)
         return
+    # Links left behind by a session which crashed while a volume was open
+    if extvoljournal.read():
+        syslog.syslog(syslog.LOG_DEBUG, "Undoing %d links of a crashed session" % \
+                      extvoljournal.recover())
+    for other in extvolstate.open_volumes():
+        if not extvolmounts.is_mountpoint(other.mountpoint):
+            _recover(other)
 
     # Check free space
     s = os.statvfs(mountpoint)
@@ -742,118 +1097,136 @@ def extvol_open(mountpoint):
         return
 
     # open extended volume
+    extvoltrace.reset()
+    progress = ProgressWindow(_("Extended volume"), _("Extended volume is being opened, please wait!"))
+    journal = None
     try:
-        with open("%s/.mounted_as_extended_volume" % os.environ["HOME"], "w") as marker:
-            marker.write("%s" % mountpoint)
-        pyn.update(_("Please wait..."),
-                   _("Extended volume is being opened, please wait!"), "usbpendrive_unmount")
-        pyn.show()
-
-        _open_gnupg(mountpoint)
-        _open_evolution(mountpoint)
-        _open_hamster(mountpoint)
-        _open_keepass(mountpoint)
-        _open_libreoffice(mountpoint)
-        _open_scribus(mountpoint)
-        _open_gimp(mountpoint)
-        _open_inkscape(mountpoint)
-        _open_gthumb(mountpoint)
-        _open_planner(mountpoint)
-        _open_desktop(mountpoint)
-        _load_printers(mountpoint)
-        _open_vbox(mountpoint)
-        _open_pulseaudio(mountpoint)
-        _open_grsync(mountpoint)
-        _open_kmymoney(mountpoint)
-        _open_thunderbird(mountpoint)
-        _open_tracker(mountpoint)
-        _open_backintime(mountpoint)
-        _open_okular(mountpoint)
-        syslog.syslog(syslog.LOG_DEBUG, "... done.")
-
-        # gconf-dumper will save above gconf dumps every 5 minutes, so you
-        # have a fairly recent state after a crash or power loss
-        syslog.syslog(syslog.LOG_DEBUG, "Starting the GConf dumper")
-        subprocess.run(["gconf-dumper.py", "-t", mountpoint])
+        with extvoltrace.span("extvol_open", "volume", mountpoint=mountpoint) as s:
+            manifest = extvolmanifest.get(mountpoint)
+            s.args["manifest"] = "fresh" if manifest.fresh else "probed"
+            manifest.begin()
+            state.create()
+            claims, provided, taken = extvolstate.claim(
+                state, PROFILES, _provides(mountpoint),
+                pinned=set(p.name for p in PROFILES if p.pinned))
+            profiles = [p for p in PROFILES if p.name in claims]
+            s.args["profiles"] = len(profiles)
+            if not provided and len(extvolstate.open_volumes()) > 1:
+                show_error(_("None of the settings on %s are used, because the other "
+                             "open extended volumes hold them already. Close them first "
+                             "to use the settings on this volume.") % mountpoint)
+            _take_over(taken)
+            # The dumper keeps the settings of these profiles up to date
+            _write_dumper_settings(state, profiles)
+            journal = extvoljournal.Journal(state.path_of("journal"))
+            journal.begin(mountpoint)
+            notify(_("Please wait..."), _("Extended volume is being opened, please wait!"))
+
+            _run_profiles(mountpoint, True, profiles, progress=progress, journal=journal)
+            manifest.begin()
+            syslog.syslog(syslog.LOG_DEBUG, "... done.")
+
+            # gconf-dumper saves changed settings to the dumps within seconds,
+            # so you have a recent state after a crash or power loss
+            syslog.syslog(syslog.LOG_DEBUG, "Starting the GConf dumper")
+            extvolrun.run(["gconf-dumper.py", "-t", mountpoint])
 
     except:
         show_error(variables=vars())
         return
+    finally:
+        if journal is not None:
+            journal.close()
+        extvolmanifest.forget(mountpoint)
+        progress.close()
+        extvoltrace.write(_trace_path(state, "open"))
+        extvolrun.log_stats()
     # Notify the user it's done
-    pyn.update(_("Opening successful"), \
-                        _("Extended volume opened successfully."),
-               "usbpendrive_unmount")
-    pyn.show()
+    notify(_("Opening successful"), _("Extended volume opened successfully."))
 
 def extvol_close(mountpoint):
     """ Close an extended Volume """
-    global pyn
     mountpoint = mountpoint.rstrip('/')
-    with open("%s/.mounted_as_extended_volume" % os.environ["HOME"], "r") as marker:
-        extvolmount = marker.readline().strip()
-    if not os.path.ismount(mountpoint) or (mountpoint != extvolmount):
+    state = extvolstate.VolumeState(mountpoint)
+    if not extvolmounts.is_mountpoint(mountpoint) or not state.exists():
         syslog.syslog(syslog.LOG_DEBUG, "No extended volume found at %s" % \
                                          mountpoint.encode('ascii', 'replace'))
         return
     syslog.syslog(syslog.LOG_DEBUG, "Closing extended volume at %s" % \
                                     mountpoint.encode('ascii', 'replace'))
+    extvoltrace.reset()
     # Test open files
     syslog.syslog(syslog.LOG_DEBUG, "Looking for open files")
-    openfiles = subprocess.run(["/usr/bin/sudo", "/usr/bin/lsof", "-w", "-F", "n"],
-                                 stdout=subprocess.PIPE,
-                                 universal_newlines=True).stdout
-    openfiles = re.findall("^n(%s/(?!.local/share/hamster-applet|.local/share/evolution|.config/tracker|.cache/tracker|.local/share/tracker|.VirtualBox/VBoxSVC.log).*)$" % mountpoint, openfiles, re.MULTILINE)
+    with extvoltrace.span("find open files", "filesystem"):
+        openfiles = extvolprocs.open_files(mountpoint, OPEN_FILES_IGNORED, sudo=True)
+    # A background snapshot is waited for before the last one
+    dirty = extvolwatch.read_state(mountpoint)
+    if dirty is not None and dirty["snapshot_pid"]:
+        snapshot = extvolprocs.descendants(dirty["snapshot_pid"])
+        openfiles = [f for f in openfiles if f[1] not in snapshot]
     if len(openfiles) > 0:
         message = (_("There are still open files on %s, listed below. Please close them first.\n\n") % mountpoint + '\n')
-        message += '\n'.join(openfiles)
+        message += '\n'.join("%s (%s)" % (path, name) for path, pid, name in openfiles)
         show_error(message)
         return
-    pyn.update(_("Please wait..."), _("Extended volume is being closed, please wait!"), "usbpendrive_unmount")
-    pyn.show()
-
-    #Stop the gconf dumper process, do a backup of the relevant gconf entries
-    # kill evolution to make sure the volume can be dismounted later
-    # restart gnome panel, clean up symlinks und copy back old folders if needed
-    syslog.syslog(syslog.LOG_DEBUG, "Stopping the GConf dumper")
-    subprocess.run(["/usr/bin/gconf-dumper.py", "-q"])
-    subprocess.run(["evolution", "--force-shutdown"])
-    _close_gnupg(mountpoint)
-    _close_evolution(mountpoint)
-    _close_hamster(mountpoint)
-    _close_keepass(mountpoint)
-    _close_libreoffice(mountpoint)
-    _close_scribus(mountpoint)
-    _close_gimp(mountpoint)
-    _close_inkscape(mountpoint)
-    _close_gthumb(mountpoint)
-    _close_planner(mountpoint)
-    _close_desktop(mountpoint)
-    _save_printers(mountpoint)
-    _close_vbox(mountpoint)
-    _close_pulseaudio(mountpoint)
-    _close_grsync(mountpoint)
-    _close_kmymoney(mountpoint)
-    _close_thunderbird(mountpoint)
-    _close_tracker(mountpoint)
-
-    subprocess.run(["/usr/bin/killall", "gconfd-2"])
-    _close_backintime(mountpoint)
-    _close_okular(mountpoint)
-    syslog.syslog(syslog.LOG_DEBUG, "Syncing...")
-    subprocess.run(["/bin/sync"])
-    os.remove("%s/.mounted_as_extended_volume" % os.environ["HOME"])
-    vm = Gio.VolumeMonitor.get()
-    for mount in vm.get_mounts():
-        if mount.get_root().get_path() == mountpoint:
-            syslog.syslog(syslog.LOG_DEBUG, "Unmounting %s" % mountpoint.encode('ascii', 'replace'))
+    progress = ProgressWindow(_("Extended volume"), _("Extended volume is being closed, please wait!"))
+    try:
+        with extvoltrace.span("extvol_close", "volume", mountpoint=mountpoint):
+            notify(_("Please wait..."), _("Extended volume is being closed, please wait!"))
+
+            # Have the gconf dumper write the final dumps (it keeps collecting
+            # the changed paths until the backintime profile stops it), then
+            # stop the daemons, clean up symlinks und copy back old folders if needed
+            syslog.syslog(syslog.LOG_DEBUG, "Pausing the GConf dumper")
+            extvolrun.run(["/usr/bin/gconf-dumper.py", "-p", "-t", mountpoint])
+            # The final dumps are written, start writing the volume back
+            # while the profiles close
+            writeback = _Writeback(mountpoint)
+            claims = extvolstate.claimed(state)
+            profiles = [p for p in PROFILES if p.name in claims]
+            fallbacks = extvolstate.fallbacks(state)
+            failures = set()
+            _run_profiles(mountpoint, False, profiles, progress=progress, failures=failures)
+            # In case the backintime profile did not stop it
+            extvolrun.run(["/usr/bin/gconf-dumper.py", "-q", "-t", mountpoint])
             try:
-                mount.unmount(0, None, None, None)
-            except:
-                syslog.syslog(syslog.LOG_DEBUG, "Unmount failed!")
-                show_error(_("Unmounting the volume at %s failed!") % mountpoint)
-            else:
-                pyn.update(_("Closing successful"), _("Extended volume closed successfully!"), "usbpendrive_unmount")
-                pyn.show()
+                with extvoltrace.span("write manifest", "filesystem"):
+                    unused = set(p.name for p in PROFILES
+                                 if p.name in fallbacks and not _holds_data(mountpoint, p))
+                    extvolmanifest.get(mountpoint).finish(claims - unused, unused)
+            except OSError as error:
+                syslog.syslog(syslog.LOG_ERR, "Could not write the manifest: %s" % error)
+            extvolmanifest.forget(mountpoint)
+            # Everything this session writes to the volume is written now
+            try:
+                extvolperms.restamp(mountpoint)
+            except OSError as error:
+                syslog.syslog(syslog.LOG_ERR, "Could not renew the permission stamp: %s" % error)
+            syslog.syslog(syslog.LOG_DEBUG, "Syncing...")
+            writeback.finish()
+            if failures:
+                # Links of these profiles may be left in $HOME: the next open
+                # undoes what the journal says is still in effect
+                syslog.syslog(syslog.LOG_ERR, "Closing %s failed, keeping the journal" % \
+                              ", ".join(sorted(failures)))
+                extvoljournal.keep(state.path_of("journal"), failures)
+            extvolstate.release(state)
+            state.remove()
+            vm = Gio.VolumeMonitor.get()
+            for mount in vm.get_mounts():
+                if mount.get_root().get_path() == mountpoint:
+                    syslog.syslog(syslog.LOG_DEBUG, "Unmounting %s" % mountpoint.encode('ascii', 'replace'))
+                    try:
+                        mount.unmount(0, None, None, None)
+                    except:
+                        syslog.syslog(syslog.LOG_DEBUG, "Unmount failed!")
+                        show_error(_("Unmounting the volume at %s failed!") % mountpoint)
+                    else:
+                        notify(_("Closing successful"), _("Extended volume closed successfully!"))
+    finally:
+        progress.close()
+        extvoltrace.write(_trace_path(state, "close"))
+        extvolrun.log_stats()
 
 if __name__ == "__main__":
     print("This module cannot be called directly")
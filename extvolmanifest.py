@@ -0,0 +1,160 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" The manifest kept in .extended_volume, which marks a volume as an
+    extended volume. It records the layout version of the container, the
+    profiles which were set up on it, the migrations done, the settings
+    dumps and which of the other paths looked at while opening exist, so
+    that opening needs one read instead of a metadata read per path.
+
+    The manifest is marked unclean while the volume is open and written
+    back when it is closed, along with the names in the volume's top
+    directory and the modification times of the directories below it
+    holding the paths recorded. If it is missing, unclean, of another
+    version, or any of these changed since (e.g. because the volume was
+    changed on another system), every path is probed again. The files this
+    package keeps in the top directory itself do not count.
+"""
+
+import os
+import re
+import json
+import threading
+
+FILE = ".extended_volume"
+VERSION = 1
+# 1: Ubuntu Privacy Remix containers, 2: with the Thunderbird profile
+LAYOUT = 2
+
+_DUMP = re.compile(r'^\..*-backup\..*\.dump$')
+# Rewritten on every mount or close: the manifest, the permission stamp
+# (extvolperms) and the snapshot token (extvolwatch)
+OWN_FILES = (FILE, ".extvol-permissions", ".extvol-snapshot")
+
+def _own(name):
+    """ Return True for the files of OWN_FILES and their temporary files """
+    return any(name == own or (name.startswith(own + '.') and name.endswith(".tmp"))
+               for own in OWN_FILES)
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+class Manifest(object):
+    """ The manifest of the volume at mountpoint, as read from it """
+    def __init__(self, mountpoint):
+        self.mountpoint = mountpoint.rstrip('/')
+        self.path = os.path.join(self.mountpoint, FILE)
+        self._lock = threading.Lock()
+        data = self._read()
+        self.fresh = bool(data is not None and data.get("clean") and
+                          data.get("top") == self._top() and
+                          all(_mtime(os.path.join(self.mountpoint, directory)) == mtime
+                              for directory, mtime in data.get("dirs", {}).items()))
+        data = data or {}
+        self.layout = data.get("layout")
+        self.profiles = set(data.get("profiles", ()))
+        self.fallbacks = set(data.get("fallbacks", ()))
+        self.migrations = set(data.get("migrations", ()))
+        self.dumps = set(data.get("dumps", ()))
+        self.files = dict(data.get("files", {}))
+
+    def _read(self):
+        """ Return the manifest, or None if there is none of this version """
+        try:
+            with open(self.path, 'r') as manifest:
+                data = json.load(manifest)
+            return data if data.get("version") == VERSION else None
+        except (OSError, ValueError, AttributeError):
+            return None
+
+    def _top(self):
+        """ Return the names in the top directory, without OWN_FILES """
+        return sorted(entry.name for entry in os.scandir(self.mountpoint)
+                      if not _own(entry.name))
+
+    def _dirs(self):
+        """ Return the modification times of the directories below the top
+            directory which hold the recorded paths """
+        dirs = {}
+        for relpath in self.files:
+            directory = os.path.dirname(relpath)
+            while directory and directory not in dirs:
+                dirs[directory] = _mtime(os.path.join(self.mountpoint, directory))
+                directory = os.path.dirname(directory)
+        return dirs
+
+    def has(self, relpath):
+        """ Return True if relpath exists on the volume, from the manifest if
+            it knows, else by looking """
+        with self._lock:
+            if self.fresh:
+                if _DUMP.match(relpath):
+                    return relpath in self.dumps
+                if relpath in self.files:
+                    return self.files[relpath]
+        exists = os.path.exists(os.path.join(self.mountpoint, relpath))
+        with self._lock:
+            if not _DUMP.match(relpath):
+                self.files[relpath] = exists
+        return exists
+
+    def migrated(self, newpath):
+        """ Remember that the migration to newpath is done """
+        with self._lock:
+            self.migrations.add(newpath)
+
+    def _refresh(self):
+        """ Look at all paths again, as they are when closing """
+        self.dumps = set(entry.name for entry in os.scandir(self.mountpoint)
+                         if _DUMP.match(entry.name))
+        for relpath in list(self.files):
+            self.files[relpath] = os.path.exists(os.path.join(self.mountpoint, relpath))
+
+    def _write(self, clean):
+        data = {"version": VERSION, "layout": self.layout or LAYOUT,
+                "profiles": sorted(self.profiles), "fallbacks": sorted(self.fallbacks),
+                "migrations": sorted(self.migrations),
+                "dumps": sorted(self.dumps), "files": self.files, "clean": clean}
+        if clean:
+            data["top"] = self._top()
+            data["dirs"] = self._dirs()
+        with open(self.path, 'a+') as manifest:
+            manifest.seek(0)
+            manifest.truncate()
+            manifest.write(json.dumps(data, indent=1, sort_keys=True) + '\n')
+            manifest.flush()
+            os.fsync(manifest.fileno())
+
+    def begin(self):
+        """ Mark the manifest as unclean while the volume is open. Called
+            again once opened, to keep the paths looked at meanwhile. """
+        with self._lock:
+            self._write(False)
+
+    def finish(self, profiles, fallbacks=()):
+        """ Record the profiles set up on the volume, and those it only held
+            because no other volume provided them and which it still holds
+            no data of, and write the manifest for the next open """
+        with self._lock:
+            self.profiles.update(profiles)
+            self.fallbacks = (self.fallbacks | set(fallbacks)) - self.profiles
+            self.layout = LAYOUT
+            self._refresh()
+            self._write(True)
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+def get(mountpoint):
+    """ Return the Manifest of mountpoint, read once per process """
+    mountpoint = mountpoint.rstrip('/')
+    with _manifests_lock:
+        if mountpoint not in _manifests:
+            _manifests[mountpoint] = Manifest(mountpoint)
+        return _manifests[mountpoint]
+
+def forget(mountpoint):
+    with _manifests_lock:
+        _manifests.pop(mountpoint.rstrip('/'), None)
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" A cached, indexed view of the mount table which is only re-read when
+    the kernel reports a change """
+
+import os
+import re
+import ctypes
+import select
+import threading
+
+MOUNTINFO = "/proc/self/mountinfo"
+# sysfs counts I/O in sectors of this size, whatever the device uses
+SECTOR_SIZE = 512
+
+_escape = re.compile(r'\\([0-7]{3})')
+
+def _unescape(field):
+    """ Undo the octal escaping of spaces, tabs, newlines and backslashes """
+    return _escape.sub(lambda m: chr(int(m.group(1), 8)), field)
+
+class Mount(object):
+    """ One line of /proc/self/mountinfo """
+    def __init__(self, line):
+        fields = line.split()
+        sep = fields.index('-')
+        self.mount_id = int(fields[0])
+        self.parent_id = int(fields[1])
+        self.major, self.minor = (int(n) for n in fields[2].split(':'))
+        self.root = _unescape(fields[3])
+        self.mountpoint = _unescape(fields[4])
+        self.options = fields[5].split(',')
+        self.fstype = fields[sep + 1]
+        self.source = _unescape(fields[sep + 2])
+        self.super_options = fields[sep + 3].split(',') if len(fields) > sep + 3 else []
+
+    @property
+    def device(self):
+        """ The block device node, with symlinks like /dev/mapper/x resolved """
+        if self.source.startswith('/dev/'):
+            return os.path.realpath(self.source)
+        return self.source
+
+    @property
+    def devno(self):
+        return "%d:%d" % (self.major, self.minor)
+
+    def __repr__(self):
+        return "<Mount %s on %s type %s>" % (self.source, self.mountpoint, self.fstype)
+
+class MountTable(object):
+    """ Parses the mount table once and keeps dicts keyed by mountpoint and
+        by device. The table is re-read only after the kernel signalled a
+        change of the mount namespace through poll() on the mountinfo file,
+        so lookups normally cost one poll() system call. """
+    def __init__(self, path=MOUNTINFO):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'r')
+        self._poll = select.poll()
+        self._poll.register(self._file.fileno(), select.POLLERR | select.POLLPRI)
+        self._by_mountpoint = {}
+        self._by_device = {}
+        self._load()
+
+    def _load(self):
+        by_mountpoint = {}
+        by_device = {}
+        self._file.seek(0)
+        for line in self._file.read().splitlines():
+            try:
+                mount = Mount(line)
+            except (ValueError, IndexError):
+                continue
+            # Later lines are mounted over earlier ones
+            by_mountpoint[mount.mountpoint] = mount
+            for key in (mount.source, mount.device, mount.devno):
+                by_device.setdefault(key, mount)
+        self._by_mountpoint = by_mountpoint
+        self._by_device = by_device
+
+    def _refresh(self):
+        """ Re-read the table if the kernel reported a change """
+        if self._poll.poll(0):
+            self._load()
+
+    def mounts(self):
+        """ Return all current mounts """
+        with self._lock:
+            self._refresh()
+            return list(self._by_mountpoint.values())
+
+    def by_mountpoint(self, mountpoint):
+        """ Return the mount at mountpoint, or None if nothing is mounted there """
+        mountpoint = os.path.normpath(mountpoint)
+        with self._lock:
+            self._refresh()
+            return self._by_mountpoint.get(mountpoint)
+
+    def by_device(self, device):
+        """ Return the first mount of a device, given as device node
+            (symlinks allowed) or "major:minor", or None """
+        with self._lock:
+            self._refresh()
+            mount = self._by_device.get(device)
+            if mount is None and device.startswith('/dev/'):
+                mount = self._by_device.get(os.path.realpath(device))
+            return mount
+
+    def find(self, path):
+        """ Return the mount the given absolute path lies on. Only walks up
+            the path string, so path does not have to exist. """
+        path = os.path.abspath(path)
+        with self._lock:
+            self._refresh()
+            while True:
+                mount = self._by_mountpoint.get(path)
+                if mount is not None or path == '/':
+                    return mount
+                path = os.path.dirname(path)
+
+_table = None
+_table_lock = threading.Lock()
+
+def table():
+    """ Return the mount table shared by everything in this process """
+    global _table
+    with _table_lock:
+        if _table is None:
+            _table = MountTable()
+        return _table
+
+def is_mountpoint(path):
+    """ Return True if something is mounted at path """
+    return table().by_mountpoint(path) is not None
+
+def filesystem(path):
+    """ Return the filesystem type of the volume path lies on, or None """
+    mount = table().find(path)
+    return mount.fstype if mount is not None else None
+
+_libc = None
+
+def syncfs(path):
+    """ Write back the dirty data of the filesystem path lies on, unlike
+        sync(1), which flushes every filesystem on the machine """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _libc.syncfs(fd) != 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error), path)
+    finally:
+        os.close(fd)
+
+def written_bytes(mount):
+    """ Return the bytes written to the block device of mount since it was
+        set up, or None if the kernel does not count them """
+    try:
+        with open("/sys/dev/block/%s/stat" % mount.devno, 'r') as stat:
+            return int(stat.read().split()[6]) * SECTOR_SIZE
+    except (OSError, IndexError, ValueError):
+        return None
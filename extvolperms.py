@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Fix ownership and permissions of a directory tree, touching only the
+    inodes which are actually wrong.
+
+    A fixed volume carries a stamp, so the next mount can skip the walk.
+    The stamp is only checked against the change times of the volume root
+    and its top-level directories: an owner or mode changed deeper inside
+    elsewhere, without creating, removing or renaming anything at the top,
+    is not noticed until a forced fix.
+"""
+
+import os
+import stat
+import json
+import fcntl
+import struct
+import time
+import syslog
+import threading
+import concurrent.futures
+import extvolmounts
+import extvolrun
+import extvoltrace
+
+# Upper bound for the number of directories scanned at the same time
+MAX_WORKERS = 8
+# Name of the stamp file kept in the root of fixed volumes
+STAMP = ".extvol-permissions"
+# ioctl returning the inode generation, _IOR('v', 1, long)
+FS_IOC_GETVERSION = 0x80087601
+# Number of paths passed to one sudo chown/chmod call
+SUDO_CHUNK = 200
+BOOT_ID = "/proc/sys/kernel/random/boot_id"
+
+class TreeFixer(object):
+    """ Walks a tree in parallel and changes owner and mode of the inodes
+        which differ from the wanted ones. Either set mode to an exact
+        permission value, or add_rwx to apply "a+rwX". Inodes which cannot
+        be changed as the current user are collected in self.denied, and
+        unreadable directories in self.unreadable. """
+    def __init__(self, uid=-1, gid=-1, mode=None, add_rwx=False):
+        self.uid = uid
+        self.gid = gid
+        self.mode = mode
+        self.add_rwx = add_rwx
+        self.changed = 0
+        self.denied = []
+        self.unreadable = []
+        self._lock = threading.Lock()
+
+    def wanted_mode(self, st):
+        """ Return the permission bits an inode with stat result st should have """
+        current = stat.S_IMODE(st.st_mode)
+        if self.mode is not None:
+            return self.mode
+        if self.add_rwx:
+            wanted = current | 0o666
+            if stat.S_ISDIR(st.st_mode) or current & 0o111:
+                wanted |= 0o111
+            return wanted
+        return current
+
+    def _fix(self, path, st):
+        """ Fix a single inode, return True if it was changed """
+        changed = False
+        try:
+            if (self.uid != -1 and st.st_uid != self.uid) or \
+                    (self.gid != -1 and st.st_gid != self.gid):
+                os.chown(path, self.uid, self.gid, follow_symlinks=False)
+                changed = True
+            if not stat.S_ISLNK(st.st_mode):
+                wanted = self.wanted_mode(st)
+                if wanted != stat.S_IMODE(st.st_mode):
+                    os.chmod(path, wanted)
+                    changed = True
+        except PermissionError:
+            with self._lock:
+                self.denied.append(path)
+            return False
+        return changed
+
+    def _scan(self, path):
+        """ Fix the entries of one directory, return its subdirectories """
+        subdirs = []
+        changed = 0
+        try:
+            entries = list(os.scandir(path))
+        except PermissionError:
+            with self._lock:
+                self.unreadable.append(path)
+            return subdirs
+        except OSError:
+            return subdirs
+        for entry in entries:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if self._fix(entry.path, st):
+                changed += 1
+            if stat.S_ISDIR(st.st_mode):
+                subdirs.append(entry.path)
+        with self._lock:
+            self.changed += changed
+        return subdirs
+
+    def run(self, path):
+        """ Fix path and everything below it, return the number of inodes changed """
+        if self._fix(path, os.lstat(path)):
+            self.changed += 1
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+            pending = set([pool.submit(self._scan, path)])
+            while pending:
+                finished, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    for subdir in future.result():
+                        pending.add(pool.submit(self._scan, subdir))
+        return self.changed
+
+    def sudo_fix(self):
+        """ Fix the inodes the current user was not allowed to change, using
+            sudo. Unreadable directories are fixed recursively. Raises
+            CalledProcessError if chown or chmod failed. """
+        owner = "%s:%s" % (self.uid, self.gid) if self.uid != -1 else None
+        modearg = "0%o" % self.mode if self.mode is not None else "a+rwX"
+        for paths, recursive in ((self.denied, []), (self.unreadable, ["-R"])):
+            for i in range(0, len(paths), SUDO_CHUNK):
+                chunk = paths[i:i + SUDO_CHUNK]
+                # Recursive runs over large subtrees must not be killed
+                # halfway, the command run by sudo would go on anyway
+                if owner is not None:
+                    extvolrun.run(["/usr/bin/sudo", "/bin/chown"] + recursive +
+                                 [owner, "--"] + chunk, timeout=None, check=True)
+                if self.mode is not None or self.add_rwx:
+                    extvolrun.run(["/usr/bin/sudo", "/bin/chmod"] + recursive +
+                                 [modearg, "--"] + chunk, timeout=None, check=True)
+                self.changed += len(chunk)
+
+def fix_tree(path, uid=-1, gid=-1, mode=None, add_rwx=False, sudo=False):
+    """ Fix owner and permissions of path and everything below it. With sudo,
+        inodes which cannot be changed as the current user are fixed using
+        sudo, see TreeFixer.sudo_fix(). Returns the number of inodes changed. """
+    fixer = TreeFixer(uid, gid, mode, add_rwx)
+    fixer.run(path)
+    if sudo and (fixer.denied or fixer.unreadable):
+        fixer.sudo_fix()
+    elif fixer.denied or fixer.unreadable:
+        syslog.syslog(syslog.LOG_DEBUG, "Could not fix %d inodes below %s" % \
+                      (len(fixer.denied) + len(fixer.unreadable), path))
+    return fixer.changed
+
+def _generation(path):
+    """ Return the inode generation of path, or None if the filesystem
+        does not tell. """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    except OSError:
+        return None
+    try:
+        buf = fcntl.ioctl(fd, FS_IOC_GETVERSION, struct.pack('l', 0))
+        return struct.unpack('l', buf)[0]
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+def _signature(mountpoint):
+    """ Return the newest change time of the volume root and the directories
+        directly below it, which is what the stamp is checked against. """
+    newest = os.lstat(mountpoint).st_ctime_ns
+    for entry in os.scandir(mountpoint):
+        if entry.name != STAMP and entry.is_dir(follow_symlinks=False):
+            newest = max(newest, entry.stat(follow_symlinks=False).st_ctime_ns)
+    return newest
+
+def _stamp_valid(mountpoint, uid, gid):
+    """ Return True if the stamp says the volume was fixed for this user
+        and the volume has not visibly changed since. """
+    path = os.path.join(mountpoint, STAMP)
+    try:
+        with open(path, 'r') as stampfile:
+            stamp = json.load(stampfile)
+        stamped = os.lstat(path).st_ctime_ns
+    except (OSError, ValueError):
+        return False
+    return stamp.get("uid") == uid and stamp.get("gid") == gid and \
+        stamp.get("generation") == _generation(mountpoint) and \
+        _signature(mountpoint) <= stamped
+
+def _mount_id(mountpoint):
+    """ Return what tells this mount of the volume apart from the others:
+        the boot and the id of the mount, or None """
+    mount = extvolmounts.table().by_mountpoint(mountpoint)
+    try:
+        with open(BOOT_ID, 'r') as boot:
+            return "%s/%d" % (boot.read().strip(), mount.mount_id) if mount else None
+    except OSError:
+        return None
+
+def _write_stamp(mountpoint, uid, gid, fixed=None):
+    """ Stamp the volume as fixed, and as checked for the current mount """
+    path = os.path.join(mountpoint, STAMP)
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as stampfile:
+        json.dump({"uid": uid, "gid": gid, "generation": _generation(mountpoint),
+                   "fixed": fixed or time.time(), "mount": _mount_id(mountpoint)},
+                  stampfile)
+    os.replace(tmp, path)
+
+def _read_stamp(mountpoint):
+    try:
+        with open(os.path.join(mountpoint, STAMP), 'r') as stampfile:
+            return json.load(stampfile)
+    except (OSError, ValueError):
+        return {}
+
+def restamp(mountpoint):
+    """ Renew the stamp of a volume after the session wrote to it, so that
+        only changes made elsewhere make the next mount walk the volume
+        again. Only a stamp written for the current user when this mount
+        was fixed, or found up to date, is renewed. Returns True if so. """
+    uid, gid = os.getuid(), os.getgid()
+    stamp = _read_stamp(mountpoint)
+    if stamp.get("uid") != uid or stamp.get("gid") != gid or \
+            stamp.get("generation") != _generation(mountpoint) or \
+            stamp.get("mount") is None or stamp.get("mount") != _mount_id(mountpoint):
+        return False
+    _write_stamp(mountpoint, uid, gid, stamp.get("fixed"))
+    return True
+
+def fix_volume(mountpoint, force=False):
+    """ Make everything on a mounted volume owned and read/writable by the
+        current user. Unless force is given, the walk is skipped if the
+        volume carries a stamp from an earlier fix and its top level
+        directories have not changed since; closing the volume renews the
+        stamp, see restamp(). The stamp is not written if sudo failed to
+        fix what the user could not. Returns the number of inodes changed,
+        or None if the walk was skipped. """
+    uid, gid = os.getuid(), os.getgid()
+
+    def stamp(fixed=None):
+        try:
+            _write_stamp(mountpoint, uid, gid, fixed)
+        except OSError:
+            syslog.syslog(syslog.LOG_DEBUG, "Could not write permission stamp on %s" % \
+                          mountpoint)
+    if not force and _stamp_valid(mountpoint, uid, gid):
+        syslog.syslog(syslog.LOG_DEBUG, "Permissions on %s are up to date" % mountpoint)
+        stamp(_read_stamp(mountpoint).get("fixed"))
+        return None
+    start = time.monotonic()
+    with extvoltrace.span("fix permissions", "filesystem", path=mountpoint) as s:
+        changed = fix_tree(mountpoint, uid, gid, add_rwx=True, sudo=True)
+        s.args["changed"] = changed
+    syslog.syslog(syslog.LOG_DEBUG, "Fixed %d inodes on %s in %.1fs" % \
+                  (changed, mountpoint, time.monotonic() - start))
+    stamp()
+    return changed
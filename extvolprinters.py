@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Save the CUPS print queues to an extended volume and restore them,
+    touching only the queues which differ """
+
+import os
+import json
+import pickle
+import hashlib
+import syslog
+import extvollazy
+import extvolsettings
+import extvoltrace
+
+cups = extvollazy.LazyModule("cups")
+
+MANIFEST = "printers.json"
+# The pickled getPrinters() dict written by older versions
+LEGACY_MANIFEST = "printers"
+# printer-type bit of the default destination (cups.CUPS_PRINTER_DEFAULT)
+CUPS_PRINTER_DEFAULT = 0x20000
+# Queue attributes which are restored, with the addPrinter() argument they map to
+ATTRIBUTES = (("device-uri", "device"),
+              ("printer-info", "info"),
+              ("printer-location", "location"))
+
+def _cupsdir(mountpoint):
+    return os.path.join(mountpoint, ".cups")
+
+def _ppd_path(mountpoint, digest):
+    return os.path.join(_cupsdir(mountpoint), "ppd", "%s.ppd" % digest)
+
+def _digest(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 16), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _queue(attrs):
+    """ Return the part of a getPrinters() entry kept in the manifest """
+    queue = dict((attr, attrs.get(attr, "")) for attr, arg in ATTRIBUTES)
+    queue["printer-make-and-model"] = attrs.get("printer-make-and-model", "")
+    return queue
+
+def _default(printers):
+    for name, attrs in printers.items():
+        if attrs.get("printer-type", 0) & CUPS_PRINTER_DEFAULT:
+            return name
+    return None
+
+def read_manifest(mountpoint):
+    """ Return the printer manifest of a volume, converting the pickle of
+        older versions, or None if the volume has no printers saved """
+    cupsdir = _cupsdir(mountpoint)
+    try:
+        with open(os.path.join(cupsdir, MANIFEST), 'r') as manifest:
+            return json.load(manifest)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(cupsdir, LEGACY_MANIFEST), 'rb') as legacy:
+            printers = pickle.load(legacy)
+    except Exception:
+        return None
+    manifest = {"version": 1, "printers": {}, "deleted": [], "default": None}
+    for name, attrs in printers.items():
+        queue = _queue(attrs)
+        ppd = os.path.join(cupsdir, "%s.ppd" % name)
+        queue["ppd"] = ppd if os.path.exists(ppd) else None
+        manifest["printers"][name] = queue
+    try:
+        with open(os.path.join(cupsdir, "default-printer"), 'r') as default:
+            manifest["default"] = default.readline().strip() or None
+    except OSError:
+        pass
+    return manifest
+
+def _ppd_file(mountpoint, queue):
+    """ Return the PPD file of a manifest entry. Legacy entries carry a path. """
+    ppd = queue.get("ppd")
+    if ppd and os.path.isabs(ppd):
+        return ppd
+    return _ppd_path(mountpoint, ppd) if ppd else None
+
+def _fetch_ppd(connection, name):
+    """ Return the path of the PPD of a queue and whether it is a fetched
+        temporary copy. The PPD is read from the CUPS directory if
+        readable, and only fetched from the server otherwise. Returns
+        (None, False) if the queue has no PPD. """
+    local = "/etc/cups/ppd/%s.ppd" % name
+    if os.access(local, os.R_OK):
+        return local, False
+    try:
+        return connection.getPPD(name), True
+    except cups.IPPError:
+        return None, False
+
+def _live_digest(connection, name):
+    """ Return the content hash of the PPD a queue uses now, or None """
+    path, fetched = _fetch_ppd(connection, name)
+    if path is None:
+        return None
+    try:
+        return _digest(path)
+    finally:
+        if fetched:
+            os.remove(path)
+
+def _save_ppd(mountpoint, connection, name):
+    """ Store the PPD of a queue under its content hash, return the hash.
+        The PPD is only copied if no PPD with that content is stored yet. """
+    path, fetched = _fetch_ppd(connection, name)
+    if path is None:
+        return None
+    try:
+        digest = _digest(path)
+        target = _ppd_path(mountpoint, digest)
+        if not os.path.exists(target):
+            with open(path, 'rb') as ppd:
+                extvolsettings.write_atomic(target, ppd.read())
+        return digest
+    finally:
+        if fetched:
+            os.remove(path)
+
+def _prune_ppds(mountpoint, manifest):
+    """ Remove stored PPDs no queue of the manifest refers to any more """
+    used = set(queue.get("ppd") for queue in manifest["printers"].values())
+    ppddir = os.path.join(_cupsdir(mountpoint), "ppd")
+    for name in os.listdir(ppddir):
+        if name.endswith(".ppd") and name[:-4] not in used:
+            os.remove(os.path.join(ppddir, name))
+
+def _write_manifest(mountpoint, manifest):
+    extvolsettings.write_atomic(os.path.join(_cupsdir(mountpoint), MANIFEST),
+                                json.dumps(manifest, indent=1, sort_keys=True))
+
+def save(mountpoint):
+    """ Write the manifest of the current print queues to the volume. The
+        PPD of every queue is hashed, so changed options are saved, but only
+        PPDs whose content is not stored yet are copied. Queues which were
+        saved before but are gone now are recorded as deleted, until the
+        next load() applied that. """
+    with extvoltrace.span("save printers", "printers") as s:
+        connection = cups.Connection()
+        printers = connection.getPrinters()
+        old = read_manifest(mountpoint) or {"printers": {}, "deleted": []}
+        os.makedirs(os.path.join(_cupsdir(mountpoint), "ppd"), exist_ok=True)
+        manifest = {"version": 1, "printers": {}, "default": _default(printers)}
+        for name, attrs in printers.items():
+            queue = _queue(attrs)
+            queue["ppd"] = _save_ppd(mountpoint, connection, name)
+            manifest["printers"][name] = queue
+        manifest["deleted"] = sorted((set(old["printers"]) | set(old.get("deleted", []))) -
+                                     set(printers))
+        _write_manifest(mountpoint, manifest)
+        _prune_ppds(mountpoint, manifest)
+        s.args["printers"] = len(printers)
+
+def _add(connection, mountpoint, name, queue):
+    kwargs = dict((arg, queue.get(attr, "")) for attr, arg in ATTRIBUTES)
+    ppd = _ppd_file(mountpoint, queue)
+    if ppd and os.path.exists(ppd):
+        kwargs["filename"] = ppd
+    connection.addPrinter(name=name, **kwargs)
+    connection.enablePrinter(name)
+    connection.acceptJobs(name)
+
+def _matches(connection, mountpoint, live, name, queue):
+    """ Return True if the live queue name is set up as in the manifest,
+        including its PPD """
+    if name not in live or _queue(live[name]) != _queue(queue):
+        return False
+    ppd = queue.get("ppd")
+    if not ppd or os.path.isabs(ppd) or not os.path.exists(_ppd_file(mountpoint, queue)):
+        return True
+    return _live_digest(connection, name) == ppd
+
+def load(mountpoint):
+    """ Bring the print queues in line with the manifest on the volume.
+        Queues which already match cost the one getPrinters() call and the
+        hash of their PPD; only missing or different queues are (re)added.
+        Queues deleted while the volume was used elsewhere are removed, and
+        the deletions are dropped from the manifest once applied. """
+    manifest = read_manifest(mountpoint)
+    if manifest is None:
+        return
+    with extvoltrace.span("load printers", "printers") as s:
+        connection = cups.Connection()
+        live = connection.getPrinters()
+        changed = 0
+        for name, queue in manifest["printers"].items():
+            if _matches(connection, mountpoint, live, name, queue):
+                continue
+            syslog.syslog(syslog.LOG_DEBUG, "%s printer %s" % \
+                          ("Updating" if name in live else "Adding", name))
+            _add(connection, mountpoint, name, queue)
+            changed += 1
+        deleted = manifest.get("deleted", [])
+        for name in deleted:
+            if name in live and name not in manifest["printers"]:
+                syslog.syslog(syslog.LOG_DEBUG, "Deleting printer %s" % name)
+                connection.deletePrinter(name)
+                changed += 1
+        if deleted and os.path.exists(os.path.join(_cupsdir(mountpoint), MANIFEST)):
+            manifest["deleted"] = []
+            _write_manifest(mountpoint, manifest)
+        default = manifest.get("default")
+        if default and default != _default(live):
+            connection.setDefault(default)
+        s.args["changed"] = changed
@@ -0,0 +1,307 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Find processes and the files they hold open on a volume, and stop
+    processes, using /proc """
+
+import os
+import json
+import select
+import signal
+import time
+import functools
+import concurrent.futures
+import extvolrun
+
+# Upper bound for the number of processes inspected at the same time
+MAX_WORKERS = 8
+
+def _pids():
+    """ Return the pids of all processes currently in /proc """
+    return [int(name) for name in os.listdir("/proc") if name.isdigit()]
+
+def _comm(pid):
+    try:
+        with open("/proc/%d/comm" % pid, 'r') as comm:
+            return comm.read().strip()
+    except OSError:
+        return None
+
+# Longest process name the kernel keeps in /proc/<pid>/comm
+COMM_LEN = 15
+# Lists the open files of processes the user may not inspect, see
+# open_files(). Allowed through sudo for the user's volumes in /media/<user>/,
+# it names one file per process.
+HELPER = "/usr/bin/extvol-open-files"
+# PF_KTHREAD in the flags field of /proc/<pid>/stat
+PF_KTHREAD = 0x00200000
+
+class Process(object):
+    """ A process as seen in /proc at the time of the snapshot """
+    def __init__(self, pid):
+        self.pid = pid
+        self.comm = _comm(pid)
+        try:
+            self.exe = os.readlink("/proc/%d/exe" % pid)
+        except OSError:
+            self.exe = None
+        try:
+            with open("/proc/%d/cmdline" % pid, 'rb') as cmdline:
+                self.argv = [arg.decode("utf-8", "replace")
+                             for arg in cmdline.read().split(b'\0') if arg]
+        except OSError:
+            self.argv = []
+
+    def names(self):
+        """ Return the names this process can be found by """
+        names = set()
+        if self.comm:
+            names.add(self.comm)
+        if self.exe:
+            names.add(os.path.basename(self.exe.replace(" (deleted)", "")))
+        if self.argv:
+            names.add(os.path.basename(self.argv[0]))
+        return names
+
+    def matches(self, names):
+        """ Return True if this process runs one of the given programs. Names
+            longer than the kernel's comm field match on their prefix. """
+        own = self.names()
+        for name in names:
+            if name in own or (len(name) > COMM_LEN and name[:COMM_LEN] == self.comm):
+                return True
+        return False
+
+    def __repr__(self):
+        return "<Process %d %s>" % (self.pid, self.comm)
+
+def snapshot():
+    """ Return a list of Process objects for all processes in /proc """
+    processes = []
+    for pid in _pids():
+        process = Process(pid)
+        if process.comm is not None:
+            processes.append(process)
+    return processes
+
+def find(names, processes=None):
+    """ Return the processes running one of the given programs, out of
+        processes or a fresh snapshot. """
+    names = tuple(names)
+    if processes is None:
+        processes = snapshot()
+    own = os.getpid()
+    return [p for p in processes if p.pid != own and p.matches(names)]
+
+@functools.lru_cache(maxsize=None)
+def evolution_binaries():
+    """ Return the names of all evolution programs, i.e. evolution itself
+        and the helpers in /usr/lib/evolution. """
+    names = set(["evolution"])
+    pending = ["/usr/lib/evolution"]
+    while pending:
+        try:
+            entries = list(os.scandir(pending.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            elif entry.is_file() and os.access(entry.path, os.X_OK):
+                names.add(entry.name)
+    return tuple(sorted(names))
+
+def _ppid(pid):
+    try:
+        with open("/proc/%d/stat" % pid, 'r') as stat:
+            return int(stat.read().rsplit(')', 1)[1].split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+def descendants(pid):
+    """ Return the set of pid and all its (grand)children """
+    children = {}
+    for child in _pids():
+        children.setdefault(_ppid(child), []).append(child)
+    found = set()
+    todo = [pid]
+    while todo:
+        current = todo.pop()
+        if current not in found:
+            found.add(current)
+            todo.extend(children.get(current, ()))
+    return found
+
+def _alive(pid):
+    """ Return True if pid exists and is not a zombie """
+    try:
+        with open("/proc/%d/stat" % pid, 'r') as stat:
+            return stat.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except (OSError, IndexError):
+        return False
+
+def _wait(pids, deadline):
+    """ Wait until the processes have exited or the deadline passed, return
+        the set of pids still alive. """
+    pids = set(pids)
+    pidfds = {}
+    if hasattr(os, "pidfd_open"):
+        for pid in list(pids):
+            try:
+                pidfds[os.pidfd_open(pid)] = pid
+            except OSError:
+                pids.discard(pid)
+    try:
+        if pidfds:
+            poller = select.poll()
+            for fd in pidfds:
+                poller.register(fd, select.POLLIN)
+            while pidfds:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                for fd, event in poller.poll(min(timeout, 3600) * 1000):
+                    poller.unregister(fd)
+                    pids.discard(pidfds.pop(fd))
+                    os.close(fd)
+        else:
+            delay = .01
+            while pids and time.monotonic() < deadline:
+                pids = set(pid for pid in pids if _alive(pid))
+                if pids:
+                    time.sleep(min(delay, max(0, deadline - time.monotonic())))
+                    delay = min(delay * 2, .2)
+    finally:
+        for fd in pidfds:
+            os.close(fd)
+    return set(pid for pid in pids if _alive(pid))
+
+def wait(pids, timeout=None):
+    """ Wait until the processes have exited, at most timeout seconds if
+        given. Returns the set of pids still alive. """
+    deadline = time.monotonic() + (timeout if timeout is not None else float("inf"))
+    return _wait(pids, deadline)
+
+def _signal(pids, signum):
+    for pid in pids:
+        try:
+            os.kill(pid, signum)
+        except OSError:
+            pass
+
+def terminate(pids, timeout=5.0):
+    """ Send SIGTERM to all pids at once, wait up to timeout seconds for
+        them to exit and SIGKILL the survivors. Returns the set of pids
+        which are still alive afterwards. """
+    pids = set(pids)
+    if not pids:
+        return set()
+    _signal(pids, signal.SIGTERM)
+    survivors = _wait(pids, time.monotonic() + timeout)
+    if survivors:
+        _signal(survivors, signal.SIGKILL)
+        survivors = _wait(survivors, time.monotonic() + 1.0)
+    return survivors
+
+def _kernel_thread(pid):
+    try:
+        with open("/proc/%d/stat" % pid, 'r') as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        return bool(int(fields[6]) & PF_KTHREAD)
+    except (OSError, IndexError, ValueError):
+        return False
+
+def _process_files(pid, device, prefix, exclude):
+    """ Return (path, pid, name) for every file of one process which lies
+        on the given device below prefix, skipping excluded paths. Returns
+        None if the process may not be inspected. """
+    candidates = []
+    base = "/proc/%d" % pid
+    for link in ("cwd", "root"):
+        candidates.append(os.path.join(base, link))
+    try:
+        candidates.extend(os.path.join(base, "fd", fd) for fd in os.listdir(base + "/fd"))
+    except PermissionError:
+        # Not ours
+        return None
+    except OSError:
+        # Process gone
+        return []
+    found = set()
+    for candidate in candidates:
+        try:
+            if os.stat(candidate).st_dev != device:
+                continue
+            path = os.readlink(candidate)
+        except OSError:
+            continue
+        found.add(path)
+    try:
+        with open(base + "/maps", 'r') as maps:
+            for line in maps:
+                fields = line.split(None, 5)
+                if len(fields) == 6 and fields[5].startswith(prefix):
+                    found.add(fields[5].rstrip('\n'))
+    except OSError:
+        pass
+    found = [path for path in found
+             if (path == prefix[:-1] or path.startswith(prefix)) and
+             not path.startswith(exclude)]
+    if not found:
+        return []
+    name = _comm(pid)
+    return [(path, pid, name) for path in sorted(found)]
+
+def scan(mountpoint, pids, exclude=()):
+    """ Return a list of (path, pid, process name) of the files, working
+        directories and mapped files of the given processes which lie on
+        the filesystem mounted at mountpoint, and a list of the pids which
+        could not be inspected. exclude lists paths relative to the
+        mountpoint which are ignored, along with everything below them. """
+    mountpoint = mountpoint.rstrip('/')
+    device = os.stat(mountpoint).st_dev
+    prefix = mountpoint + '/'
+    exclude = tuple(prefix + path.strip('/') for path in exclude)
+    result = []
+    denied = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as pool:
+        jobs = [(pid, pool.submit(_process_files, pid, device, prefix, exclude))
+                for pid in pids]
+        for pid, job in jobs:
+            files = job.result()
+            if files is None:
+                denied.append(pid)
+            else:
+                result.extend(files)
+    return result, denied
+
+def _sudo_open_files(mountpoint, pids, exclude):
+    """ Return one open file for each process of other users holding any,
+        listed by HELPER through sudo. Kernel threads, which hold no files,
+        are left out. """
+    pids = [pid for pid in pids if not _kernel_thread(pid)]
+    if not pids or not os.path.exists(HELPER):
+        return []
+    out = extvolrun.run(["/usr/bin/sudo", "-n", HELPER, mountpoint] + [str(p) for p in pids],
+                        stdout=extvolrun.PIPE, universal_newlines=True).stdout
+    prefix = mountpoint.rstrip('/') + '/'
+    exclude = tuple(prefix + path.strip('/') for path in exclude)
+    result = []
+    for line in out.splitlines():
+        try:
+            path, pid, name = json.loads(line)
+        except ValueError:
+            continue
+        if not path.startswith(exclude):
+            result.append((path, pid, name))
+    return result
+
+def open_files(mountpoint, exclude=(), sudo=False):
+    """ Return a list of (path, pid, process name) of the files, working
+        directories and mapped files of all processes which lie on the
+        filesystem mounted at mountpoint, see scan(). Processes of other
+        users are only looked at with sudo given, through HELPER, which
+        names one file of each. """
+    result, denied = scan(mountpoint, [pid for pid in _pids() if pid != os.getpid()], exclude)
+    if sudo and denied:
+        result.extend(_sudo_open_files(mountpoint, denied, exclude))
+    return result
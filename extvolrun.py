@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Run external commands on a shared asyncio loop, with timeouts, a cap on
+    the number of commands running at once and per-program latency stats """
+
+import os
+import time
+import syslog
+import threading
+import subprocess
+import extvollazy
+import extvoltrace
+
+# asyncio takes a while to import and is not needed before the first command
+asyncio = extvollazy.LazyModule("asyncio")
+
+# Commands running at the same time
+MAX_CONCURRENT = 4
+# Seconds a command may take unless the caller says otherwise
+DEFAULT_TIMEOUT = 60
+
+PIPE = subprocess.PIPE
+DEVNULL = subprocess.DEVNULL
+STDOUT = subprocess.STDOUT
+
+class CommandRunner(object):
+    """ Owns an asyncio loop in a background thread which runs all commands.
+        submit() returns a concurrent.futures.Future, so callers can start
+        several commands and wait for them together; run() waits for one. """
+    def __init__(self, max_concurrent=MAX_CONCURRENT):
+        self.max_concurrent = max_concurrent
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._loop = None
+        self._semaphore = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                ready = threading.Event()
+                thread = threading.Thread(target=self._serve, args=(ready,),
+                                          name="extvolrun", daemon=True)
+                thread.start()
+                ready.wait()
+            return self._loop
+
+    def _serve(self, ready):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        ready.set()
+        self._loop.run_forever()
+
+    def _account(self, program, seconds, returncode, timed_out):
+        with self._stats_lock:
+            stats = self._stats.setdefault(program, {"calls": 0, "total": 0.0, "max": 0.0,
+                                                     "failures": 0, "timeouts": 0})
+            stats["calls"] += 1
+            stats["total"] += seconds
+            stats["max"] = max(stats["max"], seconds)
+            if returncode != 0:
+                stats["failures"] += 1
+            if timed_out:
+                stats["timeouts"] += 1
+
+    async def _run(self, args, input, stdout, stderr, universal_newlines, timeout, check):
+        program = os.path.basename(args[0])
+        if isinstance(input, str):
+            input = input.encode("utf-8")
+        async with self._semaphore:
+            with extvoltrace.span(program, "command", argv=list(args)) as span:
+                start = time.monotonic()
+                timed_out = False
+                try:
+                    proc = await asyncio.create_subprocess_exec(
+                        *args, stdin=PIPE if input is not None else None,
+                        stdout=stdout, stderr=stderr)
+                except OSError:
+                    self._account(program, time.monotonic() - start, 127, False)
+                    span.status = "error"
+                    raise
+                try:
+                    out, err = await asyncio.wait_for(proc.communicate(input), timeout)
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    syslog.syslog(syslog.LOG_ERR, "%s did not finish within %ss, killing it" % \
+                                  (program, timeout))
+                    proc.kill()
+                    out, err = await proc.communicate()
+                span.status = "timeout" if timed_out else proc.returncode
+                self._account(program, time.monotonic() - start, proc.returncode, timed_out)
+        if universal_newlines:
+            out = out.decode("utf-8", "replace") if out is not None else None
+            err = err.decode("utf-8", "replace") if err is not None else None
+        if timed_out and check:
+            raise subprocess.TimeoutExpired(args, timeout, out, err)
+        result = subprocess.CompletedProcess(args, proc.returncode, out, err)
+        if check:
+            result.check_returncode()
+        return result
+
+    def submit(self, args, input=None, stdout=None, stderr=None,
+               universal_newlines=False, timeout=DEFAULT_TIMEOUT, check=False):
+        """ Start a command and return a future for its CompletedProcess.
+            stdout and stderr take PIPE, DEVNULL, STDOUT or None like
+            subprocess.run(). A command running longer than timeout seconds
+            (None: no limit) is killed. """
+        loop = self._start()
+        return asyncio.run_coroutine_threadsafe(
+            self._run(list(args), input, stdout, stderr, universal_newlines, timeout, check),
+            loop)
+
+    def run(self, args, **kwargs):
+        """ Run a command and wait for its CompletedProcess, see submit() """
+        return self.submit(args, **kwargs).result()
+
+    def stats(self):
+        """ Return a dict of per-program call counts and latencies """
+        with self._stats_lock:
+            return dict((program, dict(values)) for program, values in self._stats.items())
+
+_runner = None
+_runner_lock = threading.Lock()
+
+def runner():
+    """ Return the command runner shared by everything in this process """
+    global _runner
+    with _runner_lock:
+        if _runner is None:
+            _runner = CommandRunner()
+        return _runner
+
+def run(args, **kwargs):
+    """ Run a command on the shared runner and wait for it """
+    return runner().run(args, **kwargs)
+
+def submit(args, **kwargs):
+    """ Start a command on the shared runner, return a future """
+    return runner().submit(args, **kwargs)
+
+def spawn(args):
+    """ Start a long running program (a daemon or an application) in its own
+        session, without waiting for it """
+    with extvoltrace.span(os.path.basename(args[0]), "command", argv=list(args), spawn=True):
+        return subprocess.Popen(args, start_new_session=True,
+                                stdin=DEVNULL, stdout=DEVNULL, stderr=DEVNULL)
+
+def log_stats():
+    """ Write the per-program latency stats to syslog """
+    for program, stats in sorted(runner().stats().items()):
+        syslog.syslog(syslog.LOG_DEBUG, "%s: %d calls, %.2fs total, %.2fs max, "
+                      "%d failed, %d timed out" % \
+                      (program, stats["calls"], stats["total"], stats["max"],
+                       stats["failures"], stats["timeouts"]))
@@ -0,0 +1,452 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Save and restore the dconf and GConf settings kept on extended volumes """
+
+import hashlib
+import os
+import syslog
+import subprocess
+import threading
+import xml.etree.ElementTree as ET
+import extvollazy
+import extvolrun
+import extvoltrace
+
+GLib = extvollazy.LazyModule("gi.repository", "GLib")
+Gio = extvollazy.LazyModule("gi.repository", "Gio")
+
+DCONF = "/usr/bin/dconf"
+GCONFTOOL = "/usr/bin/gconftool-2"
+# Whether settings are accessed through Gio, None to use it if its bindings
+# can be loaded
+USE_GIO = None
+
+def dump_path(mountpoint, key, backend):
+    """ Return the name of the dump file for a settings key. backend is
+        either "dconf" or "gconf". """
+    name = key.rstrip('/').rsplit('/', 1)[1]
+    if backend == "gconf":
+        return "%s/.%s-backup.xml.dump" % (mountpoint, name)
+    return "%s/.%s-backup.txt.dump" % (mountpoint, name)
+
+_gio_lock = threading.Lock()
+
+def _inprocess():
+    """ Return True if settings can be accessed through Gio, which is
+        imported on the first call """
+    global USE_GIO
+    with _gio_lock:
+        if USE_GIO is None:
+            try:
+                Gio.Settings
+            except (ImportError, ValueError, AttributeError):
+                USE_GIO = False
+            else:
+                USE_GIO = True
+        return USE_GIO
+
+_schema_lock = threading.Lock()
+_schema_paths = None
+
+def _schemas():
+    """ Return a dict mapping dconf directories (without trailing slash) to
+        the installed, non-relocatable GSettings schema stored there. """
+    global _schema_paths
+    with _schema_lock:
+        if _schema_paths is None:
+            source = Gio.SettingsSchemaSource.get_default()
+            _schema_paths = {}
+            if source is not None:
+                for schema_id in source.list_schemas(True)[0]:
+                    schema = source.lookup(schema_id, True)
+                    if schema is not None and schema.get_path():
+                        _schema_paths[schema.get_path().rstrip('/')] = schema
+        return _schema_paths
+
+def _lookup_schema(schema_id):
+    if not _inprocess():
+        return None
+    source = Gio.SettingsSchemaSource.get_default()
+    if source is None:
+        return None
+    return source.lookup(schema_id, True)
+
+def _parse_keyfile(text):
+    """ Parse a dconf dump into a list of (section, [(key, value), ...]) """
+    sections = []
+    for line in text.splitlines():
+        if line.startswith('[') and line.rstrip().endswith(']'):
+            sections.append((line.strip()[1:-1].strip('/'), []))
+        elif '=' in line and sections:
+            key, value = line.split('=', 1)
+            sections[-1][1].append((key.strip(), value.strip()))
+    return sections
+
+def covered(key):
+    """ Return True if a dconf key is the directory of an installed,
+        non-relocatable schema with no further schemas below it, so that
+        reading that schema through Gio sees every value under the key. """
+    key = key.rstrip('/')
+    schemas = _schemas()
+    return key in schemas and not any(path.startswith(key + '/') for path in schemas)
+
+def dump_dconf(keys):
+    """ Read the user values of the schemas of the given dconf keys, which
+        have to be covered(), through Gio and return them in "dconf dump"
+        format, as a dict mapping keys to dump text. """
+    dumps = {}
+    schemas = _schemas()
+    for key in keys:
+        schema = schemas[key]
+        settings = Gio.Settings.new_full(schema, None, None)
+        lines = []
+        for name in sorted(schema.list_keys()):
+            value = settings.get_user_value(name)
+            if value is not None:
+                # With type annotations, as "dconf dump" prints them
+                lines.append("%s=%s" % (name, value.print_(True)))
+        dumps[key] = '[/]\n' + '\n'.join(lines) + '\n' if lines else ''
+    return dumps
+
+def load_dconf(text):
+    """ Write the values of a dconf dump rooted at / through Gio. Values
+        typed by the installed schemas are stored directly; the remaining
+        lines are returned as a dump for "dconf load /". """
+    schemas = _schemas()
+    leftover = []
+    for section, values in _parse_keyfile(text):
+        schema = schemas.get('/' + section)
+        settings = Gio.Settings.new_full(schema, None, None) if schema else None
+        unknown = []
+        for name, value in values:
+            try:
+                if settings is None or not schema.has_key(name):
+                    raise KeyError(name)
+                vtype = schema.get_key(name).get_value_type()
+                settings.set_value(name, GLib.Variant.parse(vtype, value, None, None))
+            except:
+                unknown.append("%s=%s" % (name, value))
+        if unknown:
+            leftover.append('\n[%s]' % (section or '/'))
+            leftover.extend(unknown)
+    Gio.Settings.sync()
+    return '\n'.join(leftover).lstrip('\n') + '\n' if leftover else ''
+
+def reset_dconf(key):
+    """ Reset all keys of the schemas below a dconf directory """
+    key = key.rstrip('/')
+    if not _inprocess():
+        extvolrun.run([DCONF, "reset", "-f", key + '/'])
+        return
+    for path, schema in _schemas().items():
+        if path == key or path.startswith(key + '/'):
+            settings = Gio.Settings.new_full(schema, None, None)
+            for name in schema.list_keys():
+                settings.reset(name)
+    Gio.Settings.sync()
+
+def strv_add(schema_id, key, item):
+    """ Add item to a string list setting unless it is already there.
+        Returns False if the schema is not installed. """
+    schema = _lookup_schema(schema_id)
+    if schema is None or not schema.has_key(key):
+        syslog.syslog(syslog.LOG_DEBUG, "No setting %s %s" % (schema_id, key))
+        return False
+    settings = Gio.Settings.new_full(schema, None, None)
+    items = settings.get_strv(key)
+    if item not in items:
+        settings.set_strv(key, items + [item])
+        Gio.Settings.sync()
+    return True
+
+def strv_remove(schema_id, key, item):
+    """ Remove item from a string list setting. Returns False if the schema
+        is not installed. """
+    schema = _lookup_schema(schema_id)
+    if schema is None or not schema.has_key(key):
+        syslog.syslog(syslog.LOG_DEBUG, "No setting %s %s" % (schema_id, key))
+        return False
+    settings = Gio.Settings.new_full(schema, None, None)
+    items = settings.get_strv(key)
+    if item in items:
+        settings.set_strv(key, [i for i in items if i != item])
+        Gio.Settings.sync()
+    return True
+
+class DconfWatch(object):
+    """ Calls callback(key) on the main loop whenever a setting below one of
+        the given dconf keys changes. "dconf watch /" reports every path,
+        including those without a schema or with a relocatable one. If it
+        cannot be started, only the keys covered() by a schema are watched
+        through Gio, and unwatched lists the others. """
+    def __init__(self, keys, callback):
+        self.keys = tuple(keys)
+        self.callback = callback
+        self.unwatched = ()
+        self._keys = dict((key.rstrip('/'), key) for key in self.keys)
+        self._settings = []
+        self._pending = b""
+        self._source = None
+        try:
+            self._process = subprocess.Popen([DCONF, "watch", "/"], stdin=subprocess.DEVNULL,
+                                             stdout=subprocess.PIPE)
+        except OSError as error:
+            syslog.syslog(syslog.LOG_ERR, "Could not watch dconf: %s" % error)
+            self._process = None
+            self._watch_schemas()
+        else:
+            self._source = GLib.io_add_watch(self._process.stdout.fileno(),
+                                             GLib.PRIORITY_DEFAULT,
+                                             GLib.IO_IN | GLib.IO_HUP, self._read)
+
+    def _watch_schemas(self):
+        if not _inprocess():
+            self.unwatched = self.keys
+            return
+        for path, schema in _schemas().items():
+            key = _owner(path, self._keys)
+            if key is None:
+                continue
+            settings = Gio.Settings.new_full(schema, None, None)
+            settings.connect("changed",
+                             lambda settings, name, key=self._keys[key]: self.callback(key))
+            self._settings.append(settings)
+        self.unwatched = tuple(key for key in self.keys if not covered(key))
+
+    def _read(self, fd, condition):
+        """ Pass the changed paths on, each followed by its new value """
+        data = os.read(fd, 65536)
+        if not data:
+            syslog.syslog(syslog.LOG_ERR, "dconf watch exited, watching through Gio")
+            self.close()
+            self._watch_schemas()
+            return False
+        lines = (self._pending + data).split(b"\n")
+        self._pending = lines.pop()
+        for line in lines:
+            if line.startswith(b"/"):
+                key = _owner(line.decode("utf-8", "replace").rstrip("/"), self._keys)
+                if key is not None:
+                    self.callback(self._keys[key])
+        return True
+
+    def close(self):
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+            self._process.stdout.close()
+            self._process = None
+        self._settings = []
+
+def write_atomic(path, text):
+    """ Replace the file at path with text (str or bytes) without ever
+        leaving a partly written file behind. """
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    try:
+        with open(tmp, 'wb' if isinstance(text, bytes) else 'w') as tmpfile:
+            tmpfile.write(text)
+            tmpfile.flush()
+            os.fsync(tmpfile.fileno())
+        os.replace(tmp, path)
+    except:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+def _owner(path, keys):
+    """ Return the longest key which path lies under, or None """
+    best = None
+    for key in keys:
+        if path == key or path.startswith(key + '/'):
+            if best is None or len(key) > len(best):
+                best = key
+    return best
+
+def split_dconf_dump(text, keys):
+    """ Split the output of "dconf dump /" into one dump per key. Section
+        names are made relative to the key, just like "dconf dump key/"
+        would print them. Returns a dict mapping keys to dump text. """
+    parts = dict((key, []) for key in keys)
+    current = None
+    for line in text.splitlines():
+        if line.startswith('[') and line.rstrip().endswith(']'):
+            section = line.strip()[1:-1].strip('/')
+            current = _owner('/' + section, keys)
+            if current is not None:
+                relative = section[len(current):].strip('/') or '/'
+                if parts[current]:
+                    parts[current].append('')
+                parts[current].append('[%s]' % relative)
+        elif current is not None and line.strip():
+            parts[current].append(line)
+    return dict((key, '\n'.join(lines) + '\n' if lines else '')
+                for key, lines in parts.items())
+
+def merge_dconf_dumps(dumps):
+    """ Merge per-key dumps (a dict mapping keys to dump text) into a single
+        keyfile which can be fed to "dconf load /". """
+    merged = []
+    for key, text in dumps.items():
+        base = key.strip('/')
+        for line in text.splitlines():
+            if line.startswith('[') and line.rstrip().endswith(']'):
+                section = line.strip()[1:-1].strip('/')
+                merged.append('')
+                merged.append('[%s]' % '/'.join(s for s in (base, section) if s))
+            elif line.strip():
+                merged.append(line)
+    return '\n'.join(merged).lstrip('\n') + '\n'
+
+def split_gconf_dump(text, keys):
+    """ Split a GConf entry file containing one entrylist per key into one
+        entry file per key. Returns a dict mapping keys to XML text. """
+    parts = {}
+    root = ET.fromstring(text) if text.strip() else ET.Element("gconfentryfile")
+    for entrylist in root.findall("entrylist"):
+        base = entrylist.get("base", "").rstrip('/')
+        for entry in entrylist.findall("entry"):
+            path = base + '/' + entry.findtext("key", "")
+            key = _owner(path, keys)
+            if key is None:
+                continue
+            entry.find("key").text = path[len(key):].lstrip('/')
+            parts.setdefault(key, []).append(entry)
+    dumps = {}
+    for key in keys:
+        doc = ET.Element("gconfentryfile")
+        entrylist = ET.SubElement(doc, "entrylist", base=key)
+        entrylist.extend(parts.get(key, []))
+        dumps[key] = ET.tostring(doc, encoding="unicode") + '\n'
+    return dumps
+
+def merge_gconf_dumps(dumps):
+    """ Merge per-key GConf entry files into one with an entrylist each """
+    doc = ET.Element("gconfentryfile")
+    for text in dumps.values():
+        try:
+            doc.extend(ET.fromstring(text).findall("entrylist"))
+        except ET.ParseError:
+            syslog.syslog(syslog.LOG_ERR, "Skipping unreadable GConf dump")
+    return ET.tostring(doc, encoding="unicode") + '\n'
+
+def _tool_dump(args):
+    """ Return what a dump tool printed, or None if it failed: it could not
+        be run, exited with an error or printed nothing at all """
+    try:
+        result = extvolrun.run(args, stdout=extvolrun.PIPE, universal_newlines=True)
+    except OSError as error:
+        syslog.syslog(syslog.LOG_ERR, "Could not run %s: %s" % (args[0], error))
+        return None
+    if result.returncode != 0 or not result.stdout.strip():
+        syslog.syslog(syslog.LOG_ERR, "%s failed with status %d, keeping the dumps" % \
+                      (args[0], result.returncode))
+        return None
+    return result.stdout
+
+class SettingsBatch(object):
+    """ Loads or saves all settings of one open, close or dump cycle with a
+        single dconf and a single gconftool-2 call, splitting and merging
+        the per-key dump files on the volume by key prefix. Dump files are
+        only rewritten when their content changed, and left as they are
+        when the dump tool failed. exists tells whether a dump file is
+        there, e.g. from the volume's manifest. """
+    def __init__(self, mountpoint, dconf=(), gconf=(), exists=os.path.exists):
+        self.mountpoint = mountpoint
+        self._exists = exists
+        self.dconf = tuple(sorted(set(k.rstrip('/') for k in dconf)))
+        self.gconf = tuple(sorted(set(k.rstrip('/') for k in gconf)))
+        self._hashes = {}
+
+    def _read_dumps(self, keys, backend):
+        dumps = {}
+        for key in keys:
+            path = dump_path(self.mountpoint, key, backend)
+            if self._exists(path):
+                with open(path, 'r') as dumpfile:
+                    dumps[key] = dumpfile.read()
+        return dumps
+
+    def _write_dumps(self, dumps, backend):
+        """ Write the dumps whose content differs from the file on the
+            volume, return the number of files written. """
+        written = 0
+        for key, text in dumps.items():
+            path = dump_path(self.mountpoint, key, backend)
+            digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+            if path not in self._hashes and os.path.exists(path):
+                with open(path, 'rb') as dumpfile:
+                    self._hashes[path] = hashlib.sha1(dumpfile.read()).hexdigest()
+            if self._hashes.get(path) == digest:
+                continue
+            write_atomic(path, text)
+            self._hashes[path] = digest
+            written += 1
+        return written
+
+    def dump_dconf(self, keys=None):
+        """ Return the current dconf settings as a dict of per-key dumps """
+        keys = self.dconf if keys is None else keys
+        if not keys:
+            return {}
+        inprocess = [key for key in keys if _inprocess() and covered(key)]
+        dumps = dump_dconf(inprocess) if inprocess else {}
+        # Keys without a schema of their own, or with relocatable schemas
+        # below them, are only seen by dconf itself
+        rest = [key for key in keys if key not in dumps]
+        if rest:
+            out = _tool_dump([DCONF, "dump", "/"])
+            if out is not None:
+                dumps.update(split_dconf_dump(out, rest))
+        return dumps
+
+    def dump_gconf(self):
+        """ Return the current GConf settings as a dict of per-key dumps """
+        if not self.gconf:
+            return {}
+        out = _tool_dump([GCONFTOOL, "--dump"] + list(self.gconf))
+        if out is None:
+            return {}
+        return split_gconf_dump(out, self.gconf)
+
+    def save_dconf(self, keys=None):
+        """ Write the dump files of the given (default: all) dconf keys """
+        return self._write_dumps(self.dump_dconf(keys), "dconf")
+
+    def save_gconf(self):
+        """ Write the dump files of all GConf keys """
+        return self._write_dumps(self.dump_gconf(), "gconf")
+
+    def save(self):
+        """ Write the dump files of all keys to the volume """
+        syslog.syslog(syslog.LOG_DEBUG, "Saving settings of %d dconf and %d GConf keys" % \
+                      (len(self.dconf), len(self.gconf)))
+        with extvoltrace.span("save settings", "settings") as s:
+            s.args["written"] = self.save_dconf() + self.save_gconf()
+            return s.args["written"]
+
+    def load(self):
+        """ Load the dump files found on the volume """
+        with extvoltrace.span("load settings", "settings"):
+            self._load()
+
+    def _load(self):
+        # dconf and GConf are independent, so both loads run at the same time
+        pending = []
+        dumps = self._read_dumps(self.dconf, "dconf")
+        if dumps:
+            syslog.syslog(syslog.LOG_DEBUG, "Loading DConf keys %s" % ", ".join(sorted(dumps)))
+            merged = merge_dconf_dumps(dumps)
+            if _inprocess():
+                merged = load_dconf(merged)
+            if merged:
+                pending.append(extvolrun.submit([DCONF, "load", "/"], input=merged))
+        dumps = self._read_dumps(self.gconf, "gconf")
+        if dumps:
+            syslog.syslog(syslog.LOG_DEBUG, "Loading GConf keys %s" % ", ".join(sorted(dumps)))
+            pending.append(extvolrun.submit([GCONFTOOL, "--load", "/dev/stdin"],
+                                            input=merge_gconf_dumps(dumps)))
+        for future in pending:
+            future.result()
@@ -0,0 +1,161 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" State of the extended volumes open in a session. Every open volume has
+    a directory ~/.extended-volumes/<id>/, named after its mountpoint, which
+    holds the journal of its links, the dirty set of its dumper and its
+    traces. The profiles are assigned to the open volumes in claims.json,
+    which is only changed under a lock, so volumes can be opened and
+    closed concurrently.
+"""
+
+import os
+import json
+import fcntl
+import shutil
+import urllib.parse
+import contextlib
+import extvolsettings
+
+ROOT = ".extended-volumes"
+CLAIMS = "claims.json"
+MOUNTPOINT = "mountpoint"
+# The profiles other volumes took over from a volume
+HANDED_OVER = "handed-over.json"
+
+def root():
+    return os.path.join(os.environ["HOME"], ROOT)
+
+def volume_id(mountpoint):
+    """ Return the name of the state directory of mountpoint """
+    return urllib.parse.quote(mountpoint.rstrip('/'), safe='')
+
+class VolumeState(object):
+    """ The state directory of one volume """
+    def __init__(self, mountpoint):
+        self.mountpoint = mountpoint.rstrip('/')
+        self.id = volume_id(self.mountpoint)
+        self.path = os.path.join(root(), self.id)
+
+    def path_of(self, name):
+        return os.path.join(self.path, name)
+
+    def exists(self):
+        """ Return True if the volume is open (or was, when a session crashed) """
+        return os.path.exists(self.path_of(MOUNTPOINT))
+
+    def handed_over(self):
+        """ Return the names of the profiles other volumes took over """
+        try:
+            with open(self.path_of(HANDED_OVER), 'r') as names:
+                return set(json.load(names))
+        except (OSError, ValueError, TypeError):
+            return set()
+
+    def create(self):
+        os.makedirs(self.path, mode=0o700, exist_ok=True)
+        extvolsettings.write_atomic(self.path_of(MOUNTPOINT), self.mountpoint)
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def __repr__(self):
+        return "<VolumeState %s>" % self.mountpoint
+
+def open_volumes():
+    """ Return the VolumeState of every volume with a state directory """
+    volumes = []
+    try:
+        entries = list(os.scandir(root()))
+    except FileNotFoundError:
+        return volumes
+    for entry in entries:
+        try:
+            with open(os.path.join(entry.path, MOUNTPOINT), 'r') as marker:
+                volumes.append(VolumeState(marker.read().strip()))
+        except (OSError, NotADirectoryError):
+            pass
+    return volumes
+
+@contextlib.contextmanager
+def _locked():
+    """ Hold the lock of the claims, yield them as a dict mapping profile
+        names to {"volume": id, "provided": bool}, and write them back """
+    os.makedirs(root(), mode=0o700, exist_ok=True)
+    with open(os.path.join(root(), ".lock"), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        path = os.path.join(root(), CLAIMS)
+        try:
+            with open(path, 'r') as claims:
+                claims = json.load(claims)
+        except (OSError, ValueError):
+            claims = {}
+        # Written by an older version: a plain volume id
+        claims = dict((name, owner if isinstance(owner, dict) else
+                       {"volume": owner, "provided": True})
+                      for name, owner in claims.items())
+        before = json.dumps(claims, sort_keys=True)
+        yield claims
+        if json.dumps(claims, sort_keys=True) != before:
+            extvolsettings.write_atomic(path, json.dumps(claims, indent=1, sort_keys=True))
+
+def claim(state, profiles, provides, pinned=()):
+    """ Assign profiles to the volume. provides(profile) tells whether the
+        volume holds the data of a profile.
+
+        A profile the volume provides is claimed if no other volume holds
+        it, or taken over if the volume holding it does not provide it. A
+        profile no open volume provides is claimed as well, so a volume
+        opened on its own still takes all of them, and is handed to the
+        next volume opened which provides it. Profiles named in pinned are
+        never taken over, they stay with their volume until it is closed.
+        Claims of volumes whose state is gone are dropped.
+
+        Returns the names of the profiles the volume holds, the names of
+        those it provides, and a dict mapping the ids of other volumes to
+        the names of the profiles taken over from them. The caller has to
+        close those on the other volumes before opening them here. """
+    with _locked() as claims:
+        others = dict((v.id, v) for v in open_volumes() if v.id != state.id)
+        for name, owner in list(claims.items()):
+            if owner["volume"] != state.id and owner["volume"] not in others:
+                del claims[name]
+        taken = {}
+        for profile in profiles:
+            owner = claims.get(profile.name)
+            if owner is not None and owner["volume"] == state.id:
+                continue
+            if provides(profile):
+                if owner is not None:
+                    if owner["provided"] or profile.name in pinned:
+                        continue
+                    taken.setdefault(owner["volume"], set()).add(profile.name)
+                claims[profile.name] = {"volume": state.id, "provided": True}
+            elif owner is None:
+                claims[profile.name] = {"volume": state.id, "provided": False}
+        for volume_id, names in taken.items():
+            other = others[volume_id]
+            extvolsettings.write_atomic(other.path_of(HANDED_OVER),
+                                        json.dumps(sorted(other.handed_over() | names)))
+        held = set(name for name, owner in claims.items() if owner["volume"] == state.id)
+        provided = set(name for name in held if claims[name]["provided"])
+        return held, provided, taken
+
+def claimed(state):
+    """ Return the names of the profiles the volume holds """
+    with _locked() as claims:
+        return set(name for name, owner in claims.items() if owner["volume"] == state.id)
+
+def fallbacks(state):
+    """ Return the names of the profiles the volume holds without providing
+        them, or held that way until another volume took them over """
+    with _locked() as claims:
+        return state.handed_over() | set(name for name, owner in claims.items()
+                                         if owner["volume"] == state.id and
+                                         not owner["provided"])
+
+def release(state):
+    """ Give up all profiles the volume holds """
+    with _locked() as claims:
+        for name, owner in list(claims.items()):
+            if owner["volume"] == state.id:
+                del claims[name]
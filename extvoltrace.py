@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Lightweight tracing of the steps of opening and closing a volume. The
+    spans are written in Chrome's trace event format, which chrome://tracing
+    and Perfetto can load. """
+
+import os
+import json
+import time
+import syslog
+import threading
+import collections
+
+# Spans kept at most; long running processes which never write a trace,
+# like the GConf dumper, only keep the newest
+MAX_EVENTS = 10000
+
+_lock = threading.Lock()
+_events = collections.deque(maxlen=MAX_EVENTS)
+_threads = {}
+
+def _now():
+    """ Microseconds on the monotonic clock, as trace events want them """
+    return int(time.monotonic() * 1000000)
+
+def _thread_id():
+    thread = threading.current_thread()
+    tid = getattr(threading, "get_native_id", threading.get_ident)()
+    if tid not in _threads:
+        _threads[tid] = thread.name
+    return tid
+
+class span(object):
+    """ Records the time spent in a with block as one trace event. Set
+        status to the exit code of a command, or leave it to be "ok" or the
+        name of the exception which left the block. """
+    def __init__(self, name, cat="step", **args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.status = None
+
+    def __enter__(self):
+        self.start = _now()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        end = _now()
+        if self.status is None:
+            self.status = "ok" if exc_type is None else exc_type.__name__
+        args = dict(self.args)
+        args["status"] = self.status
+        with _lock:
+            _events.append({"name": self.name, "cat": self.cat, "ph": "X",
+                            "ts": self.start, "dur": end - self.start,
+                            "pid": os.getpid(), "tid": _thread_id(), "args": args})
+        return False
+
+def reset():
+    """ Forget all recorded spans """
+    with _lock:
+        _events.clear()
+
+def events():
+    """ Return the recorded spans plus thread name metadata """
+    with _lock:
+        meta = [{"name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": tid,
+                 "args": {"name": name}} for tid, name in _threads.items()]
+        return meta + sorted(_events, key=lambda e: e["ts"])
+
+def write(path):
+    """ Write the recorded spans as a Chrome trace file """
+    try:
+        with open(path, 'w') as tracefile:
+            json.dump({"traceEvents": events(), "displayTimeUnit": "ms"}, tracefile)
+    except OSError:
+        syslog.syslog(syslog.LOG_DEBUG, "Could not write trace to %s" % path)
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Find the VirtualBox machines of an extended volume by reading the
+    machine registry in .VirtualBox/VirtualBox.xml, without starting
+    VBoxSVC. The XML files are read with a streaming parser which stops as
+    soon as it has what it needs. """
+
+import os
+import syslog
+import xml.etree.ElementTree as ET
+import extvollazy
+
+vboxapi = extvollazy.LazyModule("vboxapi")
+
+REGISTRY = os.path.join(".VirtualBox", "VirtualBox.xml")
+
+def _tag(element):
+    """ Return the tag of element without its namespace """
+    return element.tag.rsplit('}', 1)[-1]
+
+def _machine_name(path):
+    """ Return the name in the <Machine> element of a .vbox file, or None """
+    try:
+        with open(path, 'rb') as machine:
+            for event, element in ET.iterparse(machine, events=("start",)):
+                if _tag(element) == "Machine":
+                    return element.get("name")
+    except (OSError, ET.ParseError) as error:
+        syslog.syslog(syslog.LOG_DEBUG, "Could not read %s: %s" % (path, error))
+    return None
+
+def _registry_entries(registry):
+    """ Return the (uuid, src) of the <MachineEntry> elements of registry """
+    entries = []
+    with open(registry, 'rb') as registry_file:
+        for event, element in ET.iterparse(registry_file, events=("start", "end")):
+            tag = _tag(element)
+            if event == "start" and tag == "MachineEntry":
+                entries.append((element.get("uuid", "").strip("{}"), element.get("src")))
+            elif event == "end" and tag == "MachineRegistry":
+                break
+            elif event == "end":
+                element.clear()
+    return entries
+
+def machines(mountpoint):
+    """ Return a list of (name, uuid) of the machines registered on the
+        volume. Returns None if there is no registry to read, [] if it
+        lists no machines. """
+    registry = os.path.join(mountpoint, REGISTRY)
+    try:
+        entries = _registry_entries(registry)
+    except FileNotFoundError:
+        return None
+    except (OSError, ET.ParseError) as error:
+        syslog.syslog(syslog.LOG_ERR, "Could not read %s: %s" % (registry, error))
+        return None
+    found = []
+    for uuid, src in entries:
+        if not src:
+            continue
+        path = src if os.path.isabs(src) else os.path.join(os.path.dirname(registry), src)
+        name = _machine_name(path) or os.path.splitext(os.path.basename(src))[0]
+        found.append((name, uuid))
+    return found
+
+def api_machines():
+    """ Return a list of (name, uuid) of the machines, asking VBoxSVC """
+    mgr = vboxapi.VirtualBoxManager(None, None)
+    return [(vm.name, vm.id) for vm in mgr.getArray(mgr.vbox, 'machines')]
@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Track which paths on an extended volume changed since its last
+    snapshot, using inotify, so that snapshots can run while the volume is
+    idle and closing only has to snapshot what changed after that.
+
+    The set of changed ("dirty") paths is handed from the GConf dumper,
+    which watches the volume while it is open, to extvol_close through a
+    file in the state directory of the volume. Whether the volume was
+    snapshotted completely when it was closed the last time is remembered
+    with a token kept both on the volume and in $HOME: if the volume was changed
+    anywhere else in between, or the session crashed, the tokens no longer
+    match and the whole volume counts as changed.
+"""
+
+import os
+import json
+import uuid
+import ctypes
+import errno
+import fnmatch
+import struct
+import syslog
+import extvolsettings
+import extvolstate
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_UNMOUNT = 0x00002000
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+_EVENT = struct.Struct("iIII")
+
+# Names the backup leaves out anyway, as in backintime-config.tmpl
+EXCLUDE_NAMES = ("[Tt]rash*", ".[Tt]rash*", "*.backup*", "*~")
+# Paths which change because of the snapshot itself
+EXCLUDE_PATHS = (".local/share/backintime",)
+# Beyond this many dirty paths the whole volume counts as changed
+MAX_DIRTY = 10000
+# The token on the volume
+STAMP = ".extvol-snapshot"
+# The tokens of the volumes last closed with a complete snapshot
+TOKENS = ".extvol-snapshots.json"
+
+_libc = None
+
+def _inotify():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+    return _libc
+
+def excluded(relpath):
+    """ Return True if changes to relpath do not matter for snapshots """
+    if relpath == STAMP or any(relpath == path or relpath.startswith(path + '/')
+                               for path in EXCLUDE_PATHS):
+        return True
+    return any(fnmatch.fnmatchcase(name, pattern)
+               for name in relpath.split('/') for pattern in EXCLUDE_NAMES)
+
+class Watcher(object):
+    """ Watches the directories of a volume and collects the paths, relative
+        to the mountpoint, which were created, changed, moved or removed. A
+        changed directory stands for everything below it; "" stands for the
+        whole volume, e.g. after the kernel dropped events.
+
+        If trees is given, only the root of the volume, the given trees
+        with everything below them and the directories they are in are
+        watched, as well as the directories created in any of these while
+        watching. Changes deeper inside other directories are not seen.
+        Otherwise every directory is watched. """
+    def __init__(self, mountpoint, trees=None):
+        self.mountpoint = mountpoint.rstrip('/')
+        self.trees = None if trees is None else tuple(tree.strip('/') for tree in trees)
+        self.dirty = set()
+        self.fd = None
+        self._paths = {}
+
+    def fileno(self):
+        return self.fd
+
+    def start(self):
+        """ Add the watches. If there are more than inotify allows, watching
+            stops and the whole volume counts as changed. """
+        libc = _inotify()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            self.fd = None
+            self._give_up(ctypes.get_errno())
+            return
+        if self.trees is None:
+            self._add_tree("")
+        else:
+            parents = set([""])
+            for tree in self.trees:
+                while '/' in tree:
+                    tree = tree.rsplit('/', 1)[0]
+                    parents.add(tree)
+            for parent in sorted(parents):
+                if self.fd is not None and not excluded(parent):
+                    self._add_watch(parent)
+            for tree in self.trees:
+                if self.fd is not None and tree and not excluded(tree):
+                    self._add_tree(tree)
+        if self.fd is not None:
+            syslog.syslog(syslog.LOG_DEBUG, "Watching %d directories on %s" % \
+                          (len(self._paths), self.mountpoint))
+
+    def _give_up(self, error):
+        syslog.syslog(syslog.LOG_WARNING, "Cannot watch %s for changes: %s" % \
+                      (self.mountpoint, os.strerror(error)))
+        self.dirty = {""}
+        self.close()
+
+    def _add_watch(self, relpath):
+        """ Watch one directory, return False if it cannot be watched """
+        directory = os.path.join(self.mountpoint, relpath) if relpath else self.mountpoint
+        wd = _inotify().inotify_add_watch(self.fd, os.fsencode(directory), MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error == errno.ENOSPC:
+                self._give_up(error)
+            # Otherwise gone again, or not a directory after all
+            return False
+        self._paths[wd] = relpath
+        return True
+
+    def _add_tree(self, relpath):
+        top = os.path.join(self.mountpoint, relpath) if relpath else self.mountpoint
+        for directory, dirnames, filenames in os.walk(top):
+            rel = os.path.relpath(directory, self.mountpoint)
+            rel = "" if rel == "." else rel
+            if not self._add_watch(rel):
+                if self.fd is None:
+                    return
+                dirnames[:] = []
+                continue
+            dirnames[:] = [d for d in dirnames
+                           if not excluded(os.path.join(rel, d) if rel else d)]
+
+    def _mark(self, relpath):
+        if "" in self.dirty or excluded(relpath):
+            return
+        self.dirty.add(relpath)
+        if len(self.dirty) > MAX_DIRTY:
+            self.dirty = {""}
+
+    def read(self):
+        """ Read the pending events, return the number of changes seen """
+        if self.fd is None:
+            return 0
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return 0
+        changes = 0
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            name = data[offset + _EVENT.size:offset + _EVENT.size + length].rstrip(b'\0')
+            offset += _EVENT.size + length
+            if mask & IN_Q_OVERFLOW:
+                self.dirty = {""}
+                changes += 1
+                continue
+            if mask & IN_UNMOUNT:
+                self.close()
+                break
+            parent = self._paths.get(wd)
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                continue
+            if parent is None:
+                continue
+            relpath = os.path.join(parent, os.fsdecode(name)) if parent else os.fsdecode(name)
+            self._mark(relpath if name else parent)
+            changes += 1
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO) and not excluded(relpath):
+                self._add_tree(relpath)
+                if self.fd is None:
+                    break
+        return changes
+
+    def take(self):
+        """ Return the dirty paths and start a new, empty set """
+        dirty, self.dirty = self.dirty, set()
+        return dirty
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            self._paths = {}
+
+def state_path(mountpoint):
+    """ Return where the dumper leaves the dirty set for extvol_close """
+    return extvolstate.VolumeState(mountpoint).path_of("dirty")
+
+def write_state(mountpoint, dirty, snapshot_pid=None, paused=False, reloaded=None):
+    """ Record the paths not yet snapshotted and the pid of a snapshot
+        which is still running. The paths that snapshot covers count as
+        dirty, as only its end tells whether it succeeded. paused and
+        reloaded (the time the settings keys were last read again) let
+        gconf-dumper.py -p and -u wait for the dumper. """
+    os.makedirs(os.path.dirname(state_path(mountpoint)), mode=0o700, exist_ok=True)
+    extvolsettings.write_atomic(state_path(mountpoint), json.dumps(
+        {"mountpoint": mountpoint, "dirty": sorted(dirty), "snapshot_pid": snapshot_pid,
+         "paused": paused, "reloaded": reloaded, "pid": os.getpid()}, sort_keys=True))
+
+def read_state(mountpoint):
+    """ Return the state written by the dumper of mountpoint, or None if
+        there is none """
+    try:
+        with open(state_path(mountpoint), 'r') as state:
+            return json.load(state)
+    except (OSError, ValueError):
+        return None
+
+def clear_state(mountpoint):
+    try:
+        os.remove(state_path(mountpoint))
+    except FileNotFoundError:
+        pass
+
+def _tokens_path():
+    return os.path.join(os.environ["HOME"], TOKENS)
+
+def _read_tokens():
+    try:
+        with open(_tokens_path(), 'r') as tokens:
+            return set(json.load(tokens))
+    except (OSError, ValueError, TypeError):
+        return set()
+
+def begin_session(mountpoint):
+    """ Return True if the volume is unchanged since it was last closed
+        here with a complete snapshot. Until it is closed that way again,
+        it counts as changed. """
+    try:
+        with open(os.path.join(mountpoint, STAMP), 'r') as stamp:
+            token = stamp.read().strip()
+    except OSError:
+        return False
+    tokens = _read_tokens()
+    if token not in tokens:
+        return False
+    tokens.discard(token)
+    extvolsettings.write_atomic(_tokens_path(), json.dumps(sorted(tokens)))
+    return True
+
+def end_session(mountpoint, snapshotted):
+    """ Give the volume a new token, and remember it if everything on the
+        volume is in a snapshot """
+    token = uuid.uuid4().hex
+    try:
+        extvolsettings.write_atomic(os.path.join(mountpoint, STAMP), token + '\n')
+    except OSError as error:
+        syslog.syslog(syslog.LOG_ERR, "Could not write %s: %s" % (STAMP, error))
+        return
+    if snapshotted:
+        tokens = _read_tokens()
+        tokens.add(token)
+        extvolsettings.write_atomic(_tokens_path(), json.dumps(sorted(tokens)))
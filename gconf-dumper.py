@@ -2,94 +2,350 @@
 # Encoding: UTF-8
 
 import os
+import json
 import syslog
 import sys
 import time
 import signal
-import subprocess
 import getopt
 import tempfile
 import daemon
 import lockfile
+import extvolprocs
+import extvolsettings
+import extvolstate
+import extvolwatch
+import gi
+from gi.repository import GLib, Gio
 
 target = os.getcwd()
+loop = None
+batch = None
+watched = None
+dirty = set()
+flush_source = None
+first_change = None
+paused = False
+watcher = None
+idle_source = None
+snapshot_pid = None
+in_flight = set()
+reloaded = None
 
-def _write_dump(arg1=None, arg2=None):
-    global target
-    gconfdumps = ("/apps/evolution", "/apps/hamster-applet", "/apps/hamster-indicator",
-                  "/apps/planner", "/desktop/gnome/keybindings", "/apps/metacity", "/apps/gthumb")
-    dconfdumps = ("/apps/seahorse", "/org/gnome/nautilus",
-                  "/org/gnome/settings-daemon/plugins/power",
-                  "/org/gnome/desktop/session", "/org/gnome/settings-daemon/peripherals/mouse",
-                  "/org/gnome/settings-daemon/peripherals/touchpad",
-                  "/org/gnome/settings-daemon/peripherals/keyboard",
-                  "/apps/onboard", "/org/gnome/libgnomekbd",
-                  "/org/freedesktop/tracker")
+gconfdumps = ("/apps/evolution", "/apps/hamster-applet", "/apps/hamster-indicator",
+              "/apps/planner", "/desktop/gnome/keybindings", "/apps/metacity", "/apps/gthumb")
+dconfdumps = ("/apps/seahorse", "/org/gnome/nautilus",
+              "/org/gnome/settings-daemon/plugins/power",
+              "/org/gnome/desktop/session", "/org/gnome/settings-daemon/peripherals/mouse",
+              "/org/gnome/settings-daemon/peripherals/touchpad",
+              "/org/gnome/settings-daemon/peripherals/keyboard",
+              "/apps/onboard", "/org/gnome/libgnomekbd",
+              "/org/freedesktop/tracker")
+
+# Changes are written once no further change arrived for DEBOUNCE seconds,
+# but never later than MAX_DELAY seconds after the first one.
+DEBOUNCE = 2
+MAX_DELAY = 10
+# GConf has no change notification we could use, so it is still polled,
+# as are dconf keys which cannot be watched. Unchanged dumps are not
+# written, though.
+GCONF_POLL = 300
+# A snapshot of the changed volume is taken in the background once it was
+# left alone for IDLE seconds.
+IDLE = 600
+BACKINTIME = "/usr/bin/backintime"
 
+def _write_dump(arg1=None, arg2=None):
+    """ Write all dumps whose content changed """
+    if paused:
+        return True
     syslog.syslog(syslog.LOG_DEBUG, "Saving GConf data.")
-    for gconfdump in gconfdumps:
-        try:
-            dumpfile = open("%s/.%s-backup.xml.dump" % (target, gconfdump.rsplit('/', 1)[1]), 'w')
-            subprocess.call(["/usr/bin/gconftool-2", "--dump", "%s" % gconfdump], stdout=dumpfile)
-            dumpfile.close()
-        except:
-            syslog.syslog(syslog.LOG_ERR, "Error occured trying to write to %s: %s" % \
-                          (dumpfile, str(sys.exc_info())))
-    for dconfdump in dconfdumps:
-        try:
-            dumpfile = open("%s/.%s-backup.txt.dump" % (target, dconfdump.rsplit('/', 1)[1]), 'w')
-            subprocess.call(["/usr/bin/dconf", "dump", "%s/" % dconfdump], stdout=dumpfile)
-            dumpfile.close()
-        except:
-            syslog.syslog(syslog.LOG_ERR, "Error occured trying to write to %s: %s" % \
-                          (dumpfile, str(sys.exc_info())))
+    try:
+        batch.save()
+    except:
+        syslog.syslog(syslog.LOG_ERR, "Error occured trying to write to %s: %s" % \
+                      (target, str(sys.exc_info())))
+    return True
+
+def _flush():
+    """ Write the dumps of the dconf subtrees changed since the last flush """
+    global flush_source, first_change
+    if paused:
+        return False
+    keys = sorted(dirty)
+    dirty.clear()
+    flush_source = None
+    first_change = None
+    try:
+        written = batch.save_dconf(keys)
+        syslog.syslog(syslog.LOG_DEBUG, "Wrote %d of %d changed DConf dumps" % \
+                      (written, len(keys)))
+    except:
+        syslog.syslog(syslog.LOG_ERR, "Error occured trying to write to %s: %s" % \
+                      (target, str(sys.exc_info())))
+    return False
+
+def _poll_gconf():
+    if paused:
+        return False
+    try:
+        if watched.unwatched:
+            batch.save_dconf(watched.unwatched)
+        batch.save_gconf()
+    except:
+        syslog.syslog(syslog.LOG_ERR, "Error occured trying to write to %s: %s" % \
+                      (target, str(sys.exc_info())))
+    return True
+
+def _changed(key):
+    """ Remember a changed subtree and (re)arm the debounce timer """
+    global flush_source, first_change
+    if paused:
+        return
+    dirty.add(key)
+    now = time.monotonic()
+    if first_change is None:
+        first_change = now
+    if flush_source is not None:
+        if now - first_change >= MAX_DELAY - DEBOUNCE:
+            return
+        GLib.source_remove(flush_source)
+    flush_source = GLib.timeout_add_seconds(DEBOUNCE, _flush)
+
+def _backupdir():
+    return os.path.join("/media", os.environ["USER"], "backup")
+
+def _save_state():
+    try:
+        extvolwatch.write_state(target, watcher.dirty | in_flight, snapshot_pid, paused,
+                                reloaded)
+    except OSError as error:
+        syslog.syslog(syslog.LOG_ERR, "Could not save the changed paths: %s" % error)
+
+def _restart_idle():
+    global idle_source
+    if idle_source is not None:
+        GLib.source_remove(idle_source)
+    idle_source = GLib.timeout_add_seconds(IDLE, _snapshot)
+
+def _files_changed(fd, condition):
+    """ Collect the paths changed on the volume and restart the idle timer """
+    if watcher.read() and not paused:
+        _restart_idle()
+    return watcher.fileno() is not None
+
+def _snapshot():
+    """ Take a snapshot of the idle volume in the background, if it changed
+        since the last one and the backup volume is there """
+    global idle_source, snapshot_pid, in_flight
+    idle_source = None
+    if paused or snapshot_pid is not None or not watcher.dirty or \
+            not os.path.isdir(_backupdir()):
+        return False
+    try:
+        snapshot_pid = GLib.spawn_async([BACKINTIME, "backup"],
+                                        flags=GLib.SpawnFlags.DO_NOT_REAP_CHILD)[0]
+    except GLib.Error as error:
+        syslog.syslog(syslog.LOG_ERR, "Could not start a snapshot: %s" % error)
+        return False
+    in_flight = watcher.take()
+    syslog.syslog(syslog.LOG_DEBUG, "Snapshot of %d changed paths started" % len(in_flight))
+    GLib.child_watch_add(GLib.PRIORITY_DEFAULT, snapshot_pid, _snapshot_done)
+    _save_state()
+    return False
+
+def _snapshot_done(pid, status):
+    global snapshot_pid, in_flight
+    GLib.spawn_close_pid(pid)
+    snapshot_pid = None
+    if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+        syslog.syslog(syslog.LOG_DEBUG, "Snapshot of %d changed paths done" % len(in_flight))
+    else:
+        syslog.syslog(syslog.LOG_ERR, "Snapshot failed with status %d" % status)
+        watcher.dirty |= in_flight
+    in_flight = set()
+    if watcher.fileno() is None:
+        # Without the watches, changes after the snapshot are not seen
+        watcher.dirty.add("")
+    elif watcher.dirty and not paused and idle_source is None:
+        _restart_idle()
+    _save_state()
+
+def _watch_volume():
+    """ Start collecting the paths changed on the volume. If it may have
+        changed since its last complete snapshot, all of it is dirty. """
+    global watcher
+    watcher = extvolwatch.Watcher(target, _watched_trees())
+    if not extvolwatch.begin_session(target):
+        watcher.dirty.add("")
+    watcher.start()
+    if watcher.fileno() is not None:
+        GLib.io_add_watch(watcher.fileno(), GLib.PRIORITY_LOW, GLib.IO_IN, _files_changed)
+    if watcher.dirty:
+        _restart_idle()
+    _save_state()
+
+def do_pause(arg1=None, arg2=None):
+    """ Write the final dumps and stop saving settings and taking snapshots,
+        but keep collecting the changed paths until the dumper is stopped """
+    global paused, idle_source
+    _write_dump()
+    paused = True
+    if idle_source is not None:
+        GLib.source_remove(idle_source)
+        idle_source = None
+    _save_state()
+    return True
+
+def _settings_keys():
+    """ Return the dconf and gconf keys of the profiles the volume holds, as
+        extvol_open recorded them, or the defaults """
+    try:
+        with open(extvolstate.VolumeState(target).path_of("settings.json"), 'r') as keys:
+            keys = json.load(keys)
+        return tuple(keys["dconf"]), tuple(keys["gconf"])
+    except (OSError, ValueError, KeyError):
+        return dconfdumps, gconfdumps
+
+def _watched_trees():
+    """ Return the trees of the profiles the volume holds, as extvol_open
+        recorded them, or None to watch all of the volume """
+    try:
+        with open(extvolstate.VolumeState(target).path_of("settings.json"), 'r') as keys:
+            return tuple(json.load(keys)["trees"])
+    except (OSError, ValueError, KeyError):
+        return None
+
+def _load_keys():
+    """ Set up saving and watching the settings of the profiles the volume
+        holds """
+    global batch, watched
+    dconf, gconf = _settings_keys()
+    batch = extvolsettings.SettingsBatch(target, dconf=dconf, gconf=gconf)
+    if watched is not None:
+        watched.close()
+    watched = extvolsettings.DconfWatch(dconf, _changed)
+    dirty.intersection_update(dconf)
+    # Changes made before the watch was listening are only seen by reading
+    # every key once more; unchanged dumps are not written
+    for key in dconf:
+        _changed(key)
+
+def do_reload(arg1=None, arg2=None):
+    """ Another volume took over some profiles: stop saving their settings,
+        without writing them here once more """
+    global reloaded
+    _load_keys()
+    reloaded = time.time()
+    _save_state()
+    syslog.syslog(syslog.LOG_DEBUG, "Reloaded the settings keys of %s" % target)
+    return True
 
 def main_loop():
-    while True:
-        _write_dump()
-        time.sleep(300)
+    global loop
+    _watch_volume()
+    _load_keys()
+    _write_dump()
+    GLib.timeout_add_seconds(GCONF_POLL, _poll_gconf)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, do_quit)
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, _write_dump)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGUSR2, do_pause)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGHUP, do_reload)
+    loop = GLib.MainLoop()
+    loop.run()
 
 def do_quit(arg1=None, arg2=None):
     _write_dump()
+    watched.close()
+    watcher.read()
+    watcher.close()
+    _save_state()
     if os.path.exists("%s/.gconf-dumper" % os.environ["HOME"]):
         os.remove("%s/.gconf-dumper" % os.environ["HOME"])
-    exit(0)
+    loop.quit()
+    return False
+
+def _options(process):
+    """ Return the options a gconf-dumper process was started with """
+    argv = process.argv
+    scripts = [i for i, arg in enumerate(argv) if os.path.basename(arg) == "gconf-dumper.py"]
+    try:
+        return dict(getopt.getopt(argv[scripts[0] + 1:], "rqput:")[0]) if scripts else {}
+    except getopt.GetoptError:
+        return {}
+
+def _dumpers(volume=None):
+    """ Return the running dumpers as (process, target) pairs, all or only
+        the one of volume """
+    dumpers = []
+    for process in extvolprocs.find(["gconf-dumper.py"]):
+        options = _options(process)
+        if "-q" in options or "-p" in options or "-u" in options:
+            continue
+        dumper_target = options.get("-t", "").rstrip('/')
+        if volume is None or volume == dumper_target:
+            dumpers.append((process, dumper_target))
+    return dumpers
 
 def main():
     global target
     syslog.openlog("extended-volume-manager")
     action = "start"
+    volume = None
     try:
-        opts, unknown = getopt.getopt(sys.argv[1:], "rqt:")
+        opts, unknown = getopt.getopt(sys.argv[1:], "rqput:")
     except getopt.GetoptError:
         pass
     for o, a in opts:
         if o == "-t":
-            target = a.rstrip('/')
+            target = volume = a.rstrip('/')
         elif o == "-r":
             action = "start"
         elif o == "-q":
             action = "stop"
+        elif o == "-p":
+            action = "pause"
+        elif o == "-u":
+            action = "reload"
     if len(unknown) > 0:
         syslog.syslog(syslog.LOG_DEBUG, "Unknown options passed, ignoring: %s" % str(unknown))
     if action == "stop":
-        args = ["ps", "-o", "pid", "-C", "gconf-dumper.py", "--no-headers"]
-        ps = subprocess.Popen(args, stdout=subprocess.PIPE)
-        for line in ps.stdout.readlines():
-            os.kill(int(line.strip()), signal.SIGTERM)
-        ps.stdout.close()
+        # Give running dumpers (all, or the one of the volume given with -t)
+        # the time to write their final dumps
+        dumpers = _dumpers(volume)
+        extvolprocs.terminate((p.pid for p, t in dumpers), timeout=10)
+    elif action == "pause":
+        # Wait until the dumper of the volume wrote its final dumps
+        for dumper, dumper_target in _dumpers(volume):
+            os.kill(dumper.pid, signal.SIGUSR2)
+            deadline = time.monotonic() + 10
+            while dumper_target and time.monotonic() < deadline:
+                state = extvolwatch.read_state(dumper_target)
+                if state is None or state.get("paused"):
+                    break
+                time.sleep(.05)
+    elif action == "reload":
+        # Wait until the dumper of the volume read the keys again
+        for dumper, dumper_target in _dumpers(volume):
+            sent = time.time()
+            os.kill(dumper.pid, signal.SIGHUP)
+            deadline = time.monotonic() + 10
+            while dumper_target and time.monotonic() < deadline:
+                state = extvolwatch.read_state(dumper_target)
+                if state is None or (state.get("reloaded") or 0) >= sent:
+                    break
+                time.sleep(.05)
     else:
         if not os.path.isdir(target):
             syslog.syslog(syslog.LOG_ERR, "Target is not a directory")
             exit(1)
         context = daemon.DaemonContext()
         context.working_directory = tempfile.gettempdir()
-        context.pidfile = lockfile.FileLock("%s/.gconf-dumper" % tempfile.gettempdir())
-        context.signal_map = {
-            signal.SIGTERM: do_quit,
-            signal.SIGHUP: 'terminate',
-            signal.SIGUSR1: _write_dump,
-            }
+        context.pidfile = lockfile.FileLock("%s/.gconf-dumper-%s" % \
+                                            (tempfile.gettempdir(), extvolstate.volume_id(target)))
+        # SIGTERM, SIGUSR1, SIGUSR2 and SIGHUP are handled on the main loop,
+        # see main_loop()
+        context.signal_map = {}
         with context:
             main_loop()
 
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Check that extvolcopy copies a tree with its metadata, and that a copy
+    resumes from the staging directory an interrupted one left behind. """
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import extvolcopy
+
+FILES = {"a.txt": b"a" * 100, "sub/b.bin": os.urandom(70000), "sub/deeper/c": b""}
+
+class CopyTest(unittest.TestCase):
+    def setUp(self):
+        self.base = tempfile.mkdtemp(prefix="extvol-test-")
+        self.src = os.path.join(self.base, "src")
+        self.dst = os.path.join(self.base, "dst")
+        for path, data in FILES.items():
+            path = os.path.join(self.src, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.utime(path, (1400000000, 1400000000))
+        os.chmod(os.path.join(self.src, "a.txt"), 0o640)
+        os.symlink("a.txt", os.path.join(self.src, "link"))
+
+    def tearDown(self):
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _check_copy(self):
+        for path, data in FILES.items():
+            with open(os.path.join(self.dst, path), 'rb') as f:
+                self.assertEqual(f.read(), data, path)
+            self.assertEqual(os.stat(os.path.join(self.dst, path)).st_mtime, 1400000000)
+        self.assertEqual(os.stat(os.path.join(self.dst, "a.txt")).st_mode & 0o777, 0o640)
+        self.assertEqual(os.readlink(os.path.join(self.dst, "link")), "a.txt")
+        self.assertFalse(os.path.exists(self.dst + extvolcopy.PARTIAL))
+
+    def test_copy(self):
+        fractions = []
+        self.assertEqual(extvolcopy.copy_tree(self.src, self.dst, fractions.append), 0)
+        self._check_copy()
+        self.assertEqual(fractions[-1], 1.0)
+        self.assertEqual(fractions, sorted(fractions))
+
+    def test_resume(self):
+        staging = self.dst + extvolcopy.PARTIAL
+        os.makedirs(os.path.join(staging, "sub/deeper"))
+        # Finished before the interruption: kept as it is
+        shutil.copy2(os.path.join(self.src, "sub/b.bin"), os.path.join(staging, "sub/b.bin"))
+        # Same size, but another time: copied again
+        with open(os.path.join(staging, "a.txt"), 'wb') as f:
+            f.write(b"x" * 100)
+        # Cut off halfway
+        with open(os.path.join(staging, "sub/deeper/c" + extvolcopy.PART), 'wb') as f:
+            f.write(b"partial")
+        self.assertEqual(extvolcopy.copy_tree(self.src, self.dst), 1)
+        self._check_copy()
+        self.assertFalse(os.path.exists(os.path.join(self.dst, "sub/deeper/c" + extvolcopy.PART)))
+
+    def test_resume_coarse_times(self):
+        staging = self.dst + extvolcopy.PARTIAL
+        os.makedirs(os.path.join(staging, "sub"))
+        staged = os.path.join(staging, "sub/b.bin")
+        shutil.copy2(os.path.join(self.src, "sub/b.bin"), staged)
+        # As FAT stores it, rounded up to two seconds
+        os.utime(staged, (1400000001, 1400000001))
+        self.assertEqual(extvolcopy.copy_tree(self.src, self.dst), 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Check that the links journal undoes exactly the operations still in
+    effect after a crash. """
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import extvoljournal
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix="extvol-test-")
+        self.volume = os.path.join(self.home, "volume")
+        os.makedirs(os.path.join(self.volume, ".config/app"))
+        os.makedirs(os.path.join(self.home, ".config/app"))
+        self.path = os.path.join(self.home, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def _open(self):
+        """ Link .config/app to the volume, keeping the old one as .old """
+        conf = os.path.join(self.home, ".config/app")
+        journal = extvoljournal.Journal(self.path)
+        journal.begin(self.volume)
+        journal.rename(conf, conf + ".old")
+        journal.symlink(os.path.join(self.volume, ".config/app"), conf)
+        journal.close()
+        return conf
+
+    def test_recover(self):
+        conf = self._open()
+        self.assertEqual([r["op"] for r in extvoljournal.read(self.path)],
+                         ["begin", "rename", "symlink"])
+        self.assertEqual(extvoljournal.recover(self.path), 2)
+        self.assertFalse(os.path.islink(conf))
+        self.assertTrue(os.path.isdir(conf))
+        self.assertFalse(os.path.exists(conf + ".old"))
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_recover_after_partial_close(self):
+        conf = self._open()
+        # The close removed the link, but died before restoring .old
+        os.remove(conf)
+        self.assertEqual(extvoljournal.recover(self.path), 1)
+        self.assertTrue(os.path.isdir(conf))
+        self.assertFalse(os.path.exists(conf + ".old"))
+
+    def test_nothing_left_to_undo(self):
+        conf = self._open()
+        os.remove(conf)
+        os.rename(conf + ".old", conf)
+        self.assertEqual(extvoljournal.recover(self.path), 0)
+        self.assertTrue(os.path.isdir(conf))
+
+    def test_torn_line(self):
+        conf = self._open()
+        with open(self.path, 'a') as journal:
+            journal.write('{"op": "symlink", "link": "%s"' % conf)
+        self.assertEqual(len(extvoljournal.read(self.path)), 3)
+        self.assertEqual(extvoljournal.recover(self.path), 2)
+
+    def test_keep(self):
+        environ = dict(os.environ)
+        os.environ["HOME"] = self.home
+        try:
+            conf = self._open()
+            with open(self.path, 'a') as journal:
+                journal.write('{"op": "symlink"')
+            extvoljournal.keep(self.path)
+            self.assertFalse(os.path.exists(self.path))
+            # Without the torn line
+            self.assertEqual(len(extvoljournal.read()), 3)
+            self.assertEqual(extvoljournal.recover(), 2)
+            self.assertTrue(os.path.isdir(conf))
+            self.assertFalse(os.path.exists(extvoljournal.default_path()))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+    def test_keep_failed_profiles(self):
+        environ = dict(os.environ)
+        os.environ["HOME"] = self.home
+        try:
+            os.makedirs(os.path.join(self.volume, ".gimp"))
+            os.makedirs(os.path.join(self.home, ".gimp"))
+            conf, gimp = os.path.join(self.home, ".config/app"), os.path.join(self.home, ".gimp")
+            journal = extvoljournal.Journal(self.path)
+            journal.begin(self.volume)
+            for name, path in (("app", conf), ("gimp", gimp)):
+                rename, symlink = journal.of(name)
+                rename(path, path + ".old")
+                symlink(os.path.join(self.volume, os.path.relpath(path, self.home)), path)
+            journal.close()
+            # gimp was closed, and a new .old made since; app failed to close
+            os.remove(gimp)
+            os.rename(gimp + ".old", gimp)
+            os.makedirs(gimp + ".old")
+            extvoljournal.keep(self.path, set(["app"]))
+            self.assertEqual([r["op"] for r in extvoljournal.read()],
+                             ["begin", "rename", "symlink"])
+            self.assertEqual(extvoljournal.recover(), 2)
+            self.assertTrue(os.path.isdir(conf) and not os.path.islink(conf))
+            self.assertTrue(os.path.isdir(gimp + ".old"))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+
+if __name__ == "__main__":
+    unittest.main()
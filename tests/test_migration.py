@@ -0,0 +1,96 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Open a synthetic volume carrying settings in their old locations and
+    check that they are migrated and linked, using the stand-ins of the
+    benchmark (bench/extvol-bench.py) for the desktop and the tools. """
+
+import os
+import sys
+import shutil
+import tempfile
+import traceback
+import unittest
+import importlib.util
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(HERE)
+sys.path.insert(0, TOP)
+
+def _load_bench():
+    spec = importlib.util.spec_from_file_location(
+        "extvol_bench", os.path.join(TOP, "bench", "extvol-bench.py"))
+    bench = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(bench)
+    return bench
+
+# Old location, new location, a file below it
+OLD_LAYOUT = (
+    (".gnome2/hamster-applet", ".local/share/hamster-applet", "hamster.db"),
+    (".openoffice.org", ".config/libreoffice", "3/user/registrymodifications.xcu"),
+    (".fonts", ".local/share/fonts", "sub/font.ttf"),
+    )
+
+class MigrationTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        self.base = tempfile.mkdtemp(prefix="extvol-test-")
+        self.home = os.path.join(self.base, "home")
+        self.mountpoint = os.path.join(self.base, "volume")
+        bindir = os.path.join(self.base, "bin")
+        for path in (self.home, self.mountpoint, bindir):
+            os.makedirs(path)
+        bench = _load_bench()
+        bench._write_stubs(bindir, 0, {})
+        # Set up already, so no defaults are needed from /etc/skel
+        os.makedirs(os.path.join(self.mountpoint, ".gnupg"))
+        for path in (".extended_volume", ".gnupg/gnupg-scripts.conf", ".gnupg/gpg-agent.conf"):
+            open(os.path.join(self.mountpoint, path), 'a').close()
+        for old, new, name in OLD_LAYOUT:
+            path = os.path.join(self.mountpoint, old, name)
+            os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write("data of %s\n" % old)
+        os.environ["HOME"] = self.home
+        os.environ["USER"] = "test"
+        os.environ["PATH"] = bindir + os.pathsep + os.environ.get("PATH", "")
+        bench._map_tools(bindir)
+        bench._install_fake_modules()
+
+        import extvolmanager
+        import extvolmounts
+        import extvolprocs
+        import extvolsettings
+        extvolsettings.USE_GIO = False
+        self.manager = extvolmanager
+        self.errors = []
+        extvolmanager.show_error = lambda message=None, variables=None: \
+            self.errors.append(message or traceback.format_exc())
+        # An old container: confirm opening it, decline everything else
+        extvolmanager.ask_user = lambda title, message: "continue and open" in message
+        extvolmounts.is_mountpoint = lambda path: True
+        extvolprocs.open_files = lambda mountpoint, exclude=(), sudo=False: []
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def test_open_migrates_and_links(self):
+        self.manager.extvol_open(self.mountpoint)
+        try:
+            self.assertEqual(self.errors, [])
+            for old, new, name in OLD_LAYOUT:
+                with open(os.path.join(self.mountpoint, new, name), 'r') as f:
+                    self.assertEqual(f.read(), "data of %s\n" % old)
+                link = os.path.join(self.home, new)
+                self.assertTrue(os.path.islink(link), link)
+                self.assertEqual(os.path.realpath(link),
+                                 os.path.realpath(os.path.join(self.mountpoint, new)))
+                self.assertTrue(os.path.exists(os.path.join(link, name)))
+        finally:
+            self.manager.extvol_close(self.mountpoint)
+        for old, new, name in OLD_LAYOUT:
+            self.assertFalse(os.path.islink(os.path.join(self.home, new)))
+
+if __name__ == "__main__":
+    unittest.main()
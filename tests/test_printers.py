@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Check that the printer manifest on a volume only makes CUPS add,
+    change or delete the queues which differ, with a stand-in for the CUPS
+    connection. """
+
+import os
+import sys
+import json
+import types
+import pickle
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+class IPPError(Exception):
+    pass
+
+class FakeConnection(object):
+    """ Queues and PPDs of a CUPS server, and the calls which change them """
+    printers = {}
+    ppds = {}
+    calls = []
+
+    def getPrinters(self):
+        return dict((name, dict(attrs)) for name, attrs in self.printers.items())
+
+    def getPPD(self, name):
+        if name not in self.ppds:
+            raise IPPError(name)
+        fd, path = tempfile.mkstemp(suffix=".ppd")
+        os.write(fd, self.ppds[name])
+        os.close(fd)
+        return path
+
+    def addPrinter(self, name, filename=None, **kwargs):
+        self.calls.append(("add", name))
+        self.printers[name] = {"device-uri": kwargs["device"], "printer-info": kwargs["info"],
+                               "printer-location": kwargs["location"], "printer-type": 0}
+
+    def enablePrinter(self, name):
+        pass
+
+    def acceptJobs(self, name):
+        pass
+
+    def deletePrinter(self, name):
+        self.calls.append(("delete", name))
+        del self.printers[name]
+
+    def setDefault(self, name):
+        self.calls.append(("default", name))
+
+cups = types.ModuleType("cups")
+cups.Connection = FakeConnection
+cups.IPPError = IPPError
+cups.CUPS_PRINTER_DEFAULT = 0x20000
+sys.modules.setdefault("cups", cups)
+
+import extvolprinters
+
+def _printer(uri, location="", default=False):
+    return {"device-uri": uri, "printer-info": "Printer at %s" % uri,
+            "printer-location": location, "printer-make-and-model": "",
+            "printer-type": 0x20000 if default else 0}
+
+class PrintersTest(unittest.TestCase):
+    def setUp(self):
+        self.mountpoint = tempfile.mkdtemp(prefix="extvol-test-")
+        self.cups = extvolprinters.cups
+        extvolprinters.cups = cups
+        FakeConnection.printers = {
+            "office": _printer("ipp://office/ipp", "Room 1", default=True),
+            "home": _printer("usb://Home/Printer")}
+        FakeConnection.ppds = {"office": b"*PPD office\n", "home": b"*PPD home\n"}
+        FakeConnection.calls = []
+
+    def tearDown(self):
+        extvolprinters.cups = self.cups
+        shutil.rmtree(self.mountpoint, ignore_errors=True)
+
+    def _manifest(self):
+        with open(os.path.join(self.mountpoint, ".cups", "printers.json"), 'r') as f:
+            return json.load(f)
+
+    def test_save(self):
+        FakeConnection.ppds["home"] = FakeConnection.ppds["office"]
+        extvolprinters.save(self.mountpoint)
+        manifest = self._manifest()
+        self.assertEqual(sorted(manifest["printers"]), ["home", "office"])
+        self.assertEqual(manifest["default"], "office")
+        self.assertEqual(manifest["printers"]["office"]["printer-location"], "Room 1")
+        # Both queues use the same PPD, which is stored once
+        digest = manifest["printers"]["office"]["ppd"]
+        self.assertEqual(manifest["printers"]["home"]["ppd"], digest)
+        self.assertEqual(os.listdir(os.path.join(self.mountpoint, ".cups", "ppd")),
+                         ["%s.ppd" % digest])
+
+    def test_load_leaves_matching_queues_alone(self):
+        extvolprinters.save(self.mountpoint)
+        extvolprinters.load(self.mountpoint)
+        self.assertEqual(FakeConnection.calls, [])
+
+    def test_load_applies_the_differences(self):
+        extvolprinters.save(self.mountpoint)
+        # Another machine: one queue missing, one set up differently
+        del FakeConnection.printers["home"]
+        FakeConnection.printers["office"] = _printer("ipp://office/ipp", "Room 2")
+        extvolprinters.load(self.mountpoint)
+        self.assertEqual(sorted(FakeConnection.calls),
+                         [("add", "home"), ("add", "office"), ("default", "office")])
+        self.assertEqual(FakeConnection.printers["office"]["printer-location"], "Room 1")
+
+    def test_changed_ppd(self):
+        extvolprinters.save(self.mountpoint)
+        digest = self._manifest()["printers"]["office"]["ppd"]
+        # Options changed on this machine are saved
+        FakeConnection.ppds["office"] = b"*PPD office, duplex\n"
+        extvolprinters.save(self.mountpoint)
+        self.assertNotEqual(self._manifest()["printers"]["office"]["ppd"], digest)
+        # and restored on a machine with the old PPD
+        FakeConnection.ppds["office"] = b"*PPD office\n"
+        extvolprinters.load(self.mountpoint)
+        self.assertEqual(FakeConnection.calls, [("add", "office")])
+
+    def test_deleted_queues(self):
+        extvolprinters.save(self.mountpoint)
+        del FakeConnection.printers["home"]
+        extvolprinters.save(self.mountpoint)
+        self.assertEqual(self._manifest()["deleted"], ["home"])
+        # A machine which still has the queue deletes it
+        FakeConnection.printers["home"] = _printer("usb://Home/Printer")
+        extvolprinters.load(self.mountpoint)
+        self.assertEqual(FakeConnection.calls, [("delete", "home")])
+        self.assertNotIn("home", FakeConnection.printers)
+        # Applied once, so a queue of that name added later is kept
+        self.assertEqual(self._manifest()["deleted"], [])
+
+    def test_legacy_manifest(self):
+        cupsdir = os.path.join(self.mountpoint, ".cups")
+        os.makedirs(cupsdir)
+        with open(os.path.join(cupsdir, "printers"), 'wb') as legacy:
+            pickle.dump(FakeConnection.printers, legacy)
+        with open(os.path.join(cupsdir, "default-printer"), 'w') as default:
+            default.write("home\n")
+        manifest = extvolprinters.read_manifest(self.mountpoint)
+        self.assertEqual(sorted(manifest["printers"]), ["home", "office"])
+        self.assertEqual(manifest["default"], "home")
+        self.assertIsNone(manifest["printers"]["office"]["ppd"])
+
+if __name__ == "__main__":
+    unittest.main()
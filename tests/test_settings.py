@@ -0,0 +1,174 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Check the splitting and merging of dconf and GConf dumps, and that a
+    SettingsBatch loads and saves all keys with one call per tool. """
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import extvolsettings
+
+DCONF_DUMP = """[org/gnome/nemo/preferences]
+show-hidden-files=true
+
+[org/gnome/nemo/window-state]
+geometry='800x600+0+0'
+
+[org/gnome/desktop/interface]
+clock-format='24h'
+
+[apps/seahorse]
+server-auto-publish=false
+"""
+
+GCONF_DUMP = """<gconfentryfile>
+<entrylist base="/apps/evolution">
+<entry><key>mail/display/charset</key><value><string>UTF-8</string></value></entry>
+<entry><key>shell/view_defaults/component_id</key><value><string>mail</string></value></entry>
+</entrylist>
+<entrylist base="/apps/hamster-applet">
+<entry><key>general/day_start_minutes</key><value><int>300</int></value></entry>
+</entrylist>
+</gconfentryfile>
+"""
+
+# Prints the dumps above and records what is loaded, with the arguments
+STUB = """#!/bin/sh
+echo "$@" >> %(dir)s/%(tool)s.calls
+case "$1" in
+    dump|--dump) cat %(dir)s/%(tool)s.dump ;;
+    load) cat > %(dir)s/%(tool)s.loaded ;;
+    --load) cat "$2" > %(dir)s/%(tool)s.loaded ;;
+esac
+"""
+
+class SplitMergeTest(unittest.TestCase):
+    def test_dump_path(self):
+        self.assertEqual(extvolsettings.dump_path("/media/v", "/org/gnome/nemo/", "dconf"),
+                         "/media/v/.nemo-backup.txt.dump")
+        self.assertEqual(extvolsettings.dump_path("/media/v", "/apps/evolution", "gconf"),
+                         "/media/v/.evolution-backup.xml.dump")
+
+    def test_split_dconf_dump(self):
+        dumps = extvolsettings.split_dconf_dump(
+            DCONF_DUMP, ["/org/gnome/nemo", "/apps/seahorse", "/org/gnome/gedit"])
+        self.assertEqual(dumps["/org/gnome/nemo"],
+                         "[preferences]\nshow-hidden-files=true\n\n"
+                         "[window-state]\ngeometry='800x600+0+0'\n")
+        self.assertEqual(dumps["/apps/seahorse"], "[/]\nserver-auto-publish=false\n")
+        self.assertEqual(dumps["/org/gnome/gedit"], "")
+
+    def test_split_dconf_dump_longest_key(self):
+        dumps = extvolsettings.split_dconf_dump(
+            DCONF_DUMP, ["/org/gnome", "/org/gnome/nemo/preferences"])
+        self.assertEqual(dumps["/org/gnome/nemo/preferences"], "[/]\nshow-hidden-files=true\n")
+        self.assertNotIn("show-hidden-files", dumps["/org/gnome"])
+        self.assertIn("[nemo/window-state]", dumps["/org/gnome"])
+
+    def test_merge_dconf_dumps(self):
+        keys = ["/org/gnome/nemo", "/apps/seahorse"]
+        merged = extvolsettings.merge_dconf_dumps(extvolsettings.split_dconf_dump(DCONF_DUMP, keys))
+        self.assertIn("[org/gnome/nemo/window-state]\ngeometry='800x600+0+0'", merged)
+        self.assertIn("[apps/seahorse]\nserver-auto-publish=false", merged)
+        self.assertNotIn("clock-format", merged)
+        # Splitting the merged dump again gives the same per-key dumps
+        self.assertEqual(extvolsettings.split_dconf_dump(merged, keys),
+                         extvolsettings.split_dconf_dump(DCONF_DUMP, keys))
+
+    def test_split_and_merge_gconf_dump(self):
+        keys = ["/apps/evolution/mail", "/apps/hamster-applet"]
+        dumps = extvolsettings.split_gconf_dump(GCONF_DUMP, keys)
+        self.assertIn('base="/apps/evolution/mail"', dumps["/apps/evolution/mail"])
+        self.assertIn("<key>display/charset</key>", dumps["/apps/evolution/mail"])
+        self.assertNotIn("component_id", dumps["/apps/evolution/mail"])
+        self.assertIn("<key>general/day_start_minutes</key>", dumps["/apps/hamster-applet"])
+        merged = extvolsettings.merge_gconf_dumps(dumps)
+        self.assertEqual(extvolsettings.split_gconf_dump(merged, keys), dumps)
+
+class SettingsBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.base = tempfile.mkdtemp(prefix="extvol-test-")
+        self.mountpoint = os.path.join(self.base, "volume")
+        os.makedirs(self.mountpoint)
+        self.tools = (extvolsettings.DCONF, extvolsettings.GCONFTOOL, extvolsettings.USE_GIO)
+        extvolsettings.USE_GIO = False
+        extvolsettings.DCONF = self._stub("dconf", DCONF_DUMP)
+        extvolsettings.GCONFTOOL = self._stub("gconftool-2", GCONF_DUMP)
+        self.batch = extvolsettings.SettingsBatch(
+            self.mountpoint, dconf=["/org/gnome/nemo/", "/apps/seahorse"],
+            gconf=["/apps/evolution", "/apps/hamster-applet"])
+
+    def tearDown(self):
+        extvolsettings.DCONF, extvolsettings.GCONFTOOL, extvolsettings.USE_GIO = self.tools
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def _stub(self, tool, dump):
+        path = os.path.join(self.base, tool)
+        with open(path, 'w') as stub:
+            stub.write(STUB % {"dir": self.base, "tool": tool})
+        os.chmod(path, 0o755)
+        with open(os.path.join(self.base, tool + ".dump"), 'w') as f:
+            f.write(dump)
+        return path
+
+    def _read(self, name):
+        with open(os.path.join(self.base, name), 'r') as f:
+            return f.read()
+
+    def test_save_writes_one_dump_per_key(self):
+        self.batch.save()
+        with open(os.path.join(self.mountpoint, ".nemo-backup.txt.dump"), 'r') as f:
+            self.assertIn("[preferences]\nshow-hidden-files=true", f.read())
+        with open(os.path.join(self.mountpoint, ".hamster-applet-backup.xml.dump"), 'r') as f:
+            self.assertIn("day_start_minutes", f.read())
+        self.assertEqual(self._read("dconf.calls"), "dump /\n")
+        self.assertEqual(self._read("gconftool-2.calls"),
+                         "--dump /apps/evolution /apps/hamster-applet\n")
+
+    def test_load_merges_the_dumps(self):
+        self.batch.save()
+        os.remove(os.path.join(self.base, "dconf.calls"))
+        os.remove(os.path.join(self.base, "gconftool-2.calls"))
+        self.batch.load()
+        self.assertEqual(len(self._read("dconf.calls").splitlines()), 1)
+        self.assertEqual(len(self._read("gconftool-2.calls").splitlines()), 1)
+        loaded = self._read("dconf.loaded")
+        self.assertIn("[org/gnome/nemo/preferences]\nshow-hidden-files=true", loaded)
+        self.assertIn("[apps/seahorse]\nserver-auto-publish=false", loaded)
+        loaded = self._read("gconftool-2.loaded")
+        self.assertIn('base="/apps/evolution"', loaded)
+        self.assertIn('base="/apps/hamster-applet"', loaded)
+
+    def test_failed_tool_keeps_the_dumps(self):
+        self.batch.save()
+        path = os.path.join(self.mountpoint, ".nemo-backup.txt.dump")
+        with open(path, 'r') as f:
+            saved = f.read()
+        with open(extvolsettings.DCONF, 'w') as stub:
+            stub.write("#!/bin/sh\nexit 1\n")
+        self.assertEqual(extvolsettings.SettingsBatch(
+            self.mountpoint, dconf=["/org/gnome/nemo"]).save_dconf(), 0)
+        with open(path, 'r') as f:
+            self.assertEqual(f.read(), saved)
+
+    def test_reset_settings_empty_the_dump(self):
+        self.batch.save()
+        with open(os.path.join(self.base, "dconf.dump"), 'w') as f:
+            f.write("[org/gnome/gedit]\nx=1\n")
+        self.assertEqual(self.batch.save_dconf(), 2)
+        with open(os.path.join(self.mountpoint, ".nemo-backup.txt.dump"), 'r') as f:
+            self.assertNotIn("show-hidden-files", f.read())
+
+    def test_load_without_dumps(self):
+        self.batch.load()
+        self.assertFalse(os.path.exists(os.path.join(self.base, "dconf.calls")))
+        self.assertFalse(os.path.exists(os.path.join(self.base, "gconftool-2.calls")))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Check the state directories of open volumes and how the profiles are
+    assigned to them. """
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import collections
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import extvolstate
+
+Profile = collections.namedtuple("Profile", "name")
+PROFILES = [Profile("evolution"), Profile("firefox"), Profile("gimp")]
+
+def _provides(*names):
+    return lambda profile: profile.name in names
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        self.home = tempfile.mkdtemp(prefix="extvol-test-")
+        os.environ["HOME"] = self.home
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.home, ignore_errors=True)
+
+    def _open(self, mountpoint):
+        state = extvolstate.VolumeState(mountpoint)
+        state.create()
+        return state
+
+    def test_volume_state(self):
+        state = extvolstate.VolumeState("/media/user/My Disk/")
+        self.assertEqual(state.id, "%2Fmedia%2Fuser%2FMy%20Disk")
+        self.assertFalse(state.exists())
+        state.create()
+        self.assertTrue(state.exists())
+        self.assertEqual([v.mountpoint for v in extvolstate.open_volumes()],
+                         ["/media/user/My Disk"])
+        state.remove()
+        self.assertEqual(extvolstate.open_volumes(), [])
+
+    def test_alone(self):
+        state = self._open("/media/user/volume")
+        held, provided, taken = extvolstate.claim(state, PROFILES, _provides("gimp"))
+        # Profiles without data on the volume are held as fallbacks
+        self.assertEqual(held, set(["evolution", "firefox", "gimp"]))
+        self.assertEqual(provided, set(["gimp"]))
+        self.assertEqual(taken, {})
+        self.assertEqual(extvolstate.fallbacks(state), set(["evolution", "firefox"]))
+
+    def test_take_over(self):
+        first = self._open("/media/user/first")
+        extvolstate.claim(first, PROFILES, _provides("gimp"))
+        second = self._open("/media/user/second")
+        held, provided, taken = extvolstate.claim(second, PROFILES,
+                                                  _provides("gimp", "firefox"))
+        # gimp stays where its data is, the firefox fallback is taken over
+        self.assertEqual(held, set(["firefox"]))
+        self.assertEqual(provided, set(["firefox"]))
+        self.assertEqual(taken, {first.id: set(["firefox"])})
+        self.assertEqual(extvolstate.claimed(first), set(["evolution", "gimp"]))
+        self.assertEqual(first.handed_over(), set(["firefox"]))
+        self.assertEqual(extvolstate.fallbacks(first), set(["evolution", "firefox"]))
+
+    def test_pinned(self):
+        first = self._open("/media/user/first")
+        extvolstate.claim(first, PROFILES, _provides())
+        second = self._open("/media/user/second")
+        held, provided, taken = extvolstate.claim(second, PROFILES,
+                                                  _provides("gimp", "firefox"),
+                                                  pinned=set(["gimp"]))
+        self.assertEqual(held, set(["firefox"]))
+        self.assertEqual(taken, {first.id: set(["firefox"])})
+        self.assertEqual(extvolstate.claimed(first), set(["evolution", "gimp"]))
+
+    def test_release(self):
+        first = self._open("/media/user/first")
+        extvolstate.claim(first, PROFILES, _provides("gimp"))
+        extvolstate.release(first)
+        self.assertEqual(extvolstate.claimed(first), set())
+        second = self._open("/media/user/second")
+        held, provided, taken = extvolstate.claim(second, PROFILES, _provides())
+        self.assertEqual(held, set(p.name for p in PROFILES))
+        self.assertEqual(taken, {})
+
+    def test_stale_and_legacy_claims(self):
+        other = self._open("/media/user/other")
+        # Claims as older versions wrote them, one of a volume which is gone
+        with open(os.path.join(extvolstate.root(), extvolstate.CLAIMS), 'w') as claims:
+            json.dump({"evolution": other.id, "gimp": "%2Fmedia%2Fuser%2Fcrashed"}, claims)
+        state = self._open("/media/user/volume")
+        held, provided, taken = extvolstate.claim(state, PROFILES, _provides("evolution", "gimp"))
+        self.assertEqual(held, set(["firefox", "gimp"]))
+        self.assertEqual(taken, {})
+        self.assertEqual(extvolstate.claimed(other), set(["evolution"]))
+
+if __name__ == "__main__":
+    unittest.main()
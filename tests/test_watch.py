@@ -0,0 +1,101 @@
+#!/usr/bin/python3
+# Encoding: UTF-8
+""" Check the dirty set collected by the volume watcher and the snapshot
+    token which lets a clean close skip the snapshot. """
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+import extvolwatch
+
+class WatchTest(unittest.TestCase):
+    def setUp(self):
+        self.environ = dict(os.environ)
+        self.base = tempfile.mkdtemp(prefix="extvol-test-")
+        self.home = os.path.join(self.base, "home")
+        self.mountpoint = os.path.join(self.base, "volume")
+        for path in (self.home, os.path.join(self.mountpoint, ".config/app"),
+                     os.path.join(self.mountpoint, "Trash")):
+            os.makedirs(path)
+        with open(os.path.join(self.mountpoint, ".config/app/settings"), 'w') as f:
+            f.write("old\n")
+        os.environ["HOME"] = self.home
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.base, ignore_errors=True)
+
+    def test_excluded(self):
+        self.assertTrue(extvolwatch.excluded(extvolwatch.STAMP))
+        self.assertTrue(extvolwatch.excluded(".local/share/backintime/x"))
+        self.assertTrue(extvolwatch.excluded("Documents/.Trash-1000/file"))
+        self.assertTrue(extvolwatch.excluded("notes.txt~"))
+        self.assertFalse(extvolwatch.excluded(".config/app/settings"))
+
+    def test_watcher(self):
+        watcher = extvolwatch.Watcher(self.mountpoint)
+        watcher.start()
+        self.addCleanup(watcher.close)
+        self.assertIsNotNone(watcher.fileno())
+        with open(os.path.join(self.mountpoint, ".config/app/settings"), 'w') as f:
+            f.write("new\n")
+        os.makedirs(os.path.join(self.mountpoint, "Documents"))
+        open(os.path.join(self.mountpoint, "Trash", "deleted"), 'w').close()
+        self.assertGreater(watcher.read(), 0)
+        # The new directory is watched as well
+        open(os.path.join(self.mountpoint, "Documents", "letter"), 'w').close()
+        watcher.read()
+        self.assertEqual(watcher.take(), set([".config/app/settings", "Documents",
+                                             "Documents/letter"]))
+        self.assertEqual(watcher.take(), set())
+
+    def test_watched_trees(self):
+        os.makedirs(os.path.join(self.mountpoint, "Other/deep"))
+        watcher = extvolwatch.Watcher(self.mountpoint, [".config/app"])
+        watcher.start()
+        self.addCleanup(watcher.close)
+        self.assertEqual(sorted(watcher._paths.values()), ["", ".config", ".config/app"])
+        with open(os.path.join(self.mountpoint, ".config/app/settings"), 'w') as f:
+            f.write("new\n")
+        # Outside the watched trees
+        open(os.path.join(self.mountpoint, "Other/deep", "file"), 'w').close()
+        os.makedirs(os.path.join(self.mountpoint, "Documents"))
+        watcher.read()
+        # Directories created while watching are watched from then on
+        open(os.path.join(self.mountpoint, "Documents", "letter"), 'w').close()
+        watcher.read()
+        self.assertEqual(watcher.take(), set([".config/app/settings", "Documents",
+                                             "Documents/letter"]))
+
+    def test_state(self):
+        extvolwatch.write_state(self.mountpoint, set(["b", "a"]), snapshot_pid=42)
+        state = extvolwatch.read_state(self.mountpoint)
+        self.assertEqual(state["dirty"], ["a", "b"])
+        self.assertEqual(state["snapshot_pid"], 42)
+
+    def test_session_tokens(self):
+        # Never closed here
+        self.assertFalse(extvolwatch.begin_session(self.mountpoint))
+        extvolwatch.end_session(self.mountpoint, True)
+        self.assertTrue(extvolwatch.begin_session(self.mountpoint))
+        # Open, so a crash from here on leaves it changed
+        self.assertFalse(extvolwatch.begin_session(self.mountpoint))
+        extvolwatch.end_session(self.mountpoint, False)
+        self.assertFalse(extvolwatch.begin_session(self.mountpoint))
+
+    def test_changed_elsewhere(self):
+        extvolwatch.end_session(self.mountpoint, True)
+        # Closed on another machine, which wrote its own token
+        with open(os.path.join(self.mountpoint, extvolwatch.STAMP), 'w') as stamp:
+            stamp.write("0123\n")
+        self.assertFalse(extvolwatch.begin_session(self.mountpoint))
+
+if __name__ == "__main__":
+    unittest.main()